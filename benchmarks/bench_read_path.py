@@ -0,0 +1,99 @@
+"""
+Compares the cost of serializing a page of users to JSON through the ORM
+models (a prefetching queryset + User.as_dict) and through the driver rows
+(get_user_list_values + User.row_as_dict, encoded a row at a time with
+dumps_page), per row of the page.
+
+Usage: python benchmarks/bench_read_path.py [--rows 10000] [--repeat 5]
+"""
+import asyncio
+import os
+import sys
+import tracemalloc
+from argparse import ArgumentParser
+from time import perf_counter
+from typing import Awaitable, Callable, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tortoise import Tortoise  # noqa: E402
+
+from benchmarks.data import populate  # noqa: E402
+from fooapi_async.app import generate_schemas  # noqa: E402
+from fooapi_async.database_operations import (  # noqa: E402
+    get_user_list_values)
+from fooapi_async.models import User  # noqa: E402
+from fooapi_async.pool import pooled_db_config  # noqa: E402
+from fooapi_async.serialization import dumps, dumps_page  # noqa: E402
+
+
+async def model_path(limit: int) -> bytes:
+    users = await User.all()\
+        .order_by('created_at', 'id')\
+        .limit(limit)\
+        .prefetch_related('contacts')
+    total = await User.all().count()
+    return dumps({
+        'total': total,
+        'result': [u.as_dict() for u in users]
+    })
+
+
+async def values_path(limit: int) -> bytes:
+    users, contacts, total = await get_user_list_values(limit=limit)
+    return dumps_page({'total': total},
+                      (User.row_as_dict(u, contacts) for u in users))
+
+
+async def measure(path: Callable[[int], Awaitable[bytes]], rows: int,
+                  repeat: int) -> Tuple[float, int]:
+    """
+    Returns the best wall time of the path and the peak of the memory it
+    allocated, as traced by tracemalloc
+    """
+    await path(rows)  # warm up
+
+    best = float('inf')
+    for _ in range(repeat):
+        started = perf_counter()
+        await path(rows)
+        best = min(best, perf_counter() - started)
+
+    tracemalloc.start()
+    await path(rows)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return best, peak
+
+
+async def main(rows: int, repeat: int) -> None:
+    await Tortoise.init(config={
+        'connections': {'default': pooled_db_config('sqlite://:memory:')},
+        'apps': {
+            'models': {
+                'models': ['fooapi_async.models'],
+                'default_connection': 'default'
+            }
+        }
+    })
+    try:
+        await generate_schemas()
+        await populate(rows, contacts_per_user=2)
+
+        print(f'{rows} users with 2 contacts each, best of {repeat} runs')
+        print(f'{"path":<8}{"us/row":>10}{"peak B/row":>14}')
+        for name, path in (('models', model_path), ('values', values_path)):
+            best, peak = await measure(path, rows, repeat)
+            print(f'{name:<8}{best / rows * 1e6:>10.1f}{peak / rows:>14.0f}')
+    finally:
+        await Tortoise.close_connections()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.rows, args.repeat))
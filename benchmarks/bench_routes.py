@@ -0,0 +1,380 @@
+"""
+Load test of every route of the API: seeds users with their contacts,
+serves the application in-process and drives one endpoint after another
+with concurrent clients, reporting the throughput and latency percentiles
+of each endpoint as JSON. Given the results of a previous run, exits with
+status 1 if an endpoint got slower than the tolerance allows.
+
+Usage: python benchmarks/bench_routes.py [--users 1000] [--contacts 3]
+    [--requests 200] [--concurrency 10] [--settings-file settings-dev.json]
+    [--db-uri sqlite://:memory:] [--output results.json]
+    [--baseline previous.json] [--tolerance 0.2]
+"""
+import asyncio
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+from argparse import ArgumentParser, Namespace
+from math import ceil
+from os.path import expanduser
+from random import Random
+from time import perf_counter
+from typing import (
+    Any, Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple)
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jwt  # noqa: E402
+from tornado.httpclient import AsyncHTTPClient  # noqa: E402
+from tornado.httpserver import HTTPServer  # noqa: E402
+from tornado.log import access_log  # noqa: E402
+from tornado.netutil import bind_sockets  # noqa: E402
+
+from benchmarks.data import generate_users, populate  # noqa: E402
+from fooapi_async import app  # noqa: E402
+from fooapi_async.models import Contact, User  # noqa: E402
+from fooapi_async.routes import routes  # noqa: E402
+
+CREATOR_ID = 1
+
+# path, body and headers of a request
+Request = Tuple[str, Optional[bytes], Dict[str, str]]
+
+
+class Scenario:
+    """
+    State shared by the requests: the ids of the seeded rows, and the ones
+    not deleted yet by the DELETE endpoints, which use each id once
+    """
+
+    def __init__(self, user_ids: Sequence[int], contact_ids: Sequence[int],
+                 token: str, page_size: int) -> None:
+        self.random = Random(0)
+        self.user_ids = list(user_ids)
+        self.contact_ids = list(contact_ids)
+        self.page_size = page_size
+        self.auth = {'Authorization': f'Bearer {token}'}
+        self._disposable_users = self.random.sample(self.user_ids,
+                                                    len(self.user_ids))
+        self._disposable_contacts = self.random.sample(self.contact_ids,
+                                                       len(self.contact_ids))
+
+    def user_id(self) -> int:
+        return self.random.choice(self.user_ids)
+
+    def contact_id(self) -> int:
+        return self.random.choice(self.contact_ids)
+
+    def disposable_user_id(self) -> int:
+        return self._disposable_users.pop()
+
+    def disposable_contact_id(self) -> int:
+        return self._disposable_contacts.pop()
+
+    def form(self, **fields: Any) -> Tuple[bytes, Dict[str, str]]:
+        return urlencode(fields).encode('utf8'), dict(
+            self.auth, **{'Content-Type': 'application/x-www-form-urlencoded'})
+
+
+class Endpoint(NamedTuple):
+    method: str
+    # pattern of the route in routes.py
+    route: str
+    make_request: Callable[[Scenario], Request]
+    status: int = 200
+    # the rows every request deletes, if any: 'users' or 'contacts'
+    deletes: Optional[str] = None
+
+    @property
+    def name(self) -> str:
+        return f'{self.method} {self.route}'
+
+
+def _list_users(s: Scenario) -> Request:
+    return f'/api/users?limit={s.page_size}', None, {}
+
+
+def _get_user(s: Scenario) -> Request:
+    return f'/api/users/{s.user_id()}', None, {}
+
+
+def _list_contacts(s: Scenario) -> Request:
+    return f'/api/users/{s.user_id()}/contacts?limit={s.page_size}', None, {}
+
+
+def _get_contact(s: Scenario) -> Request:
+    return f'/api/contacts/{s.contact_id()}', None, {}
+
+
+def _get_contacts_by_ids(s: Scenario) -> Request:
+    ids = s.random.sample(s.contact_ids,
+                          min(s.page_size, len(s.contact_ids)))
+    return '/api/contacts?ids={}'.format(','.join(map(str, ids))), None, {}
+
+
+def _lookup_contacts(s: Scenario) -> Request:
+    # the seeded emails, in other cases (see generate_users)
+    email = 'User{}.1@Example.com'.format(s.random.randrange(len(s.user_ids)))
+    return f'/api/contacts/lookup?email={email}', None, {}
+
+
+def _export_users(s: Scenario) -> Request:
+    return '/api/export/users', None, {}
+
+
+def _create_user(s: Scenario) -> Request:
+    return ('/api/users',) + s.form(name='Load Test')
+
+
+def _update_user(s: Scenario) -> Request:
+    return (f'/api/users/{s.user_id()}',) + s.form(name='Load Test')
+
+
+def _create_contact(s: Scenario) -> Request:
+    return (f'/api/users/{s.user_id()}/contacts',) + s.form(
+        phone_no='+380501234567', type='home')
+
+
+def _update_contact(s: Scenario) -> Request:
+    return (f'/api/contacts/{s.contact_id()}',) + s.form(
+        email='load.test@example.com', type='work')
+
+
+def _import_users(s: Scenario) -> Request:
+    users = generate_users(10, 2, seed=s.random.randrange(2 ** 32))
+    body = b''.join(json.dumps(u).encode('utf8') + b'\n' for u in users)
+    return '/api/users/import', body, s.auth
+
+
+def _batch(s: Scenario) -> Request:
+    # the sync of a new user: the user, then the contacts one by one
+    operations = [{'method': 'POST', 'path': '/api/users',
+                   'body': {'name': 'Load Test'}}]
+    operations.extend(
+        {'method': 'POST', 'path': '/api/users/$0/contacts',
+         'body': {'email': f'load.test{i}@example.com', 'type': 'work'}}
+        for i in range(3))
+    body = json.dumps({'operations': operations}).encode('utf8')
+    return '/api/batch', body, dict(s.auth,
+                                    **{'Content-Type': 'application/json'})
+
+
+def _delete_contact(s: Scenario) -> Request:
+    return f'/api/contacts/{s.disposable_contact_id()}', None, s.auth
+
+
+def _delete_user_contacts(s: Scenario) -> Request:
+    return f'/api/users/{s.disposable_user_id()}/contacts', None, s.auth
+
+
+def _delete_user(s: Scenario) -> Request:
+    return f'/api/users/{s.disposable_user_id()}', None, s.auth
+
+
+# run in this order, so that the reads find every seeded row
+ENDPOINTS = [
+    Endpoint('GET', r'/api/users', _list_users),
+    Endpoint('GET', r'/api/users/(\d+)', _get_user),
+    Endpoint('GET', r'/api/users/(\d+)/contacts', _list_contacts),
+    Endpoint('GET', r'/api/contacts/(\d+)', _get_contact),
+    Endpoint('GET', r'/api/contacts', _get_contacts_by_ids),
+    Endpoint('GET', r'/api/contacts/lookup', _lookup_contacts),
+    Endpoint('GET', r'/api/export/users', _export_users),
+    Endpoint('POST', r'/api/users', _create_user, 201),
+    Endpoint('PUT', r'/api/users/(\d+)', _update_user, 204),
+    Endpoint('POST', r'/api/users/(\d+)/contacts', _create_contact, 201),
+    Endpoint('PUT', r'/api/contacts/(\d+)', _update_contact, 204),
+    Endpoint('POST', r'/api/users/import', _import_users),
+    Endpoint('POST', r'/api/batch', _batch),
+    Endpoint('DELETE', r'/api/contacts/(\d+)', _delete_contact, 204,
+             'contacts'),
+    Endpoint('DELETE', r'/api/users/(\d+)/contacts', _delete_user_contacts,
+             204, 'users'),
+    Endpoint('DELETE', r'/api/users/(\d+)', _delete_user, 204, 'users'),
+]
+
+
+def percentile(ordered: Sequence[float], p: float) -> float:
+    """
+    Nearest-rank percentile of sorted values
+    """
+    return ordered[max(0, ceil(p / 100 * len(ordered)) - 1)]
+
+
+async def drive(client: AsyncHTTPClient, base_url: str, endpoint: Endpoint,
+                scenario: Scenario, requests: int,
+                concurrency: int) -> Dict[str, Any]:
+    """
+    Sends the requests to the endpoint from concurrency clients, each
+    sending its next request as soon as it gets a response
+    """
+    latencies = []  # type: List[float]
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def send() -> None:
+        nonlocal errors
+        for _ in remaining:
+            path, body, headers = endpoint.make_request(scenario)
+            started = perf_counter()
+            response = await client.fetch(
+                base_url + path, method=endpoint.method, body=body,
+                headers=headers, raise_error=False)
+            latencies.append(perf_counter() - started)
+            if response.code != endpoint.status:
+                errors += 1
+
+    started = perf_counter()
+    await asyncio.gather(*(send() for _ in range(concurrency)))
+    elapsed = perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': errors,
+        'throughput': requests / elapsed,
+        'p50_ms': 1000 * percentile(latencies, 50),
+        'p95_ms': 1000 * percentile(latencies, 95),
+        'p99_ms': 1000 * percentile(latencies, 99),
+        'max_ms': 1000 * latencies[-1],
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any],
+            tolerance: float) -> List[str]:
+    """
+    Returns the regressions of the results from the baseline: endpoints
+    whose p95 latency grew, or whose throughput shrank, by more than the
+    tolerance
+    """
+    regressions = []
+    for name, current in results['endpoints'].items():
+        previous = baseline['endpoints'].get(name)
+        if previous is None:
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append('{}: p95 {:.2f}ms -> {:.2f}ms'.format(
+                name, previous['p95_ms'], current['p95_ms']))
+        if current['throughput'] < previous['throughput'] / (1 + tolerance):
+            regressions.append('{}: throughput {:.1f}/s -> {:.1f}/s'.format(
+                name, previous['throughput'], current['throughput']))
+    return regressions
+
+
+def _commit() -> Optional[str]:
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                            capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def _token() -> str:
+    with open(expanduser(app.settings.priv_key), 'r') as f:
+        key = f.read()
+    return jwt.encode({'id': CREATOR_ID}, key,
+                      algorithm='RS256').decode('utf8')
+
+
+async def main(args: Namespace) -> Dict[str, Any]:
+    settings = app.settings
+    await app.init_db(settings, with_replicas=False)
+    server = None
+    try:
+        await app.generate_schemas()
+        await populate(args.users, args.contacts, CREATOR_ID)
+        scenario = Scenario(
+            await User.all().values_list('id', flat=True),
+            await Contact.all().values_list('id', flat=True),
+            _token(), settings.paging_max_limit)
+
+        sockets = bind_sockets(0, '127.0.0.1')
+        base_url = 'http://127.0.0.1:{}'.format(sockets[0].getsockname()[1])
+        server = HTTPServer(app.make_app(routes))
+        server.add_sockets(sockets)
+        client = AsyncHTTPClient(force_instance=True,
+                                 max_clients=args.concurrency)
+
+        endpoints = {}
+        for endpoint in ENDPOINTS:
+            await drive(client, base_url, endpoint, scenario, args.warmup,
+                        args.concurrency)
+            endpoints[endpoint.name] = await drive(
+                client, base_url, endpoint, scenario, args.requests,
+                args.concurrency)
+        client.close()
+    finally:
+        if server is not None:
+            server.stop()
+            await server.close_all_connections()
+        await app.close_db_connections()
+
+    return {
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'db_uri': settings.db_uri,
+        'users': args.users,
+        'contacts_per_user': args.contacts,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'endpoints': endpoints,
+    }
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--contacts', type=int, default=3,
+                        help='contacts per user')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=10,
+                        help='requests per endpoint before measuring')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--settings-file', default='settings-dev.json')
+    parser.add_argument('--db-uri', default='sqlite://:memory:',
+                        help='an empty database to seed')
+    parser.add_argument('--output', help='file to write the results to, '
+                                         'instead of the standard output')
+    parser.add_argument('--baseline', help='results of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='regression allowed relative to the baseline')
+    args = parser.parse_args()
+
+    missing = {pattern for pattern, _ in routes} - \
+        {e.route for e in ENDPOINTS}
+    if missing:
+        parser.error('No endpoint drives the routes {}'.format(
+            ', '.join(sorted(missing))))
+    # the DELETE endpoints delete a different row with every request
+    seeded = {'users': args.users, 'contacts': args.users * args.contacts}
+    for rows, count in seeded.items():
+        deleted = (args.requests + args.warmup) * \
+            sum(1 for e in ENDPOINTS if e.deletes == rows)
+        if deleted > count:
+            parser.error(f'The DELETE endpoints need {deleted} {rows}, '
+                         f'{count} would be seeded')
+
+    app.init_settings(args.settings_file)
+    app.settings.db_uri = args.db_uri
+    # the expected 4xx responses would be logged as warnings
+    access_log.setLevel(logging.ERROR)
+
+    results = asyncio.run(main(args))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,54 @@
+"""
+Synthetic users and contacts for the benchmarks, written with the
+multi-row INSERTs of the import
+"""
+from random import Random
+from typing import Any, Dict, Iterator, List
+
+from fooapi_async.database_operations import import_users
+from fooapi_async.models import ContactTypeEnum
+
+FIRST_NAMES = ('Alice', 'Bohdan', 'Chen', 'Dana', 'Emeka', 'Fatima', 'Goran',
+               'Hana', 'Ivan', 'Julia', 'Kofi', 'Lena', 'Mateo', 'Nadia')
+LAST_NAMES = ('Novak', 'Smith', 'Kowalski', 'Tanaka', 'Okafor', 'Garcia',
+              'Shevchenko', 'Muller', 'Rossi', 'Haddad', 'Larsen', 'Silva')
+CONTACT_TYPES = tuple(int(t) for t in ContactTypeEnum)
+
+
+def generate_users(count: int, contacts_per_user: int,
+                   seed: int = 0) -> Iterator[Dict[str, Any]]:
+    """
+    Yields users, each with contacts_per_user contacts alternating between
+    a phone number and an email, in the form import_users takes. The same
+    seed always produces the same users.
+    """
+    random = Random(seed)
+    for i in range(count):
+        name = '{} {}'.format(random.choice(FIRST_NAMES),
+                              random.choice(LAST_NAMES))
+        contacts = []
+        for j in range(contacts_per_user):
+            contact = {'phone_no': '', 'email': '',
+                       'type': random.choice(CONTACT_TYPES)}
+            if j % 2:
+                contact['email'] = 'user{}.{}@example.com'.format(i, j)
+            else:
+                contact['phone_no'] = '+3805{:08d}'.format(
+                    random.randrange(10 ** 8))
+            contacts.append(contact)
+        yield {'name': name, 'contacts': contacts}
+
+
+async def populate(count: int, contacts_per_user: int, creator_id: int = 1,
+                   batch_size: int = 500, seed: int = 0) -> None:
+    """
+    Writes the generated users, batch_size users per transaction
+    """
+    batch = []  # type: List[Dict[str, Any]]
+    for user in generate_users(count, contacts_per_user, seed):
+        batch.append(user)
+        if len(batch) == batch_size:
+            await import_users(creator_id, batch)
+            batch = []
+    if batch:
+        await import_users(creator_id, batch)
@@ -1,84 +1,510 @@
-from tornado.web import RequestHandler
+import re
+from csv import writer as csv_writer
+from io import StringIO
+from time import time
+from typing import (
+    Any, Awaitable, Callable, Dict, Iterable, List, Match, Optional,
+    Tuple, Union)
+from weakref import WeakSet
 
+from pydantic import ValidationError
+from tornado.log import app_log
+from tornado.web import RequestHandler, stream_request_body
+from tortoise.exceptions import BaseORMException
+
+from .caches import (
+    CachedResponse,
+    LRUCache,
+    contact_responses,
+    fill,
+    user_responses)
+
+from . import replicas
+from .pool import PoolTimeoutError
+from .serialization import JSON_CONTENT_TYPE, dumps, dumps_page
+from .tracing import UNMATCHED_ROUTE, begin_request, resume
 from .utils import (
     bad_request_on_validation_error,
+    is_json_request,
+    make_etag,
+    next_page_cursor,
+    prepare_json_body,
     prepare_request_arguments,
     not_found_on_exception,
     unathorized_on_authorization_error,
-    ensure_contact_can_be_edited,
-    ensure_user_can_be_edited,
     ensure_user_contacts_can_be_edited)
-from .validation_schemata import User, LimitOffset, Contact, Headers
+from .auth_utils import ensure_can_edit_user
+from .validation_schemata import (
+    BATCH_REFERENCE_RE,
+    Batch,
+    BatchOperation,
+    User,
+    Ids,
+    LimitOffset,
+    UserFilter,
+    UserRepresentation,
+    Contact,
+    ContactList,
+    ContactLookup,
+    Export,
+    ExportFormatEnum,
+    Headers,
+    RequiredIds,
+    UserImport)
+from .models import Contact as ContactModel, User as UserModel, isoformat
 from .database_operations import (
-    get_user_list,
+    AuthorizationError,
+    Rollback,
+    batch_transaction,
+    begin_unit_of_work,
+    end_unit_of_work,
+    get_user_list_values,
+    get_user_list_versions,
+    get_user_values_by_ids,
+    get_user_version,
     add_user,
-    get_user_contacts,
+    get_user_contact_values,
     add_user_contact,
+    add_user_contacts,
     UserNotFound,
     update_user,
     delete_all_user_contacts,
-    get_single_user,
+    import_users,
+    iter_users,
+    get_single_user_values,
     delete_single_user,
     ContactNotFound,
-    get_single_contact,
+    get_single_contact_values,
+    get_contact_values_by_ids,
+    ensure_contact_owned,
+    ensure_user_owned,
+    get_contact_version,
+    lookup_contact_values,
     update_contact,
     delete_single_contact)
 
 
-class UsersHandler(RequestHandler):
+# handlers of the requests being served, which a stopping worker lets
+# finish; weak, so that requests whose connection was lost never linger
+active_requests = WeakSet()  # type: WeakSet[RequestHandler]
+
+
+class BaseHandler(RequestHandler):
+    # signed cookie carrying the time of the client's last write, so that
+    # whichever worker process serves the client's next requests reads from
+    # the primary until the replicas have caught up
+    LAST_WRITE_COOKIE = 'last_write'
+    REQUEST_ID_HEADER = 'X-Request-Id'
+
+    def prepare(self) -> None:
+        active_requests.add(self)
+        self.request_trace = begin_request(
+            self.settings['route_patterns'].get(type(self), UNMATCHED_ROUTE),
+            self.request.headers.get(self.REQUEST_ID_HEADER))
+        self.set_header(self.REQUEST_ID_HEADER, self.request_trace.request_id)
+        begin_unit_of_work()
+        replicas.begin_reads(
+            self._last_write_time() if replicas.enabled() else None)
+
+    def on_finish(self) -> None:
+        end_unit_of_work()
+        active_requests.discard(self)
+
+    def on_connection_close(self) -> None:
+        active_requests.discard(self)
+        super().on_connection_close()
+
+    def finish(self, chunk: Union[str, bytes, dict] = None) -> Any:
+        if not self._headers_written:
+            # avoid cyclical import
+            from .app import settings
+            if replicas.enabled() and \
+                    self.request.method not in ('GET', 'HEAD') and \
+                    self.get_status() < 400:
+                self.set_secure_cookie(
+                    self.LAST_WRITE_COOKIE, str(time()), expires_days=None,
+                    max_age=int(settings.replica_stickiness) + 1)
+            trace = getattr(self, 'request_trace', None)
+            if settings.server_timing and trace is not None:
+                self.set_header('Server-Timing', trace.server_timing())
+        return super().finish(chunk)
+
+    def _last_write_time(self) -> Optional[float]:
+        value = self.get_secure_cookie(self.LAST_WRITE_COOKIE)
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
+
+    def get_current_user(self) -> int:
+        """
+        Returns the id of the creator the request is authenticated as.
+        Tornado caches the result in current_user, so the Authorization header
+        is parsed and the JWT is verified at most once per request.
+        """
+        headers = {}
+        authorization = self.request.headers.get('Authorization')
+        if authorization is not None:
+            headers['Authorization'] = authorization
+
+        return Headers.parse_obj(headers).creator_id
+
+    def write_error(self, status_code: int, **kwargs: Any) -> None:
+        exc_info = kwargs.get('exc_info')
+        if exc_info is not None and isinstance(exc_info[1], PoolTimeoutError):
+            # the database is overloaded, the client may retry later
+            self.set_status(503)
+            self.write_json({'result': str(exc_info[1])})
+            return
+        super().write_error(status_code, **kwargs)
+
+    def not_modified(self, etag: str) -> bool:
+        """
+        Sets the ETag of the response and, if it matches the If-None-Match
+        header of the request, turns the response into a 304
+        """
+        self.set_header('Etag', etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+        return False
+
+    async def write_cached_response(
+            self, cache: Optional[LRUCache], key: int,
+            render: Callable[[], Awaitable[CachedResponse]],
+            lookup_etag: Callable[[], Awaitable[Optional[str]]]) -> None:
+        """
+        Writes the JSON response produced by render, serving it from the
+        cache when possible (pass None as the cache for responses that
+        mustn't be cached). A conditional request missing the cache is
+        answered with a 304 if lookup_etag returns a matching ETag, without
+        rendering the response.
+        """
+        response = cache.get(key) if cache is not None else None
+        if response is None:
+            if self.request.headers.get('If-None-Match'):
+                etag = await lookup_etag()
+                if etag is not None and self.not_modified(etag):
+                    return
+            if cache is None:
+                response = await render()
+            else:
+                # the cached response is served to every client, including
+                # the ones reading their own writes, so it's rendered from
+                # the primary rather than from a replica that may be behind
+                with replicas.primary_reads():
+                    response = await fill(cache, key, render)
+
+        if response.etag is not None and self.not_modified(response.etag):
+            return
+        self.set_status(response.status)
+        self.set_header('Content-Type', JSON_CONTENT_TYPE)
+        self.write(response.body)
+
+    def write_json(self, response: Any) -> None:
+        """
+        Writes the response encoded to JSON. Unlike write, which encodes
+        dicts with the json module, this uses the fastest encoder available.
+        """
+        self.set_header('Content-Type', JSON_CONTENT_TYPE)
+        self.write(dumps(response))
+
+    def write_json_page(self, page: Dict[str, Any],
+                        results: Iterable[Any]) -> None:
+        """
+        Writes a page of a list endpoint, see dumps_page
+        """
+        self.set_header('Content-Type', JSON_CONTENT_TYPE)
+        self.write(dumps_page(page, results))
+
+
+class UsersHandler(BaseHandler):
     @bad_request_on_validation_error
     async def get(self) -> None:
-        args = LimitOffset.parse_obj(
-            prepare_request_arguments(self.request.query_arguments))
+        query = prepare_request_arguments(self.request.query_arguments)
+        ids = Ids.parse_obj(query).ids
+        representation = UserRepresentation.parse_obj(query)
+        if ids is not None:
+            await self._get_by_ids(ids, representation)
+            return
+        args = UserFilter.parse_obj(query)
 
-        users, user_count = await get_user_list(**args.dict())
-        self.write({
-            'total': user_count,
-            'result': [u.as_dict() for u in users]
-        })
+        if self.request.headers.get('If-None-Match'):
+            versions, user_count = await get_user_list_versions(
+                **args.dict())
+            if self.not_modified(make_etag(args.dict(), representation.dict(),
+                                           user_count, versions)):
+                return
+
+        users, contacts, user_count = await get_user_list_values(
+            with_contacts=representation.with_contacts,
+            contacts_limit=representation.contacts_limit,
+            **args.dict())
+        self.set_header('Etag', make_etag(
+            args.dict(), representation.dict(), user_count,
+            [(u['id'], isoformat(u['created_at']), u['version'])
+             for u in users]))
+        page = {'total': user_count}
+        if args.cursor is not None:
+            page['next_cursor'] = next_page_cursor(users, args.limit)
+        self.write_json_page(page, (
+            UserModel.row_as_dict(u, contacts, representation.field_names)
+            for u in users))
+
+    async def _get_by_ids(self, ids: Tuple[int, ...],
+                          representation: UserRepresentation) -> None:
+        """
+        Writes the users with the ids in the order they were requested,
+        along with the ids of the missing ones. Paging and filters don't
+        apply.
+        """
+        users, contacts = await get_user_values_by_ids(
+            ids, representation.with_contacts, representation.contacts_limit)
+        self.write_json_page(
+            {'missing': [i for i in ids if i not in users]},
+            (UserModel.row_as_dict(users[i], contacts,
+                                   representation.field_names)
+             for i in ids if i in users))
 
     @bad_request_on_validation_error
     async def post(self) -> None:
-        headers = Headers.parse_obj(dict(self.request.headers.items()))
+        creator_id = self.current_user
         args = User.parse_obj(
             prepare_request_arguments(self.request.body_arguments))
 
-        new_id = await add_user(creator_id=headers.creator_id,
-                                **args.dict())
+        new_id = await add_user(creator_id=creator_id, **args.dict())
 
         self.set_status(201)
-        self.write({
+        self.write_json({
             'result': {'user_id': new_id}
         })
 
 
-class ContactsHandler(RequestHandler):
+@stream_request_body
+class UserImportHandler(BaseHandler):
+    """
+    Imports users along with their contacts from a newline-delimited JSON
+    body. Lines are validated as they arrive and the valid users are written
+    in batches, so the memory used doesn't depend on the size of the body.
+    A batch that can't be written stops the import, and the response tells
+    which lines it held.
+    """
+
+    async def prepare(self) -> None:
+        super().prepare()
+
+        try:
+            self._creator_id = self.current_user
+        except ValidationError as e:
+            self.set_status(400)
+            self.write_json({'result': e.errors()})
+            self.finish()
+            return
+
+        # avoid cyclical import
+        from .app import settings
+        self._settings = settings
+        self.request.connection.set_max_body_size(
+            settings.import_max_body_size)
+
+        self._buffer = bytearray()
+        self._skipping_line = False
+        self._line_no = 0
+        self._batch = []
+        self._batch_contacts = 0
+        # numbers of the first and the last line of the batch
+        self._batch_lines = None  # type: Optional[Tuple[int, int]]
+        self._imported = 0
+        self._failed = 0
+        self._errors = []
+        # set when a batch couldn't be written, which stops the import
+        self._write_error = None  # type: Optional[Exception]
+
+    async def data_received(self, chunk: bytes) -> None:
+        if self._finished:
+            # the request was rejected in prepare()
+            return
+        if self._write_error is not None:
+            # the rest of the body is no longer imported
+            return
+        # tornado doesn't call data_received in the context of prepare()
+        resume(self.request_trace)
+
+        self._buffer += chunk
+        *lines, self._buffer = self._buffer.split(b'\n')
+
+        for line in lines:
+            if self._skipping_line:
+                # the rest of an overlong line which was already reported
+                self._skipping_line = False
+                continue
+            await self._import_line(line)
+            if self._write_error is not None:
+                return
+
+        if len(self._buffer) > self._settings.import_max_line_size:
+            if not self._skipping_line:
+                self._line_no += 1
+                self._report_error([{
+                    'loc': ['__obj__'],
+                    'msg': 'Line is too long',
+                    'type': 'value_error'
+                }])
+                self._skipping_line = True
+            self._buffer = bytearray()
+
+    async def post(self) -> None:
+        if self._write_error is None and not self._skipping_line:
+            await self._import_line(self._buffer)
+        await self._flush_batch()
+
+        result = {
+            'imported': self._imported,
+            'failed': self._failed,
+            'errors': self._errors
+        }
+        if self._write_error is not None:
+            # the batches written before the failing one stay imported
+            self.set_status(503 if isinstance(self._write_error,
+                                              PoolTimeoutError) else 500)
+            result['aborted'] = {
+                'lines': list(self._batch_lines),
+                'msg': 'The users of these lines could not be written, '
+                       'the lines after them were not imported'
+            }
+        self.write_json({'result': result})
+
+    async def _import_line(self, line: bytes) -> None:
+        self._line_no += 1
+        if not line.strip():
+            return
+
+        try:
+            user = UserImport.parse_obj(prepare_json_body(line))
+        except ValidationError as e:
+            self._report_error(e.errors())
+            return
+
+        if not self._batch:
+            self._batch_lines = (self._line_no, self._line_no)
+        self._batch.append(user.dict())
+        self._batch_contacts += len(user.contacts)
+        self._batch_lines = (self._batch_lines[0], self._line_no)
+        # the contacts are bounded too, since they make most of the INSERTs
+        if len(self._batch) >= self._settings.import_batch_size or \
+                self._batch_contacts >= \
+                self._settings.import_batch_max_contacts:
+            await self._flush_batch()
+
+    async def _flush_batch(self) -> None:
+        if not self._batch or self._write_error is not None:
+            return
+
+        try:
+            await import_users(self._creator_id, self._batch)
+        except (BaseORMException, PoolTimeoutError) as e:
+            app_log.exception('Import failed at lines %d-%d',
+                              *self._batch_lines)
+            self._write_error = e
+            self._failed += len(self._batch)
+        else:
+            self._imported += len(self._batch)
+        self._batch = []
+        self._batch_contacts = 0
+
+    def _report_error(self, errors: list) -> None:
+        self._failed += 1
+        if len(self._errors) < self._settings.import_max_reported_errors:
+            self._errors.append({'line': self._line_no, 'errors': errors})
+
+
+class UserExportHandler(BaseHandler):
+    """
+    Streams all the users with their contacts as newline-delimited JSON or
+    as CSV with a row per contact, flushing the response after every batch
+    """
+
+    CSV_COLUMNS = ('user_id', 'name', 'created_at', 'contact_id', 'phone_no',
+                   'email', 'type', 'contact_created_at')
+
+    @bad_request_on_validation_error
+    async def get(self) -> None:
+        args = Export.parse_obj(
+            prepare_request_arguments(self.request.query_arguments))
+
+        # avoid cyclical import
+        from .app import settings
+
+        if args.format == ExportFormatEnum.csv:
+            self.set_header('Content-Type', 'text/csv; charset=UTF-8')
+            self.write(self._csv_lines([self.CSV_COLUMNS]))
+            encode_batch = self._encode_csv
+        else:
+            self.set_header('Content-Type',
+                            'application/x-ndjson; charset=UTF-8')
+            encode_batch = self._encode_ndjson
+
+        async for users in iter_users(settings.export_batch_size):
+            self.write(encode_batch(users))
+            await self.flush()
+
+    @staticmethod
+    def _encode_ndjson(users: List[UserModel]) -> bytes:
+        return b''.join(dumps(u.as_dict()) + b'\n' for u in users)
+
+    @classmethod
+    def _encode_csv(cls, users: List[UserModel]) -> str:
+        rows = []
+        for u in users:
+            user_cols = [u.id, u.name, u.created_at.isoformat()]
+            if not len(u.contacts):
+                # users without contacts still get a row
+                rows.append(user_cols + [''] * 5)
+            for c in u.contacts:
+                rows.append(user_cols + [
+                    c.id, c.phone_no, c.email, c.TYPES_TO_NAMES[c.type].value,
+                    c.created_at.isoformat()])
+        return cls._csv_lines(rows)
+
+    @staticmethod
+    def _csv_lines(rows: list) -> str:
+        buf = StringIO()
+        csv_writer(buf).writerows(rows)
+        return buf.getvalue()
+
+
+class ContactsHandler(BaseHandler):
     @bad_request_on_validation_error
     @not_found_on_exception(UserNotFound)
     async def get(self, user_id: str) -> None:
         args = LimitOffset.parse_obj(
             prepare_request_arguments(self.request.query_arguments))
 
-        contacts, contact_count = await get_user_contacts(int(user_id),
-                                                          **args.dict())
+        contacts, contact_count = await get_user_contact_values(
+            int(user_id), **args.dict())
 
-        self.write({
-            'total': contact_count,
-            'result': [c.as_dict() for c in contacts]
-        })
+        page = {'total': contact_count}
+        if args.cursor is not None:
+            page['next_cursor'] = next_page_cursor(contacts, args.limit)
+        self.write_json_page(page, (ContactModel.row_as_dict(c)
+                                    for c in contacts))
 
     @unathorized_on_authorization_error
     @bad_request_on_validation_error
     @not_found_on_exception(UserNotFound)
     @ensure_user_contacts_can_be_edited
     async def post(self, user_id: str) -> None:
+        if is_json_request(self.request):
+            await self._post_many(user_id)
+            return
+
         args = Contact.parse_obj(
             prepare_request_arguments(self.request.body_arguments))
 
         new_id = await add_user_contact(int(user_id), **args.dict())
 
         self.set_status(201)
-        self.write({
+        self.write_json({
             'result': {'contact_id': new_id}
         })
 
@@ -90,56 +516,326 @@ class ContactsHandler(RequestHandler):
         await delete_all_user_contacts(int(user_id))
         self.set_status(204)
 
+    async def _post_many(self, user_id: str) -> None:
+        """
+        Creates every contact of a JSON array at once, or none of them if
+        any fails validation
+        """
+        args = ContactList.parse_obj({
+            'contacts': prepare_json_body(self.request.body)
+        })
 
-class SingleUserHandler(RequestHandler):
-    @not_found_on_exception(UserNotFound)
-    async def get(self, user_id: str) -> None:
-        user = await get_single_user(int(user_id))
-        self.write({
-            'result': user.as_dict()
+        new_ids = await add_user_contacts(int(user_id),
+                                          args.dict()['contacts'])
+
+        self.set_status(201)
+        self.write_json({
+            'result': {'contact_ids': new_ids}
         })
 
+
+class SingleUserHandler(BaseHandler):
+    @bad_request_on_validation_error
+    async def get(self, user_id: str) -> None:
+        user_id = int(user_id)
+        representation = UserRepresentation.parse_obj(
+            prepare_request_arguments(self.request.query_arguments))
+
+        async def render() -> CachedResponse:
+            try:
+                user, contacts = await get_single_user_values(
+                    user_id, representation.with_contacts,
+                    representation.contacts_limit)
+            except UserNotFound as e:
+                return CachedResponse(404, dumps({'result': str(e)}))
+            res = UserModel.row_as_dict(user, contacts,
+                                        representation.field_names)
+            return CachedResponse(
+                200, dumps({'result': res}),
+                etag=make_etag(user_id, isoformat(user['created_at']),
+                               user['version'], representation.dict()))
+
+        async def lookup_etag() -> Optional[str]:
+            version = await get_user_version(user_id)
+            if version is None:
+                return None
+            return make_etag(user_id, *version, representation.dict())
+
+        # only the default representation is cached, so that a single
+        # entry per user is invalidated by the writes
+        cache = user_responses if representation.is_default else None
+        await self.write_cached_response(cache, user_id, render, lookup_etag)
+
     @unathorized_on_authorization_error
     @bad_request_on_validation_error
     @not_found_on_exception(UserNotFound)
-    @ensure_user_can_be_edited
     async def put(self, user_id: str) -> None:
-        args = User.parse_obj(
-            prepare_request_arguments(self.request.body_arguments))
-        await update_user(int(user_id), **args.dict())
+        creator_id = self.current_user
+        try:
+            args = User.parse_obj(
+                prepare_request_arguments(self.request.body_arguments))
+        except ValidationError:
+            # a missing or unowned user is reported before an invalid body
+            await ensure_user_owned(int(user_id), creator_id)
+            raise
+        await update_user(int(user_id), creator_id, **args.dict())
         self.set_status(204)
 
     @unathorized_on_authorization_error
     @bad_request_on_validation_error
     @not_found_on_exception(UserNotFound)
-    @ensure_user_can_be_edited
     async def delete(self, user_id: str) -> None:
-        await delete_single_user(int(user_id))
+        await delete_single_user(int(user_id), self.current_user)
         self.set_status(204)
 
 
-class SingleContactHandler(RequestHandler):
-    @not_found_on_exception(ContactNotFound)
+class ContactLookupHandler(BaseHandler):
+    """
+    Finds the contacts with a phone number or an email, along with the ids
+    of the users they belong to
+    """
+
+    @bad_request_on_validation_error
+    async def get(self) -> None:
+        query = prepare_request_arguments(self.request.query_arguments)
+        lookup = ContactLookup.parse_obj(query)
+        args = LimitOffset.parse_obj(query)
+
+        contacts, contact_count = await lookup_contact_values(
+            **lookup.dict(), **args.dict())
+
+        page = {'total': contact_count}
+        if args.cursor is not None:
+            page['next_cursor'] = next_page_cursor(contacts, args.limit)
+        self.write_json_page(page, (
+            dict(ContactModel.row_as_dict(c), user_id=c['user_id'])
+            for c in contacts))
+
+
+class ContactsByIdsHandler(BaseHandler):
+    """
+    Fetches the contacts with the ids in the order they were requested,
+    along with the ids of the users they belong to and the ids of the
+    missing contacts
+    """
+
+    @bad_request_on_validation_error
+    async def get(self) -> None:
+        ids = RequiredIds.parse_obj(
+            prepare_request_arguments(self.request.query_arguments)).ids
+
+        contacts = await get_contact_values_by_ids(ids)
+        self.write_json_page(
+            {'missing': [i for i in ids if i not in contacts]},
+            (dict(ContactModel.row_as_dict(contacts[i]),
+                  user_id=contacts[i]['user_id'])
+             for i in ids if i in contacts))
+
+
+class SingleContactHandler(BaseHandler):
     async def get(self, contact_id: str) -> None:
-        contact = await get_single_contact(int(contact_id))
-        self.write({
-            'result': contact.as_dict()
-        })
+        contact_id = int(contact_id)
+
+        async def render() -> CachedResponse:
+            try:
+                contact = await get_single_contact_values(contact_id)
+            except ContactNotFound as e:
+                return CachedResponse(404, dumps({'result': str(e)}))
+            return CachedResponse(
+                200, dumps({'result': ContactModel.row_as_dict(contact)}),
+                etag=make_etag(contact_id, isoformat(contact['created_at']),
+                               contact['version']),
+                owner_id=contact['user_id'])
+
+        async def lookup_etag() -> Optional[str]:
+            version = await get_contact_version(contact_id)
+            return make_etag(contact_id, *version) if version else None
+
+        await self.write_cached_response(contact_responses, contact_id,
+                                         render, lookup_etag)
 
     @unathorized_on_authorization_error
     @bad_request_on_validation_error
     @not_found_on_exception(ContactNotFound)
-    @ensure_contact_can_be_edited
     async def put(self, contact_id: str) -> None:
-        args = Contact.parse_obj(
-            prepare_request_arguments(self.request.body_arguments))
-        await update_contact(int(contact_id), **args.dict())
+        creator_id = self.current_user
+        try:
+            args = Contact.parse_obj(
+                prepare_request_arguments(self.request.body_arguments))
+        except ValidationError:
+            # a missing or unowned contact is reported before an invalid
+            # body
+            await ensure_contact_owned(int(contact_id), creator_id)
+            raise
+        await update_contact(int(contact_id), creator_id, **args.dict())
         self.set_status(204)
 
     @unathorized_on_authorization_error
     @bad_request_on_validation_error
     @not_found_on_exception(ContactNotFound)
-    @ensure_contact_can_be_edited
     async def delete(self, contact_id: str) -> None:
-        await delete_single_contact(int(contact_id))
+        await delete_single_contact(int(contact_id), self.current_user)
         self.set_status(204)
+
+
+async def _create_user(creator_id: int, body: Any) -> Tuple[int, Any]:
+    args = User.parse_obj(body or {})
+    new_id = await add_user(creator_id=creator_id, **args.dict())
+    return 201, {'user_id': new_id}
+
+
+async def _update_user(creator_id: int, body: Any,
+                       user_id: str) -> Tuple[int, Any]:
+    args = User.parse_obj(body or {})
+    await update_user(int(user_id), creator_id, **args.dict())
+    return 204, None
+
+
+async def _delete_user(creator_id: int, body: Any,
+                       user_id: str) -> Tuple[int, Any]:
+    await delete_single_user(int(user_id), creator_id)
+    return 204, None
+
+
+async def _create_contacts(creator_id: int, body: Any,
+                           user_id: str) -> Tuple[int, Any]:
+    await ensure_can_edit_user(int(user_id), creator_id)
+    if isinstance(body, list):
+        args = ContactList.parse_obj({'contacts': body})
+        new_ids = await add_user_contacts(int(user_id),
+                                          args.dict()['contacts'])
+        return 201, {'contact_ids': new_ids}
+
+    args = Contact.parse_obj(body or {})
+    new_id = await add_user_contact(int(user_id), **args.dict())
+    return 201, {'contact_id': new_id}
+
+
+async def _delete_user_contacts(creator_id: int, body: Any,
+                                user_id: str) -> Tuple[int, Any]:
+    await ensure_can_edit_user(int(user_id), creator_id)
+    await delete_all_user_contacts(int(user_id))
+    return 204, None
+
+
+async def _update_contact(creator_id: int, body: Any,
+                          contact_id: str) -> Tuple[int, Any]:
+    args = Contact.parse_obj(body or {})
+    await update_contact(int(contact_id), creator_id, **args.dict())
+    return 204, None
+
+
+async def _delete_contact(creator_id: int, body: Any,
+                          contact_id: str) -> Tuple[int, Any]:
+    await delete_single_contact(int(contact_id), creator_id)
+    return 204, None
+
+
+# the operations a batch can consist of, which are those of the write
+# endpoints: the method and the route of the endpoint, and the function
+# doing what its handler does, returning the status and the result of the
+# response
+BATCH_OPERATIONS = {
+    ('POST', r'/api/users'): _create_user,
+    ('PUT', r'/api/users/(\d+)'): _update_user,
+    ('DELETE', r'/api/users/(\d+)'): _delete_user,
+    ('POST', r'/api/users/(\d+)/contacts'): _create_contacts,
+    ('DELETE', r'/api/users/(\d+)/contacts'): _delete_user_contacts,
+    ('PUT', r'/api/contacts/(\d+)'): _update_contact,
+    ('DELETE', r'/api/contacts/(\d+)'): _delete_contact,
+}
+
+
+class _UnresolvedReference(Exception):
+    def __init__(self, index: int, key: str) -> None:
+        super().__init__(index, key)
+        self.index = index
+        self.key = key
+
+
+class BatchHandler(BaseHandler):
+    """
+    Executes a list of write operations, each given as the method, path and
+    body of the request to the endpoint it stands for, authenticating once.
+    Atomic batches are executed in one transaction, which the first
+    failing operation rolls back, the others being reported as failed
+    dependencies; otherwise every operation is executed on its own. A path
+    refers to the user or the contact created by an earlier operation as
+    users/$<its index> or contacts/$<its index>.
+    """
+
+    @bad_request_on_validation_error
+    async def post(self) -> None:
+        creator_id = self.current_user
+        batch = Batch.parse_obj(prepare_json_body(self.request.body))
+
+        responses = []  # type: List[Dict[str, Any]]
+        if not batch.atomic:
+            for operation in batch.operations:
+                responses.append(await self._run_operation(
+                    creator_id, operation, responses))
+        else:
+            async with batch_transaction():
+                for operation in batch.operations:
+                    responses.append(await self._run_operation(
+                        creator_id, operation, responses))
+                    if responses[-1]['status'] >= 400:
+                        raise Rollback()
+
+            failed = len(responses) - 1
+            if responses[failed]['status'] >= 400:
+                responses = [
+                    r if i == failed else
+                    {'status': 424,
+                     'result': f'Rolled back, operation {failed} failed'}
+                    for i, r in enumerate(responses)]
+                responses.extend(
+                    {'status': 424,
+                     'result': f'Not executed, operation {failed} failed'}
+                    for _ in batch.operations[failed + 1:])
+
+        self.write_json({'result': responses})
+
+    async def _run_operation(
+            self, creator_id: int, operation: BatchOperation,
+            responses: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Executes the operation, returning its status and its result as the
+        endpoint it stands for would respond
+        """
+        def resolve(match: Match) -> str:
+            # a user id only stands for a user, a contact id for a contact
+            collection, index = match[1], int(match[2])
+            key = 'user_id' if collection == 'users' else 'contact_id'
+            result = responses[index].get('result')
+            if not isinstance(result, dict) or key not in result:
+                raise _UnresolvedReference(index, key)
+            return f'{collection}/{result[key]}'
+
+        try:
+            path = BATCH_REFERENCE_RE.sub(resolve, operation.path)
+        except _UnresolvedReference as e:
+            return {'status': 424,
+                    'result': f'Operation {e.index} created no {e.key}'}
+
+        for (method, route), execute in BATCH_OPERATIONS.items():
+            match = re.fullmatch(route, path)
+            if method == operation.method and match:
+                break
+        else:
+            return {'status': 404,
+                    'result': f'No operation {operation.method.value} {path}'}
+
+        try:
+            status, result = await execute(creator_id, operation.body,
+                                           *match.groups())
+        except ValidationError as e:
+            status, result = 400, e.errors()
+        except (UserNotFound, ContactNotFound) as e:
+            status, result = 404, str(e)
+        except AuthorizationError as e:
+            status, result = 401, str(e)
+
+        if result is None:
+            return {'status': status}
+        return {'status': status, 'result': result}
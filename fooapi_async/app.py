@@ -1,67 +1,258 @@
-from typing import List, Tuple
+import asyncio
+import os
+import signal
+from functools import partial
+from socket import socket
+from time import sleep, time
+from types import FrameType
+from typing import List, Optional, Tuple
 
 from tortoise import Tortoise
-from tornado.web import Application, RequestHandler
+from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
+from tornado.log import app_log
+from tornado.netutil import bind_sockets
+from tornado.web import Application, RequestHandler
 
-from .validation_schemata import Settings
+from . import replicas, tracing
+from .api import active_requests
+from .caches import contact_responses, phone_number_cache, user_responses
+from .database_operations import backfill_normalized_contacts
+from .metrics import log_request, make_metrics_app
+from .models import get_composite_index_sql
+from .pool import pooled_db_config
+from .validation_schemata import Settings, email_cache, jwt_cache
 from .routes import routes
 
 
 settings = None
 
+# seconds a worker must stay up to be restarted right away when it dies
+_MIN_WORKER_UPTIME = 1
+
+# how often a stopping worker checks whether its requests have finished
+_DRAIN_POLL_INTERVAL = 0.05
+
 
 def init_settings(settings_file_path: str) -> Settings:
     global settings
     settings = Settings.parse_file(settings_file_path)
+    jwt_cache.configure(maxsize=settings.jwt_cache_size,
+                        ttl=settings.jwt_cache_ttl)
+    for cache in (phone_number_cache, email_cache):
+        cache.configure(maxsize=settings.validation_cache_size, ttl=None)
+    tracing.configure(settings.slow_statement_threshold)
+    for cache in (user_responses, contact_responses):
+        cache.configure(maxsize=settings.response_cache_size,
+                        ttl=settings.response_cache_ttl)
 
 
-async def init_db(settings: Settings) -> None:
-    await Tortoise.init(
-        db_url=settings.db_uri,
-        modules={'models': ['fooapi_async.models']}
-    )
+async def init_db(settings: Settings, with_replicas: bool = True) -> None:
+    """
+    Connects to the primary database and, unless told otherwise, to the
+    read-only replicas
+    """
+    pool_options = {
+        'min_size': settings.db_pool_min_size,
+        'max_size': settings.db_pool_max_size,
+        'acquire_timeout': settings.db_pool_acquire_timeout,
+        'statement_timeout': settings.db_statement_timeout
+    }
+    connections = {
+        'default': pooled_db_config(settings.db_uri, **pool_options)
+    }
+    replica_names = []
+    if with_replicas:
+        for i, uri in enumerate(settings.replica_db_uris):
+            replica_names.append(f'replica_{i}')
+            connections[replica_names[-1]] = pooled_db_config(
+                uri, **pool_options)
+
+    await Tortoise.init(config={
+        'connections': connections,
+        'apps': {
+            'models': {
+                'models': ['fooapi_async.models'],
+                'default_connection': 'default'
+            }
+        }
+    })
+    replicas.configure(replica_names, settings.replica_stickiness)
 
 
 async def close_db_connections() -> None:
+    replicas.configure([])
     await Tortoise.close_connections()
 
 
+async def generate_schemas(safe: bool = True) -> None:
+    """
+    Creates the tables of the models along with their composite indexes
+    """
+    await Tortoise.generate_schemas(safe=safe)
+    await Tortoise.get_connection('default').execute_script(
+        get_composite_index_sql())
+
+
 async def create_schema() -> None:
     try:
         global settings
-        await init_db(settings)
-        await Tortoise.generate_schemas(safe=False)
+        await init_db(settings, with_replicas=False)
+        await generate_schemas(safe=False)
     finally:
         await close_db_connections()
 
 
 async def drop_schema() -> None:
     global settings
-    await init_db(settings)
+    await init_db(settings, with_replicas=False)
     await Tortoise._drop_databases()
 
 
+async def backfill_contacts(batch_size: int) -> int:
+    try:
+        global settings
+        await init_db(settings, with_replicas=False)
+        return await backfill_normalized_contacts(batch_size)
+    finally:
+        await close_db_connections()
+
+
 def make_app(routes: List[Tuple[str, RequestHandler]]) -> Application:
-    return Application(routes)
+    return Application(routes, cookie_secret=settings.replica_cookie_secret,
+                       log_function=log_request,
+                       # the requests are traced under their route pattern
+                       route_patterns={handler: pattern
+                                       for pattern, handler in routes})
 
 
-def run(settings_file_path: str) -> None:
+def run(settings_file_path: str, workers: int = 1) -> None:
+    """
+    Serves the API. With more than one worker, the listening socket is
+    bound before forking the worker processes, which share it, and the
+    current process supervises them until it's told to stop.
+    """
     global settings
 
     init_settings(settings_file_path)
 
+    # SO_REUSEPORT lets a restarted server bind the port while the old one
+    # is still draining its connections (the workers of a server share the
+    # socket bound here, so they don't need it)
+    sockets = bind_sockets(settings.api_port, reuse_port=True)
+
+    if workers > 1:
+        _supervise(workers, sockets)
+    else:
+        _serve(sockets)
+
+
+def _serve(sockets: List[socket], index: int = 0) -> None:
+    """
+    Runs a worker: connects to the database (so that forked workers never
+    share a connection) and serves the requests until SIGTERM or SIGINT.
+    Every worker has its own metrics, served on the metrics port offset by
+    the index of the worker.
+    """
     loop = IOLoop.current()
+    server = HTTPServer(make_app(routes))
+    metrics_server = None
+    if settings.metrics_port is not None:
+        metrics_server = HTTPServer(make_metrics_app())
+        metrics_server.listen(settings.metrics_port + index)
 
-    async def run_db_init():
-        await init_db(settings)
+    def stop(signum: int, frame: Optional[FrameType]) -> None:
+        loop.add_callback_from_signal(shutdown)
 
-    try:
-        loop.run_sync(run_db_init)
+    async def shutdown() -> None:
+        await _drain(server, settings.shutdown_timeout)
+        if metrics_server is not None:
+            metrics_server.stop()
+            await metrics_server.close_all_connections()
+        loop.stop()
 
-        application = make_app(routes)
-        application.listen(settings.api_port)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
 
+    try:
+        loop.run_sync(partial(init_db, settings))
+        server.add_sockets(sockets)
         loop.start()
     finally:
         loop.run_sync(close_db_connections)
+
+
+async def _drain(server: HTTPServer, timeout: float) -> None:
+    """
+    Stops accepting connections and waits up to timeout seconds for the
+    requests in flight to finish, before closing the remaining (idle)
+    connections
+    """
+    server.stop()
+    deadline = time() + timeout
+    while active_requests and time() < deadline:
+        await asyncio.sleep(_DRAIN_POLL_INTERVAL)
+    if active_requests:
+        app_log.warning('Dropping %d unfinished requests',
+                        len(active_requests))
+    await server.close_all_connections()
+
+
+def _supervise(worker_count: int, sockets: List[socket]) -> None:
+    """
+    Forks the workers and restarts the ones that die, until SIGTERM or
+    SIGINT, which is forwarded to the workers before waiting for them to
+    exit
+    """
+    workers = {}  # pid -> (worker index, start time)
+    stopping = False
+
+    def spawn(index: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            # the supervisor's handlers would make the worker signal its
+            # siblings until _serve installs its own
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            exit_code = 0
+            try:
+                _serve(sockets, index)
+            except BaseException:
+                app_log.exception('Worker %d failed', index)
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        workers[pid] = (index, time())
+
+    def stop(signum: int, frame: Optional[FrameType]) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for index in range(worker_count):
+        spawn(index)
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+
+        if pid not in workers:
+            continue
+        index, started_at = workers.pop(pid)
+        if stopping:
+            continue
+
+        app_log.warning('Worker %d (pid %d) exited with status %d, '
+                        'restarting it', index, pid, status)
+        # don't spin when a worker can't even start, e.g. if the database
+        # is unreachable
+        if time() - started_at < _MIN_WORKER_UPTIME:
+            sleep(_MIN_WORKER_UPTIME)
+        if not stopping:
+            spawn(index)
@@ -0,0 +1,69 @@
+from typing import List
+
+import asyncpg
+from tortoise.backends.asyncpg.client import (
+    AsyncpgDBClient,
+    TransactionWrapper as AsyncpgTransactionWrapper,
+    translate_exceptions)
+from tortoise.exceptions import DBConnectionError
+
+from ..pool import PooledClientMixin, PooledTransactionMixin
+
+
+class PooledAsyncpgClient(PooledClientMixin, AsyncpgDBClient):
+    """
+    PostgreSQL client with a pool of connections, so that the statements
+    of concurrent requests run in parallel instead of queueing for the
+    single connection of the tortoise client
+    """
+
+    def __init__(self, user: str, password: str, database: str, host: str,
+                 port: int, min_size: int = 1, max_size: int = 10,
+                 acquire_timeout: float = 5, statement_timeout: float = 30,
+                 **kwargs) -> None:
+        super().__init__(user, password, database, host, port, **kwargs)
+        self._init_pool_options(min_size, max_size, acquire_timeout,
+                                statement_timeout)
+        self._transaction_class = type(
+            'TransactionWrapper', (TransactionWrapper, self.__class__), {})
+
+    @translate_exceptions
+    async def _fetch_rows(self, query: str) -> List[asyncpg.Record]:
+        async with self.acquire_connection() as connection:
+            self.log.debug(query)
+            return await connection.fetch(query)
+
+    async def _connect(self, with_db: bool) -> asyncpg.Connection:
+        dsn = self.DSN_TEMPLATE.format(
+            user=self.user,
+            password=self.password,
+            host=self.host,
+            port=self.port,
+            database=self.database if with_db else '')
+        try:
+            connection = await asyncpg.connect(dsn, server_settings={
+                # enforced by the server, in milliseconds
+                'statement_timeout': str(int(self.statement_timeout * 1000))
+            })
+        except asyncpg.InvalidCatalogNameError:
+            raise DBConnectionError(
+                f"Can't establish connection to database {self.database}")
+        self.log.debug(
+            'Created connection %s with params: user=%s database=%s '
+            'host=%s port=%s', connection, self.user, self.database,
+            self.host, self.port)
+        return connection
+
+    async def _disconnect(self, connection: asyncpg.Connection) -> None:
+        await connection.close()
+        self.log.debug(
+            'Closed connection %s with params: user=%s database=%s host=%s '
+            'port=%s', connection, self.user, self.database, self.host,
+            self.port)
+
+
+class TransactionWrapper(PooledTransactionMixin, AsyncpgTransactionWrapper):
+    pass
+
+
+client_class = PooledAsyncpgClient
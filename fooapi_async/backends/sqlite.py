@@ -0,0 +1,69 @@
+import sqlite3
+from typing import List
+
+import aiosqlite
+from tortoise.backends.sqlite.client import (
+    SqliteClient,
+    TransactionWrapper as SqliteTransactionWrapper,
+    translate_exceptions)
+from tortoise.exceptions import ConfigurationError
+
+from ..pool import PooledClientMixin, PooledTransactionMixin
+
+# the writes return the affected rows with RETURNING, see
+# database_operations._execute_returning
+MIN_SQLITE_VERSION = (3, 35, 0)
+
+
+class PooledSqliteClient(PooledClientMixin, SqliteClient):
+    """
+    SQLite client with a pool of connections, a local stand-in for the
+    server databases. SQLite still serializes the writes, and has no
+    statement timeout, so the statement timeout bounds how long a
+    statement waits for the database lock instead.
+    """
+
+    def __init__(self, file_path: str, min_size: int = 1,
+                 max_size: int = 1, acquire_timeout: float = 5,
+                 statement_timeout: float = 30, **kwargs) -> None:
+        if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+            raise ConfigurationError(
+                'SQLite {} is too old, {} or newer is required'.format(
+                    sqlite3.sqlite_version,
+                    '.'.join(map(str, MIN_SQLITE_VERSION))))
+        super().__init__(file_path, **kwargs)
+        if file_path == ':memory:':
+            # every connection would open a separate in-memory database
+            min_size = max_size = 1
+        self._init_pool_options(min_size, max_size, acquire_timeout,
+                                statement_timeout)
+        self._transaction_class = type(
+            'TransactionWrapper', (TransactionWrapper, self.__class__), {})
+
+    @translate_exceptions
+    async def _fetch_rows(self, query: str) -> List[sqlite3.Row]:
+        async with self.acquire_connection() as connection:
+            self.log.debug(query)
+            return await connection.execute_fetchall(query)
+
+    async def _connect(self, with_db: bool) -> aiosqlite.Connection:
+        connection = aiosqlite.connect(self.filename, isolation_level=None,
+                                       timeout=self.statement_timeout)
+        connection.start()
+        await connection._connect()
+        connection._conn.row_factory = sqlite3.Row
+        self.log.debug('Created connection %s with params: filename=%s',
+                       connection, self.filename)
+        return connection
+
+    async def _disconnect(self, connection: aiosqlite.Connection) -> None:
+        await connection.close()
+        self.log.debug('Closed connection %s with params: filename=%s',
+                       connection, self.filename)
+
+
+class TransactionWrapper(PooledTransactionMixin, SqliteTransactionWrapper):
+    pass
+
+
+client_class = PooledSqliteClient
@@ -0,0 +1,130 @@
+from collections import OrderedDict
+from time import time
+from typing import (
+    Any, Awaitable, Callable, Hashable, NamedTuple, Optional)
+
+
+class LRUCache:
+    """
+    Bounded least-recently-used cache with an optional per-entry time to
+    live. Counts hits and misses so its efficiency can be monitored.
+    """
+
+    def __init__(self, maxsize: int = 1024,
+                 ttl: Optional[float] = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+
+    def configure(self, maxsize: int, ttl: Optional[float]) -> None:
+        """
+        Applies new limits and drops the cached entries
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clear()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            value, expires_at = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if expires_at is not None and expires_at <= time():
+            del self._entries[key]
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Returns the value like get, but without counting a hit or a miss
+        """
+        try:
+            value, expires_at = self._entries[key]
+        except KeyError:
+            return default
+        if expires_at is not None and expires_at <= time():
+            return default
+        return value
+
+    def set(self, key: Hashable, value: Any,
+            expires_at: Optional[float] = None) -> None:
+        """
+        Stores the value until the cache's TTL or the given absolute UNIX
+        timestamp elapses, whichever comes first
+        """
+        if self.maxsize <= 0:
+            return
+
+        if self.ttl is not None:
+            ttl_expiry = time() + self.ttl
+            if expires_at is None or ttl_expiry < expires_at:
+                expires_at = ttl_expiry
+
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self.invalidations += 1
+        self._entries.pop(key, None)
+
+    def invalidate_matching(self, predicate: Callable[[Any], bool]) -> None:
+        """
+        Drops every entry whose value satisfies the predicate
+        """
+        self.invalidations += 1
+        for key in [k for k, (v, _) in self._entries.items() if predicate(v)]:
+            del self._entries[key]
+
+    def clear(self) -> None:
+        self.invalidations += 1
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class CachedResponse(NamedTuple):
+    status: int
+    body: bytes
+    # ETag of the response body, if the response can be revalidated
+    etag: Optional[str] = None
+    # the user a cached contact belongs to, so the contact can be dropped
+    # together with the user
+    owner_id: Optional[int] = None
+
+
+async def fill(cache: LRUCache, key: Hashable,
+               load: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Loads the value and caches it, unless it was invalidated meanwhile
+    """
+    invalidations = cache.invalidations
+    value = await load()
+    # a write may have invalidated the entry while it was being loaded,
+    # in which case the loaded value may already be stale
+    if cache.invalidations == invalidations:
+        cache.set(key, value)
+    return value
+
+
+# encoded responses of the single user and single contact GET endpoints,
+# invalidated by the write operations and configured by init_settings
+user_responses = LRUCache()
+contact_responses = LRUCache()
+# valid phone numbers -> their E.164 form, filled by the validation of the
+# requests and read when the contacts are written; configured by
+# init_settings
+phone_number_cache = LRUCache()
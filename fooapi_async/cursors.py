@@ -0,0 +1,28 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from datetime import datetime
+from json import dumps, loads
+from typing import Tuple
+
+
+def encode_cursor(created_at: str, row_id: int) -> str:
+    """
+    Encodes the keyset position of a row (its creation time in ISO format
+    and its id) into an opaque string token
+    """
+    raw = dumps([created_at, row_id], separators=(',', ':'))
+    return urlsafe_b64encode(raw.encode('utf8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """
+    Reverses encode_cursor, raises ValueError if the token is malformed
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, row_id = loads(urlsafe_b64decode(padded.encode('ascii')))
+        if not isinstance(row_id, int):
+            raise TypeError
+        return datetime.fromisoformat(created_at), row_id
+    except (BinasciiError, UnicodeError, TypeError, ValueError):
+        raise ValueError('Invalid cursor') from None
@@ -1,9 +1,41 @@
-from typing import Optional, Tuple, List, Any, Dict
-
-from tortoise.queryset import QuerySet
+import sys
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import (
+    Optional, Tuple, List, Any, Callable, Dict, Type, AsyncIterator, Mapping,
+    Sequence)
+
+from pypika import Table, JoinType, analytics as an, functions as fn
+from pypika.queries import QueryBuilder
+from pypika.terms import Criterion
+from tortoise import Model
+from tortoise.backends.base.client import (
+    BaseDBAsyncClient, BaseTransactionWrapper)
 from tortoise.exceptions import DoesNotExist
+from tortoise.transactions import in_transaction
+
+from .caches import LRUCache, contact_responses, user_responses
+from .models import (
+    Contact, User, isoformat, normalize_email, normalize_phone_number)
+from .replicas import read_db
+
+
+# names of the service columns appended to rows by the list queries
+_TOTAL_COLUMN = '_total'
+_OWNER_COLUMN = '_owner_id'
+_RANK_COLUMN = '_rank'
+
+# a row as returned by the database driver, indexable by column name
+Row = Mapping[str, Any]
+
+# rows loaded during the current request, keyed by model and primary key,
+# so that the authorization checks and the write paths share one instance
+_identity_map = ContextVar('identity_map', default=None)
 
-from .models import Contact, User
+# invalidations of the cached responses made by the writes of the batch
+# transaction under way, made once more when it's finished
+_batch_invalidations = ContextVar('batch_invalidations', default=None)
 
 
 class UserNotFound(Exception):
@@ -16,106 +48,880 @@ class ContactNotFound(Exception):
         super().__init__(f'Contact with id {contact_id} was not found')
 
 
-async def get_user_list(
-        limit: Optional[int] = None,
-        offset: Optional[int] = None) -> Tuple[List[User], int]:
-    qry = User\
-        .all()\
-        .order_by('created_at')\
-        .prefetch_related('contacts')
+class AuthorizationError(Exception):
+    pass
 
-    users = await _limit_and_offset_query(qry, limit, offset)
 
-    user_count = await User.all().count()
+class Rollback(Exception):
+    """
+    Raised to roll back the batch transaction, see batch_transaction
+    """
 
-    return users, user_count
 
+async def get_user_list_values(
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        cursor: Optional[Tuple[datetime, int]] = None,
+        with_contacts: bool = True,
+        contacts_limit: Optional[int] = None,
+        **filters: Any
+) -> Tuple[Sequence[Row], Optional[Dict[int, List[Row]]], int]:
+    """
+    Fetches a page of users together with the total user count in a single
+    statement, then the contacts of the page (at most contacts_limit per
+    user) with a second one unless they aren't needed. No model instance is
+    built: the rows are returned as the driver produces them, to be
+    serialized with User.row_as_dict, and the contact rows grouped by user
+    id (None if they weren't fetched). Both the page and the count are
+    narrowed down by the filters, see _user_filter_criterion.
+    """
+    rows, user_count = await _fetch_user_page(
+        None, limit, offset, cursor, **filters)
+
+    contacts_by_user = None
+    if with_contacts:
+        contacts_by_user = await _fetch_contact_rows(
+            [row['id'] for row in rows], contacts_limit) if rows else {}
+
+    return rows, contacts_by_user, user_count
+
+
+async def get_user_list_versions(
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        cursor: Optional[Tuple[datetime, int]] = None,
+        **filters: Any
+) -> Tuple[List[Tuple[int, str, int]], int]:
+    """
+    Fetches the (id, created_at, version) triples of a page of users and
+    the total user count, which is all that's needed to tell whether the
+    page has changed
+    """
+    rows, user_count = await _fetch_user_page(
+        ('id', 'created_at', 'version'), limit, offset, cursor, **filters)
+
+    versions = [(row['id'], isoformat(row['created_at']), row['version'])
+                for row in rows]
+
+    return versions, user_count
+
+
+async def iter_users(batch_size: int) -> AsyncIterator[List[User]]:
+    """
+    Yields all the users with their contacts prefetched in batches, walking
+    the table in keyset order so that every batch costs the same
+    """
+    db = read_db(User)
+    users_tbl = Table(User._meta.table)
+    cursor = None
+
+    while True:
+        qry = db.query_class.from_(users_tbl).select(users_tbl.star)
+        qry = _paginate_query(qry, users_tbl, batch_size, None, cursor)
+
+        users = [User(**row) for row in await db.execute_query(qry.get_sql())]
+        if not users:
+            return
+
+        await User.fetch_for_list(users, 'contacts', using_db=db)
+        yield users
+
+        if len(users) < batch_size:
+            return
+        cursor = (users[-1].created_at, users[-1].id)
+
+
+async def get_single_user(user_id: int, with_contacts: bool = True) -> User:
+    return await _fetch_single_user(user_id, prefetch_contacts=with_contacts)
+
+
+async def get_single_user_values(
+        user_id: int, with_contacts: bool = True,
+        contacts_limit: Optional[int] = None
+) -> Tuple[Row, Optional[Dict[int, List[Row]]]]:
+    """
+    Fetches the row of the user and the user's contact rows, see
+    get_user_list_values
+    """
+    user = await _fetch_single_row(User, user_id, UserNotFound)
+    contacts_by_user = None
+    if with_contacts:
+        contacts_by_user = await _fetch_contact_rows([user_id],
+                                                     contacts_limit)
+    return user, contacts_by_user
+
+
+async def get_user_values_by_ids(
+        user_ids: Sequence[int], with_contacts: bool = True,
+        contacts_limit: Optional[int] = None
+) -> Tuple[Dict[int, Row], Optional[Dict[int, List[Row]]]]:
+    """
+    Fetches the rows of the users with the ids, keyed by id, with a single
+    statement, then their contact rows with a second one unless they
+    aren't needed, see get_user_list_values. The ids of missing users are
+    left out.
+    """
+    users = await _fetch_rows_by_ids(User, user_ids)
+    contacts_by_user = None
+    if with_contacts:
+        contacts_by_user = await _fetch_contact_rows(
+            list(users), contacts_limit) if users else {}
+    return users, contacts_by_user
+
+
+async def get_user_version(user_id: int) -> Optional[Tuple[str, int]]:
+    """
+    Returns the creation time (in ISO format) and the version of the user,
+    or None if the user doesn't exist
+    """
+    rows = await User.filter(id=user_id)\
+        .using_db(read_db(User))\
+        .values_list('created_at', 'version')
+    return (rows[0][0].isoformat(), rows[0][1]) if rows else None
+
+
+async def ensure_user_owned(user_id: int, creator_id: int) -> None:
+    """
+    Raises UserNotFound or AuthorizationError unless the user exists and
+    was created by the given creator, as update_user would
+    """
+    db = User._meta.db
+    users_tbl = Table(User._meta.table)
+
+    qry = db.query_class\
+        .from_(users_tbl)\
+        .select(users_tbl.id)\
+        .where((users_tbl.id == user_id) &
+               (users_tbl.creator_id == creator_id))
+    if not await _fetch_rows(db, qry):
+        await _raise_for_unowned_user(user_id, creator_id)
+
+
+async def update_user(user_id: int, creator_id: int, **data) -> None:
+    """
+    Updates the user with a single statement that also checks that the
+    user was created by the given creator
+    """
+    db = User._meta.db
+    users_tbl = Table(User._meta.table)
+
+    qry = db.query_class\
+        .update(users_tbl)\
+        .where((users_tbl.id == user_id) &
+               (users_tbl.creator_id == creator_id))\
+        .set(users_tbl.version, users_tbl.version + 1)
+    qry = _set_fields(qry, User, data)
+
+    if not await _execute_returning(db, qry, 'id'):
+        await _raise_for_unowned_user(user_id, creator_id)
+    _forget(User, user_id)
+    _invalidate(user_responses, user_id)
+
+
+async def delete_single_user(user_id: int, creator_id: int) -> None:
+    db = User._meta.db
+    users_tbl = Table(User._meta.table)
+
+    qry = db.query_class\
+        .from_(users_tbl)\
+        .where((users_tbl.id == user_id) &
+               (users_tbl.creator_id == creator_id))\
+        .delete()
+
+    if not await _execute_returning(db, qry, 'id'):
+        await _raise_for_unowned_user(user_id, creator_id)
+    _forget(User, user_id)
+    _invalidate(user_responses, user_id)
+    _invalidate_matching(contact_responses, lambda r: r.owner_id == user_id)
+
+
+async def get_single_contact_values(contact_id: int) -> Row:
+    """
+    Fetches the row of the contact, see get_user_list_values
+    """
+    return await _fetch_single_row(Contact, contact_id, ContactNotFound)
+
+
+async def get_contact_values_by_ids(
+        contact_ids: Sequence[int]) -> Dict[int, Row]:
+    """
+    Fetches the rows of the contacts with the ids, keyed by id, with a
+    single statement. The ids of missing contacts are left out.
+    """
+    return await _fetch_rows_by_ids(Contact, contact_ids)
+
+
+async def get_contact_version(contact_id: int) -> Optional[Tuple[str, int]]:
+    """
+    Returns the creation time (in ISO format) and the version of the
+    contact, or None if the contact doesn't exist
+    """
+    rows = await Contact.filter(id=contact_id)\
+        .using_db(read_db(Contact))\
+        .values_list('created_at', 'version')
+    return (rows[0][0].isoformat(), rows[0][1]) if rows else None
+
+
+async def ensure_contact_owned(contact_id: int, creator_id: int) -> None:
+    """
+    Raises ContactNotFound or AuthorizationError unless the contact exists
+    and its user was created by the given creator, as update_contact would
+    """
+    db = Contact._meta.db
+    contacts_tbl = Table(Contact._meta.table)
+
+    qry = db.query_class\
+        .from_(contacts_tbl)\
+        .select(contacts_tbl.id)\
+        .where(_owned_contact_criterion(db, contact_id, creator_id))
+    if not await _fetch_rows(db, qry):
+        await _raise_for_unowned_contact(contact_id, creator_id)
+
+
+async def update_contact(contact_id: int, creator_id: int, **data) -> None:
+    """
+    Updates the contact with a single statement that also checks that the
+    contact's user was created by the given creator, and bumps the version
+    of the user in the same transaction
+    """
+    contacts_tbl = Table(Contact._meta.table)
+
+    async with _transaction(Contact):
+        db = Contact._meta.db
+        qry = db.query_class\
+            .update(contacts_tbl)\
+            .where(_owned_contact_criterion(db, contact_id, creator_id))\
+            .set(contacts_tbl.version, contacts_tbl.version + 1)
+        qry = _set_fields(qry, Contact, Contact.normalized(data))
+
+        rows = await _execute_returning(db, qry, 'id', 'user_id')
+        if rows:
+            await _bump_user_version(db, rows[0]['user_id'])
+
+    if not rows:
+        await _raise_for_unowned_contact(contact_id, creator_id)
+    _forget(Contact, contact_id)
+    _invalidate(contact_responses, contact_id)
+    # the contact is embedded into its user's response
+    _invalidate(user_responses, rows[0]['user_id'])
+
+
+async def delete_single_contact(contact_id: int, creator_id: int) -> None:
+    contacts_tbl = Table(Contact._meta.table)
+
+    async with _transaction(Contact):
+        db = Contact._meta.db
+        qry = db.query_class\
+            .from_(contacts_tbl)\
+            .where(_owned_contact_criterion(db, contact_id, creator_id))\
+            .delete()
+
+        rows = await _execute_returning(db, qry, 'id', 'user_id')
+        if rows:
+            await _bump_user_version(db, rows[0]['user_id'])
+
+    if not rows:
+        await _raise_for_unowned_contact(contact_id, creator_id)
+    _forget(Contact, contact_id)
+    _invalidate(contact_responses, contact_id)
+    _invalidate(user_responses, rows[0]['user_id'])
+
+
+async def get_user_contact_values(
+        user_id: int, limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        cursor: Optional[Tuple[datetime, int]] = None
+) -> Tuple[List[Row], int]:
+    """
+    Fetches the rows of a page of the user's contacts (see
+    get_user_list_values), the total contact count and verifies that the
+    user exists using a single statement (the user row is left-joined to
+    their contacts, so it's returned even when there are none)
+    """
+    db = read_db(Contact)
+    users_tbl = Table(User._meta.table)
+    contacts_tbl = Table(Contact._meta.table)
+
+    total_qry = db.query_class\
+        .from_(contacts_tbl)\
+        .select(fn.Count('*'))\
+        .where(contacts_tbl.user_id == user_id)
+    qry = db.query_class\
+        .from_(users_tbl)\
+        .join(contacts_tbl, how=JoinType.left)\
+        .on(_keyset_criterion(contacts_tbl.user_id == users_tbl.id,
+                              contacts_tbl, cursor))\
+        .select(users_tbl.id.as_(_OWNER_COLUMN),
+                total_qry.as_(_TOTAL_COLUMN),
+                contacts_tbl.star)\
+        .where(users_tbl.id == user_id)
+    qry = _paginate_query(qry, contacts_tbl, limit, offset, None)
+
+    rows = await _fetch_rows(db, qry)
+    if not rows:
+        # the page is past the end, so the user's existence and the total
+        # must be checked separately
+        qry = db.query_class\
+            .from_(users_tbl)\
+            .select(total_qry.as_(_TOTAL_COLUMN))\
+            .where(users_tbl.id == user_id)
+        rows = await _fetch_rows(db, qry)
+        if not rows:
+            raise UserNotFound(user_id)
+        return [], rows[0][_TOTAL_COLUMN]
+
+    total = rows[0][_TOTAL_COLUMN]
+    contacts = [row for row in rows if row['id'] is not None]
 
-async def get_single_user(user_id: int) -> User:
-    return await _fetch_single_user(user_id, prefetch_contacts=True)
+    return contacts, total
 
 
-async def update_user(user_id: int, **data) -> None:
-    user = await _fetch_single_user(user_id)
-    for name, val in data.items():
-        setattr(user, name, val)
-    await user.save()
+async def lookup_contact_values(
+        phone_no: str = '', email: str = '', limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        cursor: Optional[Tuple[datetime, int]] = None
+) -> Tuple[Sequence[Row], int]:
+    """
+    Fetches the rows of a page of the contacts with the phone number or
+    the email (compared in their normalized forms, through their indexes)
+    and their total count, see get_user_list_values
+    """
+    db = read_db(Contact)
+    contacts_tbl = Table(Contact._meta.table)
+
+    if phone_no:
+        column, value = 'e164_phone_no', normalize_phone_number(phone_no)
+    else:
+        column, value = 'lowercase_email', normalize_email(email)
+    criterion = contacts_tbl.field(column) == value
+
+    total_qry = db.query_class\
+        .from_(contacts_tbl)\
+        .select(fn.Count('*'))\
+        .where(criterion)
+    qry = db.query_class\
+        .from_(contacts_tbl)\
+        .select(contacts_tbl.star, total_qry.as_(_TOTAL_COLUMN))\
+        .where(criterion)
+    qry = _paginate_query(qry, contacts_tbl, limit, offset, cursor)
+
+    rows = await _fetch_rows(db, qry)
+    if not rows:
+        # the page is past the end, so there's no row to carry the total
+        return [], await Contact.filter(**{column: value})\
+            .using_db(db).count()
+
+    return rows, rows[0][_TOTAL_COLUMN]
+
+
+async def backfill_normalized_contacts(batch_size: int) -> int:
+    """
+    Fills in the normalized columns of the contacts written before they
+    were added, which are left empty by their defaults. Walks the table in
+    primary key order, updating each batch in its own transaction, and
+    returns how many contacts were updated.
+    """
+    contacts_tbl = Table(Contact._meta.table)
+    last_id = 0
+    updated = 0
+
+    while True:
+        db = Contact._meta.db
+        qry = db.query_class\
+            .from_(contacts_tbl)\
+            .select(contacts_tbl.id, contacts_tbl.phone_no,
+                    contacts_tbl.email)\
+            .where((contacts_tbl.id > last_id) &
+                   (contacts_tbl.e164_phone_no == '') &
+                   (contacts_tbl.lowercase_email == ''))\
+            .orderby(contacts_tbl.id)\
+            .limit(batch_size)
+        rows = await _fetch_rows(db, qry)
+        if not rows:
+            return updated
+
+        async with _transaction(Contact):
+            db = Contact._meta.db
+            for row in rows:
+                e164 = normalize_phone_number(row['phone_no'])
+                email = normalize_email(row['email'])
+                if not e164 and not email:
+                    # neither can be looked up, there's nothing to fill in
+                    continue
+                update_qry = db.query_class\
+                    .update(contacts_tbl)\
+                    .set(contacts_tbl.e164_phone_no, e164)\
+                    .set(contacts_tbl.lowercase_email, email)\
+                    .where(contacts_tbl.id == row['id'])
+                await db.execute_query(update_qry.get_sql())
+                updated += 1
+
+        if len(rows) < batch_size:
+            return updated
+        last_id = rows[-1]['id']
+
+
+async def add_user(**data) -> int:
+    user = await User.create(**data)
+    # drop a cached 404 for the id
+    _invalidate(user_responses, user.id)
+    return user.id
 
 
-async def delete_single_user(user_id: int) -> None:
+async def add_user_contact(user_id: int, **contact_data) -> int:
     user = await _fetch_single_user(user_id)
-    await user.delete()
 
+    async with _transaction(Contact):
+        new_contact = await Contact.create(
+            user=user, **Contact.normalized(contact_data))
+        await _bump_user_version(Contact._meta.db, user_id)
+    _forget(User, user_id)
+    _invalidate(contact_responses, new_contact.id)
+    _invalidate(user_responses, user_id)
 
-async def get_single_contact(contact_id: int) -> Contact:
-    return await _fetch_single_contact(contact_id)
+    return new_contact.id
 
 
-async def update_contact(contact_id: int, **data) -> None:
-    contact = await _fetch_single_contact(contact_id)
-    for name, val in data.items():
-        setattr(contact, name, val)
-    await contact.save()
+async def add_user_contacts(user_id: int,
+                            contacts: List[Dict[str, Any]]) -> List[int]:
+    """
+    Creates all the contacts with a single multi-row INSERT and returns
+    their ids in the order the contacts were given
+    """
+    user = await _fetch_single_user(user_id)
 
+    async with _transaction(Contact):
+        new_ids = await _insert_rows(
+            Contact, [dict(Contact.normalized(c), user_id=user.id)
+                      for c in contacts])
+        await _bump_user_version(Contact._meta.db, user_id)
+    _forget(User, user_id)
+    for contact_id in new_ids:
+        _invalidate(contact_responses, contact_id)
+    _invalidate(user_responses, user_id)
 
-async def delete_single_contact(contact_id: int) -> None:
-    contact = await _fetch_single_contact(contact_id)
-    await contact.delete()
+    return new_ids
 
 
-async def get_user_contacts(
-        user_id: int, limit: Optional[int] = None,
-        offset: Optional[int] = None) -> Tuple[List[Contact], int]:
-    await _fetch_single_user(user_id)
+async def import_users(creator_id: int,
+                       users: List[Dict[str, Any]]) -> List[int]:
+    """
+    Creates the users along with their contacts in one transaction, using
+    a multi-row INSERT for the users and another one for all the contacts
+    """
+    async with _transaction(User):
+        user_ids = await _insert_rows(
+            User, [{'name': u['name'], 'creator_id': creator_id}
+                   for u in users])
 
-    qry = Contact.filter(user_id=user_id)
-    contacts = await _limit_and_offset_query(qry, limit, offset)
-    total = await qry.count()
+        contacts = [dict(Contact.normalized(c), user_id=user_id)
+                    for user_id, u in zip(user_ids, users)
+                    for c in u['contacts']]
+        contact_ids = await _insert_rows(Contact, contacts) if contacts else []
 
-    return contacts, total
+    # only drop cached 404s once the rows are visible to other requests
+    for user_id in user_ids:
+        _invalidate(user_responses, user_id)
+    for contact_id in contact_ids:
+        _invalidate(contact_responses, contact_id)
 
+    return user_ids
 
-async def add_user(**data) -> int:
-    user = await User.create(**data)
-    return user.id
 
+async def delete_all_user_contacts(user_id: int) -> None:
+    await _fetch_single_user(user_id)
 
-async def add_user_contact(user_id: int, **contact_data) -> int:
-    user = await _fetch_single_user(user_id)
+    async with _transaction(Contact):
+        await Contact.filter(user_id=user_id).delete()
+        await _bump_user_version(Contact._meta.db, user_id)
+    _forget(User, user_id)
+    _invalidate(user_responses, user_id)
+    _invalidate_matching(contact_responses, lambda r: r.owner_id == user_id)
+
+
+@asynccontextmanager
+async def batch_transaction() -> AsyncIterator[None]:
+    """
+    Runs the writes of the block in one transaction, which the transactions
+    they start themselves join, rolled back by raising Rollback. The cached
+    responses the writes drop are dropped once more when it's finished:
+    the ones cached meanwhile may reflect what it had not committed yet, or
+    what it rolled back.
+    """
+    invalidations = []  # type: List[Tuple[LRUCache, Any, bool]]
+    token = _batch_invalidations.set(invalidations)
+    try:
+        async with in_transaction(User._meta.default_connection):
+            yield
+    except Rollback:
+        # the instances remembered by the writes may not exist anymore
+        if _identity_map.get() is not None:
+            _identity_map.set({})
+    finally:
+        _batch_invalidations.reset(token)
+        for cache, key_or_predicate, matching in invalidations:
+            if matching:
+                cache.invalidate_matching(key_or_predicate)
+            else:
+                cache.invalidate(key_or_predicate)
 
-    new_contact = await Contact.create(user=user, **contact_data)
 
-    return new_contact.id
+def begin_unit_of_work() -> None:
+    """
+    Starts a fresh identity map for the current request
+    """
+    _identity_map.set({})
 
 
-async def delete_all_user_contacts(user_id: int) -> None:
-    await _fetch_single_user(user_id)
-    await Contact.filter(user_id=user_id).delete()
+def end_unit_of_work() -> None:
+    _identity_map.set(None)
 
 
 async def _fetch_single_user(user_id: int,
                              prefetch_contacts: bool = False) -> User:
-    qry = User.get(id=user_id)
-    if prefetch_contacts:
-        qry = qry.prefetch_related('contacts')
-
-    try:
-        return await qry
-    except DoesNotExist:
-        raise UserNotFound(user_id) from None
-
-
-async def _fetch_single_contact(contact_id: int) -> Contact:
-    try:
-        return await Contact.get(id=contact_id)
-    except DoesNotExist:
-        raise ContactNotFound(contact_id) from None
+    user = _recall(User, user_id)
+    if user is None:
+        qry = User.get(id=user_id)
+        if prefetch_contacts:
+            qry = qry.prefetch_related('contacts')
+
+        try:
+            user = _remember(await qry)
+        except DoesNotExist:
+            raise UserNotFound(user_id) from None
+    elif prefetch_contacts and not user.contacts._fetched:
+        await user.fetch_related('contacts')
+
+    return user
+
+
+async def _fetch_user_page(
+        columns: Optional[Tuple[str, ...]], limit: Optional[int],
+        offset: Optional[int], cursor: Optional[Tuple[datetime, int]],
+        **filters: Any
+) -> Tuple[Sequence[Row], int]:
+    """
+    Fetches the given columns (all of them by default) of a page of the
+    users matching the filters together with their total count in a single
+    statement. The rows also have the total count column, which is left in
+    place rather than copying them all to drop it.
+    """
+    db = read_db(User)
+    users_tbl = Table(User._meta.table)
+    criterion = _user_filter_criterion(users_tbl, **filters)
+
+    total_qry = db.query_class\
+        .from_(users_tbl)\
+        .select(fn.Count('*').as_(_TOTAL_COLUMN))
+    if criterion is not None:
+        total_qry = total_qry.where(criterion)
+    selected = [users_tbl.field(c) for c in columns] if columns \
+        else [users_tbl.star]
+    qry = db.query_class\
+        .from_(users_tbl)\
+        .select(*selected, total_qry.as_(_TOTAL_COLUMN))
+    if criterion is not None:
+        qry = qry.where(criterion)
+    qry = _paginate_query(qry, users_tbl, limit, offset, cursor)
+
+    rows = await _fetch_rows(db, qry)
+    if not rows:
+        # the page is past the end, so there's no row to carry the total
+        return [], (await _fetch_rows(db, total_qry))[0][_TOTAL_COLUMN]
+
+    return rows, rows[0][_TOTAL_COLUMN]
+
+
+async def _fetch_contact_rows(
+        user_ids: List[int], contacts_limit: Optional[int]
+) -> Dict[int, List[Row]]:
+    """
+    Fetches the contact rows of the users, grouped by user id, with a
+    single statement. When a limit is given, only the first contacts_limit
+    contacts of every user are fetched, ranked with a window function.
+    """
+    db = read_db(Contact)
+    contacts_tbl = Table(Contact._meta.table)
+
+    if contacts_limit is None:
+        qry = db.query_class\
+            .from_(contacts_tbl)\
+            .select(contacts_tbl.star)\
+            .where(contacts_tbl.user_id.isin(user_ids))\
+            .orderby(contacts_tbl.user_id)\
+            .orderby(contacts_tbl.created_at)\
+            .orderby(contacts_tbl.id)
+    else:
+        rank = an.RowNumber()\
+            .over(contacts_tbl.user_id)\
+            .orderby(contacts_tbl.created_at)\
+            .orderby(contacts_tbl.id)
+        ranked_qry = db.query_class\
+            .from_(contacts_tbl)\
+            .select(contacts_tbl.star, rank.as_(_RANK_COLUMN))\
+            .where(contacts_tbl.user_id.isin(user_ids))
+        qry = db.query_class\
+            .from_(ranked_qry)\
+            .select(ranked_qry.star)\
+            .where(ranked_qry.field(_RANK_COLUMN) <= contacts_limit)\
+            .orderby(ranked_qry.user_id)\
+            .orderby(ranked_qry.field(_RANK_COLUMN))
+
+    contacts_by_user = {}
+    for row in await _fetch_rows(db, qry):
+        contacts_by_user.setdefault(row['user_id'], []).append(row)
+    return contacts_by_user
+
+
+async def _fetch_single_row(model: Type[Model], pk: int,
+                            not_found: Type[Exception]) -> Row:
+    db = read_db(model)
+    tbl = Table(model._meta.table)
+
+    qry = db.query_class.from_(tbl).select(tbl.star).where(tbl.id == pk)
+    rows = await _fetch_rows(db, qry)
+    if not rows:
+        raise not_found(pk)
+    return rows[0]
+
+
+async def _fetch_rows_by_ids(model: Type[Model],
+                             pks: Sequence[int]) -> Dict[int, Row]:
+    db = read_db(model)
+    tbl = Table(model._meta.table)
+
+    qry = db.query_class.from_(tbl).select(tbl.star).where(tbl.id.isin(pks))
+    return {row['id']: row for row in await _fetch_rows(db, qry)}
+
+
+async def _fetch_rows(db: BaseDBAsyncClient,
+                      qry: QueryBuilder) -> Sequence[Row]:
+    """
+    Fetches the rows of the query without copying them to dicts, using the
+    pooled clients' fetch_rows (the clients of other backends only have
+    execute_query)
+    """
+    fetch = getattr(db, 'fetch_rows', db.execute_query)
+    return await fetch(qry.get_sql())
+
+
+async def _bump_user_version(db: BaseDBAsyncClient, user_id: int) -> None:
+    users_tbl = Table(User._meta.table)
+    qry = db.query_class\
+        .update(users_tbl)\
+        .set(users_tbl.version, users_tbl.version + 1)\
+        .where(users_tbl.id == user_id)
+    await db.execute_query(qry.get_sql())
+
+
+def _owned_contact_criterion(db: BaseDBAsyncClient, contact_id: int,
+                             creator_id: int) -> Criterion:
+    """
+    Matches the contact if its user was created by the given creator. The
+    user is looked up by the primary key taken from the contact, so that
+    checking the ownership never scans the users of the creator.
+    """
+    users_tbl = Table(User._meta.table)
+    contacts_tbl = Table(Contact._meta.table)
+
+    contact_user_id = db.query_class\
+        .from_(contacts_tbl)\
+        .select(contacts_tbl.user_id)\
+        .where(contacts_tbl.id == contact_id)
+    owned_user_id = db.query_class\
+        .from_(users_tbl)\
+        .select(users_tbl.id)\
+        .where(users_tbl.id.isin(contact_user_id) &
+               (users_tbl.creator_id == creator_id))
+
+    return (contacts_tbl.id == contact_id) & \
+        contacts_tbl.user_id.isin(owned_user_id)
+
+
+def _set_fields(qry: QueryBuilder, model: Type[Model],
+                data: Dict[str, Any]) -> QueryBuilder:
+    for name, val in data.items():
+        field = model._meta.fields_map[name]
+        qry = qry.set(model._meta.fields_db_projection[name],
+                      field.to_db_value(val, None))
+    return qry
 
 
-def _limit_and_offset_query(qry: QuerySet, limit: Optional[int],
-                            offset: Optional[int]) -> QuerySet:
+async def _execute_returning(db: BaseDBAsyncClient, qry: QueryBuilder,
+                             *columns: str) -> List[Dict[str, Any]]:
+    """
+    Executes an INSERT, UPDATE or DELETE statement and returns the given
+    columns of the affected rows (RETURNING is supported by PostgreSQL and
+    SQLite 3.35+)
+    """
+    return await db.execute_query(
+        f'{qry.get_sql()} RETURNING {", ".join(columns)}')
+
+
+async def _insert_rows(model: Type[Model],
+                       rows: List[Dict[str, Any]]) -> List[int]:
+    """
+    Inserts the rows with a single statement, filling in the model's
+    defaults, and returns the new ids in insertion order
+    """
+    db = model._meta.db
+    executor = db.executor_class(model=model, db=db)
+    regular_columns, columns = executor._prepare_insert_columns()
+
+    qry = db.query_class.into(Table(model._meta.table)).columns(*columns)
+    for row in rows:
+        values = executor._prepare_insert_values(model(**row),
+                                                 regular_columns)
+        qry = qry.insert(*[_to_sql_literal(v) for v in values])
+
+    rows = await _execute_returning(db, qry, 'id')
+    # ids are assigned in ascending order within a single statement
+    return sorted(row['id'] for row in rows)
+
+
+def _to_sql_literal(value: Any) -> Any:
+    # store datetimes in the same textual form the driver uses for bound
+    # parameters, not the ISO format pypika would render them with
+    if isinstance(value, datetime):
+        return str(value)
+    return value
+
+
+async def _raise_for_unowned_user(user_id: int, creator_id: int) -> None:
+    """
+    Tells why an ownership-checked write to the user affected no rows
+    """
+    if not await User.filter(id=user_id).count():
+        raise UserNotFound(user_id)
+    raise AuthorizationError(
+        f"Creator {creator_id} can't edit user {user_id}")
+
+
+async def _raise_for_unowned_contact(contact_id: int,
+                                     creator_id: int) -> None:
+    """
+    Tells why an ownership-checked write to the contact affected no rows
+    """
+    if not await Contact.filter(id=contact_id).count():
+        raise ContactNotFound(contact_id)
+    raise AuthorizationError(
+        f"Creator {creator_id} can't edit contact {contact_id}")
+
+
+@asynccontextmanager
+async def _transaction(model: Type[Model]) -> AsyncIterator[None]:
+    """
+    Starts a transaction on the model's connection, or joins the one under
+    way, see batch_transaction
+    """
+    if isinstance(model._meta.db, BaseTransactionWrapper):
+        yield
+        return
+    async with in_transaction(model._meta.default_connection):
+        yield
+
+
+def _invalidate(cache: LRUCache, key: Any) -> None:
+    cache.invalidate(key)
+    invalidations = _batch_invalidations.get()
+    if invalidations is not None:
+        invalidations.append((cache, key, False))
+
+
+def _invalidate_matching(cache: LRUCache,
+                         predicate: Callable[[Any], bool]) -> None:
+    cache.invalidate_matching(predicate)
+    invalidations = _batch_invalidations.get()
+    if invalidations is not None:
+        invalidations.append((cache, predicate, True))
+
+
+def _recall(model: Type[Model], pk: int) -> Optional[Model]:
+    identity_map = _identity_map.get()
+    if identity_map is None:
+        return None
+    return identity_map.get((model, pk))
+
+
+def _remember(instance: Model) -> Model:
+    identity_map = _identity_map.get()
+    if identity_map is not None:
+        identity_map[(type(instance), instance.id)] = instance
+    return instance
+
+
+def _forget(model: Type[Model], pk: int) -> None:
+    identity_map = _identity_map.get()
+    if identity_map is not None:
+        identity_map.pop((model, pk), None)
+
+
+def _paginate_query(qry: QueryBuilder, tbl: Table, limit: Optional[int],
+                    offset: Optional[int],
+                    cursor: Optional[Tuple[datetime, int]]) -> QueryBuilder:
+    """
+    Orders the query by the keyset of the table and applies keyset
+    pagination when a cursor (the (created_at, id) pair of the last row of
+    the previous page) is given, falling back to limit/offset otherwise
+    """
+    if cursor:
+        qry = qry.where(_keyset_criterion(None, tbl, cursor))
+    qry = qry.orderby(tbl.created_at).orderby(tbl.id)
     if limit is not None:
         qry = qry.limit(limit)
     if offset is not None:
         qry = qry.offset(offset)
     return qry
+
+
+def _user_filter_criterion(tbl: Table, name_prefix: Optional[str] = None,
+                           created_after: Optional[datetime] = None,
+                           created_before: Optional[datetime] = None,
+                           creator_id: Optional[int] = None
+                           ) -> Optional[Criterion]:
+    """
+    Builds the condition selecting the users matching the filters, None if
+    there's none. The name prefix is matched as a range of names, which
+    unlike LIKE can use the index of the column; it's case-sensitive. The
+    creation time bounds are exclusive.
+    """
+    conditions = []
+    if name_prefix:
+        conditions.append(tbl.name >= name_prefix)
+        following = ord(name_prefix[-1]) + 1
+        if 0xD800 <= following <= 0xDFFF:
+            # surrogates can't be encoded, and no name contains them
+            following = 0xE000
+        if following <= sys.maxunicode:
+            conditions.append(
+                tbl.name < name_prefix[:-1] + chr(following))
+    if created_after is not None:
+        conditions.append(tbl.created_at > _to_sql_literal(created_after))
+    if created_before is not None:
+        conditions.append(tbl.created_at < _to_sql_literal(created_before))
+    if creator_id is not None:
+        conditions.append(tbl.creator_id == creator_id)
+
+    criterion = None
+    for condition in conditions:
+        criterion = condition if criterion is None else criterion & condition
+    return criterion
+
+
+def _keyset_criterion(criterion: Optional[Criterion], tbl: Table,
+                      cursor: Optional[Tuple[datetime, int]]
+                      ) -> Optional[Criterion]:
+    """
+    Adds the "rows after the cursor" condition to the given criterion
+    """
+    if not cursor:
+        return criterion
+
+    created_at, row_id = cursor
+    created_at = _to_sql_literal(created_at)
+    after_cursor = (tbl.created_at > created_at) | (
+        (tbl.created_at == created_at) & (tbl.id > row_id))
+
+    if criterion is None:
+        return after_cursor
+    return criterion & after_cursor
@@ -0,0 +1,245 @@
+from typing import Callable, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+from tornado.log import access_log
+from tornado.web import Application, RequestHandler
+
+from .caches import contact_responses, phone_number_cache, user_responses
+from .tracing import UNMATCHED_ROUTE
+
+
+# upper bounds of the buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+# upper bounds of the buckets of the statements per request histogram
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(str(v))}"'
+                          for n, v in zip(names, values)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    TYPE = 'untyped'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+    def samples(self) -> Iterable[Tuple[str, Sequence[str], Sequence[str],
+                                        float]]:
+        """
+        Yields the (name suffix, label names, label values, value) samples
+        """
+        raise NotImplementedError()
+
+    def expose(self) -> Iterator[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.TYPE}'
+        for suffix, names, values, value in self.samples():
+            yield '{}{}{} {}'.format(self.name, suffix,
+                                     _format_labels(names, values),
+                                     _format_value(value))
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._values = {}  # type: Dict[LabelValues, float]
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        self._values[label_values] = \
+            self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        for values, value in sorted(self._values.items()):
+            yield '', self.labels, values, value
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        # label values -> (observations per bucket, sum)
+        self._values = {}  # type: Dict[LabelValues, Tuple[List[int], list]]
+
+    def observe(self, value: float, *label_values: str) -> None:
+        counts, total = self._values.setdefault(
+            label_values, ([0] * len(self.buckets), [0.0]))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                # the buckets are cumulated when exposed
+                counts[i] += 1
+                break
+        total[0] += value
+
+    def samples(self):
+        names = self.labels + ('le',)
+        for values, (counts, total) in sorted(self._values.items()):
+            cumulated = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulated += count
+                le = _format_value(float(bound))
+                yield '_bucket', names, values + (le,), cumulated
+            yield '_sum', self.labels, values, total[0]
+            yield '_count', self.labels, values, cumulated
+
+
+class Gauge(Metric):
+    """
+    Gauge whose values are collected from the current state when exposed
+    """
+    TYPE = 'gauge'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str],
+                 collect: Callable[[], Iterable[Tuple[LabelValues, float]]]
+                 ) -> None:
+        super().__init__(name, documentation, labels)
+        self._collect = collect
+
+    def samples(self):
+        for values, value in self._collect():
+            yield '', self.labels, values, value
+
+
+class CollectedCounter(Gauge):
+    """
+    Counter maintained elsewhere, e.g. by the caches, collected when exposed
+    """
+    TYPE = 'counter'
+
+
+def _cache_stat(attribute: str) -> Callable[[], Iterable]:
+    def collect() -> Iterable[Tuple[LabelValues, float]]:
+        # avoid cyclical import
+        from .validation_schemata import email_cache, jwt_cache
+        caches = (('jwt', jwt_cache), ('user_responses', user_responses),
+                  ('contact_responses', contact_responses),
+                  ('phone_numbers', phone_number_cache),
+                  ('emails', email_cache))
+        for name, cache in caches:
+            value = getattr(cache, attribute)
+            yield (name,), value() if callable(value) else value
+    return collect
+
+
+def _pool_stat(attribute: str) -> Callable[[], Iterable]:
+    def collect() -> Iterable[Tuple[LabelValues, float]]:
+        # avoid cyclical import
+        from .pool import pools
+        for name, pool in sorted(pools.items()):
+            yield (name,), getattr(pool, attribute)
+    return collect
+
+
+requests_total = Counter(
+    'fooapi_requests_total', 'Requests served',
+    ('route', 'method', 'status'))
+request_duration = Histogram(
+    'fooapi_request_duration_seconds', 'Time taken to serve a request',
+    ('route', 'method'))
+request_db_statements = Histogram(
+    'fooapi_request_db_statements', 'Statements sent to the database by a '
+    'request', ('route', 'method'), buckets=STATEMENT_BUCKETS)
+request_db_duration = Histogram(
+    'fooapi_request_db_duration_seconds', 'Time a request spent executing '
+    'statements', ('route', 'method'))
+
+registry = [
+    requests_total,
+    request_duration,
+    request_db_statements,
+    request_db_duration,
+    Gauge('fooapi_db_pool_connections', 'Open database connections',
+          ('connection',), _pool_stat('size')),
+    Gauge('fooapi_db_pool_connections_in_use',
+          'Database connections in use', ('connection',),
+          _pool_stat('in_use')),
+    Gauge('fooapi_db_pool_waiting', 'Requests waiting for a database '
+          'connection', ('connection',), _pool_stat('waiting')),
+    Gauge('fooapi_db_pool_saturation', 'Share of the maximum number of '
+          'database connections in use', ('connection',),
+          _pool_stat('saturation')),
+    CollectedCounter('fooapi_cache_hits_total', 'Cache hits', ('cache',),
+                     _cache_stat('hits')),
+    CollectedCounter('fooapi_cache_misses_total', 'Cache misses',
+                     ('cache',), _cache_stat('misses')),
+    Gauge('fooapi_cache_entries', 'Cached entries', ('cache',),
+          _cache_stat('__len__')),
+]  # type: List[Metric]
+
+
+def expose() -> str:
+    """
+    Renders all the metrics in the Prometheus text format
+    """
+    return ''.join(line + '\n' for metric in registry
+                   for line in metric.expose())
+
+
+def log_request(handler: RequestHandler) -> None:
+    """
+    The log_function of the application: records the metrics of every
+    request, labelled with the pattern of the route it matched, and then
+    logs it like tornado does by default, along with its request id
+    """
+    trace = getattr(handler, 'request_trace', None)
+    route = trace.route if trace is not None else UNMATCHED_ROUTE
+    method = handler.request.method
+    duration = handler.request.request_time()
+
+    requests_total.inc(route, method, str(handler.get_status()))
+    request_duration.observe(duration, route, method)
+    if trace is not None:
+        request_db_statements.observe(trace.db_statements, route, method)
+        request_db_duration.observe(trace.db_time, route, method)
+
+    if handler.get_status() < 400:
+        log_method = access_log.info
+    elif handler.get_status() < 500:
+        log_method = access_log.warning
+    else:
+        log_method = access_log.error
+    log_method('%d %s %.2fms (request %s)', handler.get_status(),
+               handler._request_summary(), 1000.0 * duration,
+               trace.request_id if trace is not None else '-')
+
+
+class MetricsHandler(RequestHandler):
+    def get(self) -> None:
+        self.set_header('Content-Type', CONTENT_TYPE)
+        self.write(expose())
+
+
+def make_metrics_app() -> Application:
+    """
+    The application serving the metrics, on a port of its own so that it
+    isn't exposed with the API
+    """
+    return Application([(r'/metrics', MetricsHandler)])
@@ -1,9 +1,12 @@
-from typing import Dict, Any
+from typing import Dict, Any, List, Mapping, Optional, Sequence, Union
 from enum import IntEnum, Enum
 from datetime import datetime
 
+import phonenumbers
 from tortoise import Model, fields
 
+from .caches import phone_number_cache
+
 
 class ContactTypeEnum(IntEnum):
     home = 1
@@ -17,6 +20,40 @@ class ContactTypeNameEnum(str, Enum):
     other = 'other'
 
 
+def isoformat(value: Union[datetime, str]) -> str:
+    """
+    Formats a datetime column value as returned by the database driver in
+    ISO format. SQLite returns the datetimes as they were stored, i.e. as
+    str(datetime), which only differs from the ISO format by the separator.
+    """
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value.replace(' ', 'T', 1)
+
+
+def normalize_phone_number(phone_no: str) -> str:
+    """
+    Returns the phone number in E.164 format, or an empty string if it
+    can't be parsed, so that the different ways of writing a number can be
+    looked up at once
+    """
+    e164 = phone_number_cache.peek(phone_no)
+    if e164 is not None:
+        # the number was just validated
+        return e164
+
+    try:
+        number = phonenumbers.parse(phone_no)
+    except phonenumbers.NumberParseException:
+        return ''
+    return phonenumbers.format_number(number,
+                                      phonenumbers.PhoneNumberFormat.E164)
+
+
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
 class Contact(Model):
     TYPES_TO_NAMES = {
         ContactTypeEnum.home: ContactTypeNameEnum.home,
@@ -31,11 +68,22 @@ class Contact(Model):
     id = fields.IntField(pk=True)
     phone_no = fields.CharField(PHONE_MAX_LEN, null=False, default='')
     email = fields.CharField(EMAIL_MAX_LEN, null=False, default='')
+    # the phone number and email normalized, to look the contacts up by
+    e164_phone_no = fields.CharField(PHONE_MAX_LEN, null=False, default='',
+                                     index=True)
+    lowercase_email = fields.CharField(EMAIL_MAX_LEN, null=False, default='',
+                                       index=True)
     created_at = fields.DatetimeField(null=False, default=datetime.utcnow,
                                       index=True)
     type = fields.SmallIntField(null=False, default=ContactTypeEnum.other)
     user = fields.ForeignKeyField('models.User', related_name='contacts',
                                   on_delete=fields.CASCADE, null=False)
+    # incremented by every update, used to build the contact's ETag
+    version = fields.IntField(null=False, default=1)
+
+    # the indexes spanning several columns, see get_composite_index_sql;
+    # this one serves the pages of a user's contacts
+    COMPOSITE_INDEXES = (('user_id', 'created_at', 'id'),)
 
     def __repr__(self) -> str:
         return ('<Contact id={id}, phone_no={phone}, email={email}, '
@@ -46,6 +94,16 @@ class Contact(Model):
                     type=self.TYPES_TO_NAMES[self.type],
                     created_at=self.created_at.isoformat())
 
+    @staticmethod
+    def normalized(data: Mapping[str, Any]) -> Dict[str, Any]:
+        """
+        Adds the normalized columns to the data of a contact being written
+        """
+        return dict(data,
+                    e164_phone_no=normalize_phone_number(
+                        data.get('phone_no', '')),
+                    lowercase_email=normalize_email(data.get('email', '')))
+
     def as_dict(self) -> Dict[str, Any]:
         return {
             'id': self.id,
@@ -55,15 +113,39 @@ class Contact(Model):
             'type': self.TYPES_TO_NAMES[self.type]
         }
 
+    @classmethod
+    def row_as_dict(cls, row: Mapping[str, Any]) -> Dict[str, Any]:
+        """
+        Same as as_dict, but for a row of the contact table as returned by
+        the database driver
+        """
+        return {
+            'id': row['id'],
+            'phone_no': row['phone_no'],
+            'email': row['email'],
+            'created_at': isoformat(row['created_at']),
+            'type': cls.TYPES_TO_NAMES[row['type']]
+        }
+
 
 class User(Model):
     NAME_MAX_LEN = 128
+    # fields of the dict representation, apart from the contacts
+    DICT_FIELDS = ('id', 'name', 'created_at')
 
     id = fields.IntField(pk=True)
-    name = fields.CharField(NAME_MAX_LEN, null=False, required=True)
+    # indexed for the name prefix filter
+    name = fields.CharField(NAME_MAX_LEN, null=False, required=True,
+                            index=True)
     created_at = fields.DatetimeField(null=False, default=datetime.utcnow,
                                       index=True)
     creator_id = fields.IntField(null=False)
+    # incremented by every write to the user or to their contacts, since
+    # the contacts are part of the user's representation
+    version = fields.IntField(null=False, default=1)
+
+    # serves the pages of the users filtered by creator, in keyset order
+    COMPOSITE_INDEXES = (('creator_id', 'created_at', 'id'),)
 
     def __repr__(self) -> str:
         return (
@@ -75,12 +157,53 @@ class User(Model):
                 creator_id=self.creator_id,
                 contacts=', '.join((repr(c) for c in self.contacts)))
 
-    def as_dict(self, dump_contacts: bool = False) -> Dict[str, Any]:
+    def as_dict(self, dump_contacts: bool = True,
+                fields: Optional[Sequence[str]] = None) -> Dict[str, Any]:
         res = {
             'id': self.id,
             'name': self.name,
-            'created_at': self.created_at.isoformat(),
-            'contacts': [c.as_dict() for c in self.contacts]
+            'created_at': self.created_at.isoformat()
         }
+        if fields is not None:
+            res = {name: res[name] for name in fields}
+
+        if dump_contacts:
+            res['contacts'] = [c.as_dict() for c in self.contacts]
 
         return res
+
+    @classmethod
+    def row_as_dict(
+            cls, row: Mapping[str, Any],
+            contacts_by_user: Optional[Mapping[int, List[Mapping]]] = None,
+            fields: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+        """
+        Same as as_dict, but for a row of the user table as returned by the
+        database driver. The contacts are dumped if the contact rows,
+        grouped by user id, are given.
+        """
+        res = {name: row[name] for name in fields or cls.DICT_FIELDS}
+        if 'created_at' in res:
+            res['created_at'] = isoformat(res['created_at'])
+
+        if contacts_by_user is not None:
+            res['contacts'] = [Contact.row_as_dict(c)
+                               for c in contacts_by_user.get(row['id'], ())]
+
+        return res
+
+
+def get_composite_index_sql() -> str:
+    """
+    Returns the statements creating the indexes spanning several columns
+    listed by the models in COMPOSITE_INDEXES, which tortoise can't declare
+    """
+    statements = []
+    for model in (User, Contact):
+        table = model._meta.table
+        for columns in model.COMPOSITE_INDEXES:
+            statements.append(
+                'CREATE INDEX IF NOT EXISTS "{table}_{name}_idx" ON "{table}" '
+                '({columns});'.format(table=table, name='_'.join(columns),
+                                      columns=', '.join(columns)))
+    return ' '.join(statements)
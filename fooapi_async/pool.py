@@ -0,0 +1,281 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from time import perf_counter
+from typing import (
+    Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional,
+    Sequence)
+
+from tortoise.backends.base.client import ConnectionWrapper
+from tortoise.backends.base.config_generator import expand_db_url
+
+from .tracing import record_statement
+
+
+# engines replacing the single-connection tortoise clients
+POOLED_ENGINES = {
+    'tortoise.backends.asyncpg': 'fooapi_async.backends.asyncpg',
+    'tortoise.backends.sqlite': 'fooapi_async.backends.sqlite',
+}
+
+# open pools by connection name, to monitor their saturation
+pools = {}  # type: Dict[str, ConnectionPool]
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Bounded pool of database connections. Connections are opened on demand
+    up to max_size, and acquiring one waits at most acquire_timeout seconds
+    for another to be released.
+    """
+
+    def __init__(self, connect: Callable[[], Awaitable[Any]],
+                 disconnect: Callable[[Any], Awaitable[None]],
+                 min_size: int, max_size: int,
+                 acquire_timeout: float) -> None:
+        self.min_size = min(min_size, max_size)
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self._connect = connect
+        self._disconnect = disconnect
+        self._idle = deque()
+        # connections open or being opened
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+        self._released = asyncio.Condition()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def in_use(self) -> int:
+        return self._in_use
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    @property
+    def saturation(self) -> float:
+        """
+        Share of the maximum number of connections in use, 1 meaning that
+        further requests for a connection have to wait
+        """
+        return self._in_use / self.max_size
+
+    async def open(self) -> None:
+        while self._size < self.min_size:
+            self._size += 1
+            try:
+                self._idle.append(await self._connect())
+            except BaseException:
+                self._size -= 1
+                raise
+
+    async def close(self) -> None:
+        """
+        Closes the idle connections, the ones in use are closed as they're
+        released
+        """
+        self._closed = True
+        while self._idle:
+            self._size -= 1
+            await self._disconnect(self._idle.pop())
+
+    async def get(self) -> Any:
+        """
+        Takes a connection, which must be given back with release
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.acquire_timeout
+
+        async with self._released:
+            self._waiting += 1
+            try:
+                while not self._idle and self._size >= self.max_size:
+                    try:
+                        await asyncio.wait_for(self._released.wait(),
+                                               deadline - loop.time())
+                    except asyncio.TimeoutError:
+                        raise PoolTimeoutError(
+                            'No database connection was released in '
+                            f'{self.acquire_timeout} seconds') from None
+            finally:
+                self._waiting -= 1
+
+            self._in_use += 1
+            if self._idle:
+                # the most recently used connection is the likeliest to be
+                # still alive
+                return self._idle.pop()
+            self._size += 1
+
+        try:
+            return await self._connect()
+        except BaseException:
+            await self._discard()
+            raise
+
+    async def release(self, connection: Any) -> None:
+        if self._closed:
+            await self._disconnect(connection)
+            await self._discard()
+            return
+
+        self._in_use -= 1
+        self._idle.append(connection)
+        async with self._released:
+            self._released.notify()
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[Any]:
+        connection = await self.get()
+        try:
+            yield connection
+        finally:
+            await self.release(connection)
+
+    async def _discard(self) -> None:
+        self._in_use -= 1
+        self._size -= 1
+        async with self._released:
+            self._released.notify()
+
+
+class PooledClientMixin:
+    """
+    Replaces the single connection (and the lock serializing its use) of a
+    tortoise client with a pool: every statement borrows a connection and
+    every transaction holds one until it's finished. The client classes
+    implement _connect and _disconnect.
+    """
+
+    def _init_pool_options(self, min_size: int, max_size: int,
+                           acquire_timeout: float,
+                           statement_timeout: float) -> None:
+        self._pool_options = (min_size, max_size, acquire_timeout)
+        self.statement_timeout = statement_timeout
+        self._pool = None  # type: Optional[ConnectionPool]
+
+    async def _connect(self, with_db: bool) -> Any:
+        raise NotImplementedError()
+
+    async def _disconnect(self, connection: Any) -> None:
+        raise NotImplementedError()
+
+    async def fetch_rows(self, query: str) -> Sequence[Any]:
+        """
+        Executes the query and returns the rows as the driver produces them:
+        immutable tuples which can also be indexed by column name, rather
+        than the dicts execute_query copies every row into
+        """
+        with _timed_statement(query):
+            return await self._fetch_rows(query)
+
+    async def _fetch_rows(self, query: str) -> Sequence[Any]:
+        raise NotImplementedError()
+
+    async def execute_insert(self, query: str, values: list) -> Any:
+        with _timed_statement(query):
+            return await super().execute_insert(query, values)
+
+    async def execute_query(self, query: str) -> List[Any]:
+        with _timed_statement(query):
+            return await super().execute_query(query)
+
+    async def execute_script(self, query: str) -> None:
+        with _timed_statement(query):
+            await super().execute_script(query)
+
+    async def create_connection(self, with_db: bool) -> None:
+        async def connect() -> Any:
+            return await self._connect(with_db)
+
+        self._pool = ConnectionPool(connect, self._disconnect,
+                                    *self._pool_options)
+        await self._pool.open()
+        pools[self.connection_name] = self._pool
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            await self._pool.close()
+            pools.pop(self.connection_name, None)
+            self._pool = None
+
+    def acquire_connection(self) -> Any:
+        return self._pool.acquire()
+
+    def _in_transaction(self) -> Any:
+        return self._transaction_class(self.connection_name, self._pool)
+
+
+class PooledTransactionMixin:
+    """
+    Makes a tortoise transaction wrapper take a connection from the pool
+    when it starts and give it back when it's finished
+    """
+
+    def __init__(self, connection_name: str, pool: ConnectionPool) -> None:
+        super().__init__(connection_name, None, asyncio.Lock())
+        self._pool = pool
+
+    def acquire_connection(self) -> ConnectionWrapper:
+        return ConnectionWrapper(self._connection, self._lock)
+
+    async def start(self) -> None:
+        self._connection = await self._pool.get()
+        try:
+            await super().start()
+        except BaseException:
+            await self._release()
+            raise
+
+    async def commit(self) -> None:
+        try:
+            await super().commit()
+        finally:
+            await self._release()
+
+    async def rollback(self) -> None:
+        try:
+            await super().rollback()
+        finally:
+            await self._release()
+
+    async def _release(self) -> None:
+        if self._connection is not None:
+            await self._pool.release(self._connection)
+            self._connection = None
+
+
+@contextmanager
+def _timed_statement(query: str) -> Iterator[None]:
+    """
+    Records the time taken by a statement, including the wait for a
+    connection, in the trace of the current request
+    """
+    started = perf_counter()
+    try:
+        yield
+    finally:
+        record_statement(query, perf_counter() - started)
+
+
+def pooled_db_config(db_uri: str, **pool_options: Any) -> Dict[str, Any]:
+    """
+    Expands the database URI into a tortoise connection config that uses
+    the pooled client of the backend, if there's one
+    """
+    config = expand_db_url(db_uri)
+    engine = POOLED_ENGINES.get(config['engine'])
+    if engine is not None:
+        config['engine'] = engine
+        config['credentials'].update(pool_options)
+    return config
@@ -0,0 +1,71 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from itertools import cycle
+from time import time
+from typing import Iterator, List, Optional, Type
+
+from tortoise import Model, Tortoise
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+
+# round-robin over the names of the replica connections, None without any
+_replicas = None  # type: Optional[Iterator[str]]
+
+# seconds after a write during which the client reads from the primary
+_stickiness = 0.0
+
+# name of the connection the reads of the current request are routed to,
+# None for the primary
+_read_connection = ContextVar('read_connection', default=None)
+
+
+def configure(replica_names: List[str], stickiness: float = 0) -> None:
+    """
+    Sets the connections to route the reads to, and for how many seconds
+    a client who wrote reads from the primary
+    """
+    global _replicas, _stickiness
+    _replicas = cycle(replica_names) if replica_names else None
+    _stickiness = stickiness
+
+
+def enabled() -> bool:
+    return _replicas is not None
+
+
+def begin_reads(last_write: Optional[float]) -> None:
+    """
+    Picks the connection for the reads of the current request: the next
+    replica, or the primary if the client making the request wrote at the
+    given UNIX time and the replicas may not have caught up yet
+    """
+    name = None
+    if _replicas is not None and (
+            last_write is None or last_write + _stickiness <= time()):
+        name = next(_replicas)
+    _read_connection.set(name)
+
+
+@contextmanager
+def primary_reads() -> Iterator[None]:
+    """
+    Routes the reads made within the block to the primary
+    """
+    token = _read_connection.set(None)
+    try:
+        yield
+    finally:
+        _read_connection.reset(token)
+
+
+def read_db(model: Type[Model]) -> BaseDBAsyncClient:
+    """
+    Returns the connection to read the model from, the primary being used
+    inside transactions
+    """
+    db = model._meta.db
+    name = _read_connection.get()
+    if name is None or \
+            db is not Tortoise.get_connection(model._meta.default_connection):
+        return db
+    return Tortoise.get_connection(name)
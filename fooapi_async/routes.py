@@ -1,12 +1,22 @@
 from .api import (
+    BatchHandler,
     UsersHandler,
     ContactsHandler,
+    ContactsByIdsHandler,
+    ContactLookupHandler,
     SingleContactHandler,
-    SingleUserHandler)
+    SingleUserHandler,
+    UserExportHandler,
+    UserImportHandler)
 
 routes = [
     (r'/api/users/(\d+)/contacts', ContactsHandler),
     (r'/api/users/(\d+)', SingleUserHandler),
+    (r'/api/users/import', UserImportHandler),
+    (r'/api/contacts/lookup', ContactLookupHandler),
     (r'/api/contacts/(\d+)', SingleContactHandler),
     (r'/api/users', UsersHandler),
+    (r'/api/contacts', ContactsByIdsHandler),
+    (r'/api/export/users', UserExportHandler),
+    (r'/api/batch', BatchHandler),
 ]
@@ -0,0 +1,55 @@
+from json import dumps as json_dumps
+from typing import Any, Dict, Iterable
+
+from .tracing import traced
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+JSON_CONTENT_TYPE = 'application/json; charset=UTF-8'
+
+
+def _orjson_dumps(obj: Any) -> bytes:
+    return orjson.dumps(obj)
+
+
+def _json_dumps(obj: Any) -> bytes:
+    # compact and UTF-8 encoded, to produce the same output as orjson
+    return json_dumps(obj, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf8')
+
+
+# encodes to JSON bytes, using orjson when it's installed since it's several
+# times faster than the json module on large responses
+_encode = _orjson_dumps if orjson is not None else _json_dumps
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Encodes a response to JSON bytes
+    """
+    with traced('serialization'):
+        return _encode(obj)
+
+
+def dumps_page(page: Dict[str, Any], results: Iterable[Any]) -> bytes:
+    """
+    Encodes the page (its total, cursor...) with the results added as a
+    JSON array under "result". The results are encoded one at a time as
+    they're produced, so that the dicts representing a large page are never
+    all held in memory at once.
+    """
+    with traced('serialization'):
+        buf = bytearray(_encode(page))
+        buf[-1:] = b',"result":[' if page else b'"result":['
+        first = True
+        for result in results:
+            if not first:
+                buf += b','
+            buf += _encode(result)
+            first = False
+        buf += b']}'
+        return bytes(buf)
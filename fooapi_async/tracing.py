@@ -0,0 +1,114 @@
+import re
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Dict, Optional
+from uuid import uuid4
+
+from tornado.log import app_log
+
+
+# route label of the requests no route matched
+UNMATCHED_ROUTE = 'unmatched'
+
+# request ids accepted from the X-Request-Id header, e.g. set by a proxy;
+# others are replaced, since the id ends up in the logs
+_REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9._:-]{1,64}$')
+
+# statements taking at least this many seconds are logged, configured by
+# init_settings
+_slow_statement_threshold = None  # type: Optional[float]
+
+
+def configure(slow_statement_threshold: Optional[float]) -> None:
+    global _slow_statement_threshold
+    _slow_statement_threshold = slow_statement_threshold
+
+
+class RequestTrace:
+    """
+    Where the time serving a request went: the statements sent to the
+    database, counted by the pooled clients, and the spans of the other
+    phases (validation, serialization) traced with traced
+    """
+    __slots__ = ('route', 'request_id', 'db_statements', 'db_time', 'spans')
+
+    def __init__(self, route: str, request_id: str) -> None:
+        self.route = route
+        self.request_id = request_id
+        self.db_statements = 0
+        self.db_time = 0.0
+        self.spans = {}  # type: Dict[str, float]
+
+    def server_timing(self) -> str:
+        """
+        Value of the Server-Timing header reporting the trace, in
+        milliseconds
+        """
+        metrics = ['db;dur={:.3f};desc="{} statements"'.format(
+            1000 * self.db_time, self.db_statements)]
+        metrics.extend(f'{name};dur={1000 * duration:.3f}'
+                       for name, duration in self.spans.items())
+        return ', '.join(metrics)
+
+
+# trace of the request being served
+_request_trace = ContextVar('request_trace', default=None)
+
+
+def begin_request(route: str,
+                  request_id: Optional[str] = None) -> RequestTrace:
+    """
+    Starts tracing the current request, under the given request id if it's
+    acceptable, otherwise under a new one
+    """
+    if request_id is None or not _REQUEST_ID_RE.match(request_id):
+        request_id = uuid4().hex
+    trace = RequestTrace(route, request_id)
+    _request_trace.set(trace)
+    return trace
+
+
+def resume(trace: RequestTrace) -> None:
+    """
+    Makes the trace current again in code that runs outside the context
+    the request was begun in, e.g. the data_received of a streaming handler
+    """
+    _request_trace.set(trace)
+
+
+def record_statement(query: str, duration: float) -> None:
+    trace = _request_trace.get()
+    if trace is not None:
+        trace.db_statements += 1
+        trace.db_time += duration
+        route, request_id = trace.route, trace.request_id
+    else:
+        route = request_id = '-'
+
+    if _slow_statement_threshold is not None and \
+            duration >= _slow_statement_threshold:
+        app_log.warning('Slow statement (%.2fms, route %s, request %s): %s',
+                        1000 * duration, route, request_id, query)
+    else:
+        app_log.debug('Statement (%.2fms, route %s, request %s): %s',
+                      1000 * duration, route, request_id, query)
+
+
+class traced:
+    """
+    Context manager adding the time spent in its block to the named span
+    of the current request's trace
+    """
+    __slots__ = ('name', '_started')
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self) -> None:
+        self._started = perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        trace = _request_trace.get()
+        if trace is not None:
+            trace.spans[self.name] = trace.spans.get(self.name, 0) + \
+                perf_counter() - self._started
@@ -1,12 +1,17 @@
 from functools import wraps
+from hashlib import sha1
+from json import loads
+from typing import Any, Mapping, Optional, Sequence
 
 from pydantic import ValidationError
+from pydantic.error_wrappers import ErrorWrapper
+from tornado.httputil import HTTPServerRequest
 
 from .auth_utils import (
     AuthorizationError,
-    ensure_can_edit_contact,
     ensure_can_edit_user)
-from .validation_schemata import Headers
+from .cursors import encode_cursor
+from .models import isoformat
 
 
 def http_code_on_exception(http_code, exc, message_factory=lambda e: str(e)):
@@ -17,7 +22,7 @@ def http_code_on_exception(http_code, exc, message_factory=lambda e: str(e)):
                 await method(self, *args, **kwargs)
             except exc as e:
                 self.set_status(http_code)
-                self.write({'result': message_factory(e)})
+                self.write_json({'result': message_factory(e)})
         return new_meth
     return wrapper
 
@@ -37,30 +42,11 @@ def unathorized_on_authorization_error(method):
 def ensure_user_contacts_can_be_edited(method):
     @wraps(method)
     async def wrapper(self, user_id, *args, **kwargs):
-        headers = Headers.parse_obj(dict(self.request.headers.items()))
-        await ensure_can_edit_user(int(user_id), headers.creator_id)
+        await ensure_can_edit_user(int(user_id), self.current_user)
         await method(self, user_id, *args, **kwargs)
     return wrapper
 
 
-def ensure_user_can_be_edited(method):
-    @wraps(method)
-    async def wrapper(self, user_id, *args, **kwargs):
-        headers = Headers.parse_obj(dict(self.request.headers.items()))
-        await ensure_can_edit_user(int(user_id), headers.creator_id)
-        await method(self, user_id, *args, **kwargs)
-    return wrapper
-
-
-def ensure_contact_can_be_edited(method):
-    @wraps(method)
-    async def wrapper(self, contact_id, *args, **kwargs):
-        headers = Headers.parse_obj(dict(self.request.headers.items()))
-        await ensure_can_edit_contact(int(contact_id), headers.creator_id)
-        await method(self, contact_id, *args, **kwargs)
-    return wrapper
-
-
 def prepare_request_arguments(args):
     """
     Flattens request arguments by taking only the first value for each
@@ -71,3 +57,38 @@ def prepare_request_arguments(args):
         if isinstance(v, bytes):
             args[k] = v.decode('utf8')
     return args
+
+
+def is_json_request(request: HTTPServerRequest) -> bool:
+    content_type = request.headers.get('Content-Type', '')
+    return content_type.split(';')[0].strip() == 'application/json'
+
+
+def prepare_json_body(body: bytes) -> Any:
+    """
+    Decodes a JSON request body, reporting malformed JSON the same way
+    pydantic's parse_raw does
+    """
+    try:
+        return loads(body)
+    except (ValueError, TypeError, UnicodeDecodeError) as e:
+        raise ValidationError([ErrorWrapper(e, loc='__obj__')])
+
+
+def next_page_cursor(rows: Sequence[Mapping[str, Any]],
+                     limit: int) -> Optional[str]:
+    """
+    Returns the cursor pointing past the last row of a keyset page or None
+    when the page wasn't full, i.e. there's nothing left to fetch
+    """
+    if len(rows) < limit:
+        return None
+    return encode_cursor(isoformat(rows[-1]['created_at']), rows[-1]['id'])
+
+
+def make_etag(*parts: Any) -> str:
+    """
+    Builds a strong ETag from the values identifying a version of a
+    resource, e.g. the ids, creation times and versions of its rows
+    """
+    return '"{}"'.format(sha1(repr(parts).encode('utf8')).hexdigest())
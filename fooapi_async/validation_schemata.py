@@ -1,18 +1,26 @@
 import re
+from datetime import datetime, timezone
+from hashlib import sha256
 from typing import Dict, Any
 from os.path import expanduser
-from typing import Optional
+from enum import Enum
+from typing import List, Optional, Tuple
 
 import phonenumbers
 from pydantic import (
     BaseModel,
     validator,
+    PositiveFloat,
     PositiveInt,
     EmailStr,
+    Schema,
     BaseSettings,
     constr)
 from jwt import decode as jwt_decode, InvalidTokenError
 
+from .caches import LRUCache, phone_number_cache
+from .cursors import decode_cursor
+from .tracing import traced
 from .models import (
     ContactTypeNameEnum,
     Contact as ContactModel,
@@ -20,13 +28,31 @@ from .models import (
     ContactTypeEnum)
 
 
+# sha256 digest of a verified JWT -> creator id, configured by init_settings
+jwt_cache = LRUCache()
+# valid emails -> validated email, configured by init_settings; like
+# parsing phone numbers (see phone_number_cache), validating them is a pure
+# but costly function of the input, and the same contacts are written over
+# and over by the clients syncing them. Invalid values aren't cached, so
+# they can't evict the valid ones.
+email_cache = LRUCache()
+
+# reference to the id of a user or a contact created by an earlier
+# operation of a batch, e.g. users/$0
+BATCH_REFERENCE_RE = re.compile(r'\b(users|contacts)/\$(\d+)')
+
+
 class EmailOrEmptyStr(EmailStr):
     @classmethod
     def validate(cls, value: str) -> str:
         if isinstance(value, str) and not len(value):
             return value
 
-        return super().validate(value)
+        email = email_cache.get(value)
+        if email is None:
+            email = super().validate(value)
+            email_cache.set(value, email)
+        return email
 
 
 class PhoneNumberStr(str):
@@ -43,6 +69,9 @@ class PhoneNumberStr(str):
         if not len(v):
             return v
 
+        if phone_number_cache.get(v) is not None:
+            return v
+
         try:
             num = phonenumbers.parse(v)
         except phonenumbers.phonenumberutil.NumberParseException as e:
@@ -51,12 +80,26 @@ class PhoneNumberStr(str):
         if not phonenumbers.is_possible_number(num):
             raise ValueError('Such phone number is impossible.')
 
+        phone_number_cache.set(v, phonenumbers.format_number(
+            num, phonenumbers.PhoneNumberFormat.E164))
         return v
 
 
-class LimitOffset(BaseModel):
+class RequestModel(BaseModel):
+    """
+    Model of request data, whose validation is traced
+    """
+
+    @classmethod
+    def parse_obj(cls, obj: Any) -> 'RequestModel':
+        with traced('validation'):
+            return super().parse_obj(obj)
+
+
+class LimitOffset(RequestModel):
     limit: Optional[PositiveInt] = None
     offset: PositiveInt = None
+    cursor: str = None
 
     @validator('limit', always=True)
     def validate_limit(cls, v: int, **kwargs) -> int:
@@ -71,8 +114,128 @@ class LimitOffset(BaseModel):
                 f'limit must not be greater than {settings.paging_max_limit}')
         return v
 
+    @validator('cursor')
+    def validate_cursor(cls, v: str, values: Dict[str, Any],
+                        **kwargs) -> Tuple:
+        if values.get('offset') is not None:
+            raise ValueError('cursor and offset are mutually exclusive')
+
+        # an empty cursor requests the first page in keyset mode
+        if not len(v):
+            return ()
+
+        return decode_cursor(v)
+
+
+class UserFilter(LimitOffset):
+    """
+    Narrows down the list of users, paginated as usual
+    """
+    name_prefix: constr(min_length=1, max_length=UserModel.NAME_MAX_LEN) = None
+    created_after: datetime = None
+    created_before: datetime = None
+    creator_id: PositiveInt = None
+
+    @validator('created_after', 'created_before')
+    def validate_created(cls, v: datetime, **kwargs) -> datetime:
+        # the creation times are stored as naive UTC
+        if v.tzinfo is not None:
+            v = v.astimezone(timezone.utc).replace(tzinfo=None)
+        return v
+
+    @validator('created_before')
+    def validate_created_range(cls, v: datetime, values: Dict[str, Any],
+                               **kwargs) -> datetime:
+        created_after = values.get('created_after')
+        if created_after is not None and created_after >= v:
+            raise ValueError('created_before must be later than created_after')
+        return v
+
 
-class Contact(BaseModel):
+def _split_names(v: str) -> Tuple[str, ...]:
+    # comma-separated list, as in ?fields=id,name
+    return tuple(dict.fromkeys(n.strip() for n in v.split(',') if n.strip()))
+
+
+class Ids(RequestModel):
+    """
+    Ids of the rows fetched at once, as in ?ids=1,2,3
+    """
+    ids: str = None
+
+    @validator('ids')
+    def validate_ids(cls, v: str, **kwargs) -> Tuple[int, ...]:
+        # avoid cyclical import
+        from .app import settings
+
+        names = _split_names(v)
+        if not names:
+            raise ValueError('At least one id must be requested')
+        if not all(n.isdigit() and int(n) > 0 for n in names):
+            raise ValueError('ids must be positive integers')
+        ids = tuple(dict.fromkeys(int(n) for n in names))
+        if len(ids) > settings.paging_max_limit:
+            raise ValueError(
+                'At most {} ids can be requested'.format(
+                    settings.paging_max_limit))
+        return ids
+
+
+class RequiredIds(Ids):
+    ids: str = ...
+
+
+class UserRepresentation(RequestModel):
+    """
+    Selects the fields of the user representation. Unless specific fields
+    are requested, all of them are returned along with the contacts.
+    """
+    # "fields" is taken by BaseModel
+    field_names: str = Schema(None, alias='fields')
+    include: str = None
+    contacts_limit: PositiveInt = None
+
+    @validator('field_names')
+    def validate_fields(cls, v: str, **kwargs) -> Tuple[str, ...]:
+        fields = _split_names(v)
+        if not fields:
+            raise ValueError('At least one field must be requested')
+
+        unknown = [f for f in fields if f not in UserModel.DICT_FIELDS]
+        if unknown:
+            raise ValueError(f'Unknown fields: {", ".join(unknown)}')
+        return fields
+
+    @validator('include')
+    def validate_include(cls, v: str, **kwargs) -> Tuple[str, ...]:
+        include = _split_names(v)
+        unknown = [i for i in include if i != 'contacts']
+        if unknown:
+            raise ValueError(f'Unknown relations: {", ".join(unknown)}')
+        return include
+
+    @validator('contacts_limit')
+    def validate_contacts_limit(cls, v: int, **kwargs) -> int:
+        # avoid cyclical import
+        from .app import settings
+
+        if v > settings.paging_max_limit:
+            raise ValueError(
+                'contacts_limit must not be greater than '
+                f'{settings.paging_max_limit}')
+        return v
+
+    @property
+    def with_contacts(self) -> bool:
+        return self.field_names is None or 'contacts' in (self.include or ())
+
+    @property
+    def is_default(self) -> bool:
+        return self.field_names is None and self.include is None and \
+            self.contacts_limit is None
+
+
+class Contact(RequestModel):
     phone_no: PhoneNumberStr = ''
     email: EmailOrEmptyStr = ''
     type: ContactTypeNameEnum = ...
@@ -108,23 +271,125 @@ class Contact(BaseModel):
         anystr_strip_whitespace = True
 
 
-class User(BaseModel):
+def _check_bulk_contact_count(contacts: List[Contact]) -> List[Contact]:
+    # avoid cyclical import
+    from .app import settings
+
+    if len(contacts) > settings.bulk_max_contacts:
+        raise ValueError(
+            f'At most {settings.bulk_max_contacts} contacts can be '
+            'created at once')
+    return contacts
+
+
+class ContactList(RequestModel):
+    contacts: List[Contact] = ...
+
+    @validator('contacts', whole=True)
+    def validate_contact_count(cls, v: List[Contact],
+                               **kwargs) -> List[Contact]:
+        if not len(v):
+            raise ValueError('At least one contact must be provided')
+        return _check_bulk_contact_count(v)
+
+
+class ContactLookup(RequestModel):
+    phone_no: PhoneNumberStr = ''
+    email: EmailOrEmptyStr = ''
+
+    @validator('email', always=True)
+    def validate_email(cls, v: str, values: Dict[str, Any], **kwargs) -> str:
+        if bool(v) == bool(values.get('phone_no')):
+            raise ValueError('Either phone_no or email must be given')
+        return v
+
+    class Config:
+        anystr_strip_whitespace = True
+
+
+class User(RequestModel):
     name: constr(min_length=1, max_length=UserModel.NAME_MAX_LEN,
                  strip_whitespace=True) = ...
 
 
-class Headers(BaseModel):
+class UserImport(User):
+    contacts: List[Contact] = []
+
+    @validator('contacts', whole=True)
+    def validate_contact_count(cls, v: List[Contact],
+                               **kwargs) -> List[Contact]:
+        return _check_bulk_contact_count(v)
+
+
+class ExportFormatEnum(str, Enum):
+    ndjson = 'ndjson'
+    csv = 'csv'
+
+
+class Export(RequestModel):
+    format: ExportFormatEnum = ExportFormatEnum.ndjson
+
+
+class BatchMethodEnum(str, Enum):
+    post = 'POST'
+    put = 'PUT'
+    delete = 'DELETE'
+
+
+class BatchOperation(RequestModel):
+    method: BatchMethodEnum = ...
+    # may refer to the id created by an earlier operation of the batch as
+    # $<index of the operation>, e.g. /api/users/$0/contacts
+    path: str = ...
+    body: Any = None
+
+
+class Batch(RequestModel):
+    operations: List[BatchOperation] = ...
+    # all or nothing: the operations are executed in one transaction
+    atomic: bool = True
+
+    @validator('operations', whole=True)
+    def validate_operations(cls, v: List[BatchOperation],
+                            **kwargs) -> List[BatchOperation]:
+        # avoid cyclical import
+        from .app import settings
+
+        if not len(v):
+            raise ValueError('At least one operation must be provided')
+
+        if len(v) > settings.batch_max_operations:
+            raise ValueError(
+                f'At most {settings.batch_max_operations} operations can be '
+                'executed at once')
+
+        for index, operation in enumerate(v):
+            for _, reference in BATCH_REFERENCE_RE.findall(operation.path):
+                if int(reference) >= index:
+                    raise ValueError(
+                        f'Operation {index} can only refer to the earlier '
+                        'operations')
+        return v
+
+
+class Headers(RequestModel):
     Authorization: str = ...
 
     @validator('Authorization', always=True)
     def validate_jwt_token(cls, v: str, values: Dict[str, Any], **kwargs) -> str:
         match = re.fullmatch(r'Bearer (?P<jwt>[A-Za-z0-9.\-_=]+)', v)
         try:
-            # avoid cyclical import
-            from .app import settings
-            jwt = jwt_decode(match['jwt'], settings.pub_key,
-                             algorithms='RS256')
-            values['creator_id'] = jwt['id']
+            token_hash = sha256(match['jwt'].encode('ascii')).digest()
+            creator_id = jwt_cache.get(token_hash)
+            if creator_id is None:
+                # avoid cyclical import
+                from .app import settings
+                jwt = jwt_decode(match['jwt'], settings.pub_key,
+                                 algorithms='RS256')
+                creator_id = jwt['id']
+                jwt_cache.set(token_hash, creator_id,
+                              expires_at=jwt.get('exp'))
+            values['creator_id'] = creator_id
             return v
         except (InvalidTokenError, ValueError, TypeError):
             raise ValueError('Error while extracting creator id from JWT')
@@ -138,6 +403,61 @@ class Settings(BaseSettings):
     pub_key: str = ...
     priv_key: str = None
     paging_max_limit: PositiveInt = ...
+    # the connection pool of every worker process, so the database gets up
+    # to workers * db_pool_max_size connections; statements running for
+    # longer than db_statement_timeout seconds are cancelled
+    db_pool_min_size: int = 1
+    db_pool_max_size: PositiveInt = 10
+    db_pool_acquire_timeout: PositiveFloat = 5
+    db_statement_timeout: PositiveFloat = 30
+    # read-only replicas of db_uri, which the GET endpoints read from in
+    # turn; a client who wrote within replica_stickiness seconds reads from
+    # the primary instead, which is tracked with a cookie signed with
+    # replica_cookie_secret (the same for all the worker processes)
+    replica_db_uris: List[str] = []
+    replica_stickiness: PositiveFloat = 5
+    replica_cookie_secret: Optional[str] = None
+    # verified tokens are cached so that the signature of a token reused by
+    # a client is only checked once per TTL; a zero size disables the cache
+    jwt_cache_size: int = 4096
+    jwt_cache_ttl: PositiveInt = 300
+    # validated phone numbers and emails kept by every worker process; a
+    # zero size disables the caches
+    validation_cache_size: int = 10000
+    # encoded single user/contact responses, including 404s; every worker
+    # process has its own cache, so the TTL bounds how long a write made
+    # through another worker can go unnoticed; a zero size disables it
+    response_cache_size: int = 10000
+    response_cache_ttl: PositiveInt = 30
+    bulk_max_contacts: PositiveInt = 1000
+    batch_max_operations: PositiveInt = 100
+    # users are written by the streaming import in transactions of this
+    # size, or of fewer users if they have this many contacts together
+    import_batch_size: PositiveInt = 500
+    import_batch_max_contacts: PositiveInt = 10000
+    import_max_body_size: PositiveInt = 10 * 1024 ** 3
+    import_max_line_size: PositiveInt = 1024 ** 2
+    import_max_reported_errors: PositiveInt = 100
+    # number of users loaded and written per flush by the export
+    export_batch_size: PositiveInt = 1000
+    # seconds a stopping worker waits for the requests in flight to finish
+    shutdown_timeout: PositiveFloat = 10
+    # /metrics is served on this port plus the index of the worker, so that
+    # every worker process can be scraped; unset, no metrics are served
+    metrics_port: Optional[PositiveInt] = None
+    # statements taking at least this many seconds are logged as warnings
+    # with the route and the id of their request; unset, none are
+    slow_statement_threshold: Optional[PositiveFloat] = 0.5
+    # report where the time of every request went (database, validation,
+    # serialization) in a Server-Timing header
+    server_timing: bool = False
+
+    @validator('replica_cookie_secret', always=True)
+    def validate_replica_cookie_secret(cls, v: str, values: Dict[str, Any],
+                                       **kwargs) -> str:
+        if values.get('replica_db_uris') and not v:
+            raise ValueError('A secret is required to use replicas')
+        return v
 
     @validator('pub_key')
     def read_public_key(cls, v: str) -> str:
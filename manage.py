@@ -4,7 +4,8 @@ from os.path import expanduser
 from tornado.ioloop import IOLoop
 import jwt
 
-from fooapi_async.app import run, create_schema, init_settings, drop_schema
+from fooapi_async.app import (
+    run, create_schema, init_settings, drop_schema, backfill_contacts)
 
 parser = ArgumentParser()
 parser.add_argument('--settings-file', type=str, required=True)
@@ -12,17 +13,27 @@ parser.add_argument('--settings-file', type=str, required=True)
 subparsers = parser.add_subparsers(dest='subcommand')
 
 run_parser = subparsers.add_parser('run')
+run_parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes to fork')
 
 init_db_parser = subparsers.add_parser('init-db')
 
 create_jwt_parser = subparsers.add_parser('create-jwt')
 create_jwt_parser.add_argument('creator_id', type=int)
 
+backfill_contacts_parser = subparsers.add_parser(
+    'backfill-contacts',
+    help='fill in the normalized phone numbers and emails of the contacts '
+         'written before they were added')
+backfill_contacts_parser.add_argument('--batch-size', type=int, default=1000,
+                                      help='number of contacts per '
+                                           'transaction')
+
 
 if __name__ == '__main__':
     args = parser.parse_args()
     if args.subcommand == 'run':
-        run(args.settings_file)
+        run(args.settings_file, args.workers)
     elif args.subcommand == 'init-db':
         async def run_create_schema():
             init_settings(args.settings_file)
@@ -39,3 +50,8 @@ if __name__ == '__main__':
         token = jwt.encode({'id': args.creator_id}, key,
                            algorithm='RS256')
         print(token)
+    elif args.subcommand == 'backfill-contacts':
+        init_settings(args.settings_file)
+        updated = IOLoop.current().run_sync(
+            lambda: backfill_contacts(args.batch_size))
+        print(f'{updated} contacts updated')
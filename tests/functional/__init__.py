@@ -1,5 +1,7 @@
 import json
+from contextlib import ExitStack, contextmanager
 from os.path import expanduser
+from unittest import mock
 from urllib.parse import urlencode
 from typing import Dict, Any
 
@@ -12,7 +14,9 @@ from fooapi_async.app import (
     make_app,
     init_db,
     close_db_connections,
+    generate_schemas,
     init_settings)
+from fooapi_async.caches import contact_responses, user_responses
 from fooapi_async.routes import routes
 from fooapi_async.models import User, Contact
 from tests.functional.db_fixtures import fixtures
@@ -29,6 +33,8 @@ class BaseTest(AsyncHTTPTestCase):
     def setUp(self) -> None:
         super().setUp()
         self.io_loop.run_sync(init_db_and_apply_db_fixtures)
+        user_responses.clear()
+        contact_responses.clear()
 
     def tearDown(self) -> None:
         self.io_loop.run_sync(close_db_connections)
@@ -49,13 +55,56 @@ class BaseTest(AsyncHTTPTestCase):
             res = json.loads(response.body)
             self.assertEqual(ret_data, res)
 
-    def _create_token(self, creator_id: int) -> str:
+    def _create_token(self, creator_id: int, **claims) -> str:
         from fooapi_async.app import settings
         with open(expanduser(settings.priv_key), 'r') as f:
             priv_key = f.read()
-        return jwt.encode({'id': creator_id}, priv_key,
+        return jwt.encode({'id': creator_id, **claims}, priv_key,
                           algorithm='RS256').decode('utf8')
 
+    @contextmanager
+    def override_settings(self, **overrides):
+        from fooapi_async.app import settings
+        originals = {name: getattr(settings, name) for name in overrides}
+        for name, value in overrides.items():
+            setattr(settings, name, value)
+        try:
+            yield settings
+        finally:
+            for name, value in originals.items():
+                setattr(settings, name, value)
+
+    def count_queries(self, url: str, method: str = 'GET',
+                      body: Dict[str, Any] = None,
+                      creator_id: int = None,
+                      headers: Dict[str, str] = None) -> int:
+        """
+        Performs a successful request and returns the number of statements
+        it sent to the database
+        """
+        headers = dict(headers or {})
+        if creator_id is not None:
+            headers['Authorization'] = 'Bearer {}'.format(
+                self._create_token(creator_id))
+        if body is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            body = urlencode(body)
+
+        # patch the client class, so that the statements sent through the
+        # transaction wrappers (subclasses of the client) are counted too
+        client_class = type(Tortoise.get_connection('default'))
+        with ExitStack() as stack:
+            methods = [
+                stack.enter_context(mock.patch.object(
+                    client_class, name, autospec=True,
+                    side_effect=getattr(client_class, name)))
+                for name in ('execute_query', 'execute_insert', 'fetch_rows')
+            ]
+            response = self.fetch(url, method=method, body=body,
+                                  headers=headers, raise_error=False)
+        self.assertLess(response.code, 400)
+        return sum(m.call_count for m in methods)
+
     def do_get_and_assert(self, url: str, status_code: int,
                           ret_data: Dict[str, Any]) -> None:
         self._do_request_and_assert('GET', url, status_code, ret_data)
@@ -71,6 +120,21 @@ class BaseTest(AsyncHTTPTestCase):
         self._do_request_and_assert('POST', url, status_code, ret_data, body,
                                     headers)
 
+    def do_post_json_and_assert(self, url: str, status_code: int,
+                                ret_data: Dict[str, Any], body: Any,
+                                creator_id: int = None) -> None:
+        headers = {'Content-Type': 'application/json'}
+        if creator_id is not None:
+            headers['Authorization'] = 'Bearer {}'.format(
+                self._create_token(creator_id))
+
+        response = self.fetch(url, method='POST', body=json.dumps(body),
+                              headers=headers, raise_error=False)
+        self.assertEqual(response.code, status_code)
+
+        if ret_data is not None:
+            self.assertEqual(ret_data, json.loads(response.body))
+
     def do_put_and_assert(self, url: str, status_code: int,
                           ret_data: Dict[str, Any], body: Dict[str, Any],
                           creator_id: int) -> None:
@@ -96,11 +160,11 @@ class BaseTest(AsyncHTTPTestCase):
 async def init_db_and_apply_db_fixtures() -> None:
     from fooapi_async.app import settings
     await init_db(settings)
-    await Tortoise.generate_schemas()
+    await generate_schemas()
 
     for item in fixtures:
         user = await User.create(name=item['name'],
                                  creator_id=item['creator_id'],
                                  created_at=item['created_at'])
         for c in item['contacts']:
-            await Contact.create(**c, user=user)
+            await Contact.create(**Contact.normalized(c), user=user)
@@ -1,4 +1,27 @@
-from tests.functional import BaseTest
+import json
+from time import time
+from typing import Any, Dict, List
+from unittest import mock
+from urllib.parse import urlencode
+
+import phonenumbers
+from pydantic.types import validate_email
+from pypika import Table
+from tornado.web import Application
+from tortoise import Tortoise
+from tortoise.exceptions import OperationalError
+from tortoise.utils import get_schema_sql
+
+from fooapi_async import (
+    database_operations, serialization, validation_schemata)
+from fooapi_async.app import close_db_connections
+from fooapi_async.caches import contact_responses, user_responses
+from fooapi_async.database_operations import (
+    _owned_contact_criterion, _user_filter_criterion)
+from fooapi_async.validation_schemata import Headers
+from fooapi_async.models import (
+    Contact as ContactModel, User, get_composite_index_sql)
+from tests.functional import BaseTest, init_db_and_apply_db_fixtures
 
 
 class UsersHandlerTest(BaseTest):
@@ -81,6 +104,278 @@ class UsersHandlerTest(BaseTest):
                 ]
             })
 
+    def test_users_paged_by_cursor(self) -> None:
+        response = self.fetch('/api/users?cursor=')
+        self.assertEqual(response.code, 200)
+        first_page = json.loads(response.body)
+        self.assertEqual([u['id'] for u in first_page['result']], [1, 2])
+        self.assertEqual(first_page['total'], 3)
+
+        self.do_get_and_assert(
+            '/api/users?cursor={}'.format(first_page['next_cursor']),
+            200,
+            {
+                'result': [
+                    {
+                        'id': 3,
+                        'name': 'John Doe',
+                        'contacts': [],
+                        'created_at': '2019-01-01T00:00:05'
+                    }
+                ],
+                'total': 3,
+                'next_cursor': None
+            })
+
+    def test_cursor_validated(self) -> None:
+        self.do_get_and_assert(
+            '/api/users?cursor=garbage',
+            400,
+            {
+                'result': [
+                    {
+                        'loc': ['cursor'],
+                        'msg': 'Invalid cursor',
+                        'type': 'value_error'
+                    }
+                ]
+            })
+
+        self.do_get_and_assert(
+            '/api/users?cursor=&offset=1',
+            400,
+            {
+                'result': [
+                    {
+                        'loc': ['cursor'],
+                        'msg': 'cursor and offset are mutually exclusive',
+                        'type': 'value_error'
+                    }
+                ]
+            })
+
+    def test_users_and_total_fetched_in_two_queries(self) -> None:
+        # the page with the total and the contacts prefetch
+        self.assertEqual(self.count_queries('/api/users'), 2)
+        self.assertEqual(self.count_queries('/api/users?cursor='), 2)
+
+    def test_unchanged_users_page_not_modified(self) -> None:
+        etag = self.fetch('/api/users?limit=1').headers['Etag']
+
+        response = self.fetch('/api/users?limit=1',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 304)
+        self.assertEqual(response.body, b'')
+        # only the versions of the page are looked up
+        self.assertEqual(
+            self.count_queries('/api/users?limit=1',
+                               headers={'If-None-Match': etag}),
+            1)
+
+        # the ETag depends on the requested page
+        response = self.fetch('/api/users?limit=2',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+
+    def test_users_page_etag_changed_by_writes(self) -> None:
+        etag = self.fetch('/api/users').headers['Etag']
+        self.do_delete_and_assert(
+            '/api/contacts/1',
+            204,
+            100)
+
+        response = self.fetch('/api/users', headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+        self.assertNotEqual(response.headers['Etag'], etag)
+
+    def test_users_sparse_fieldset(self) -> None:
+        self.do_get_and_assert(
+            '/api/users?fields=name,id',
+            200,
+            {
+                'result': [
+                    {'name': 'Frank Foobar', 'id': 1},
+                    {'name': 'Crash Coredump', 'id': 2}
+                ],
+                'total': 3
+            })
+        # contacts aren't prefetched
+        self.assertEqual(self.count_queries('/api/users?fields=name'), 1)
+
+    def test_users_embedded_contacts_limited(self) -> None:
+        self.do_get_and_assert(
+            '/api/users?fields=id&include=contacts&contacts_limit=1',
+            200,
+            {
+                'result': [
+                    {
+                        'id': 1,
+                        'contacts': [
+                            {
+                                'id': 1,
+                                'phone_no': '111',
+                                'email': '',
+                                'type': 'home',
+                                'created_at': '2019-01-01T00:00:02',
+                            }
+                        ]
+                    },
+                    {'id': 2, 'contacts': []}
+                ],
+                'total': 3
+            })
+
+    def test_users_representation_validated(self) -> None:
+        self.do_get_and_assert(
+            '/api/users?fields=id,password&include=posts',
+            400,
+            {
+                'result': [
+                    {
+                        'loc': ['fields'],
+                        'msg': 'Unknown fields: password',
+                        'type': 'value_error'
+                    },
+                    {
+                        'loc': ['include'],
+                        'msg': 'Unknown relations: posts',
+                        'type': 'value_error'
+                    }
+                ]
+            })
+
+    def test_users_filtered(self) -> None:
+        def ids(query: str) -> List[int]:
+            response = self.fetch(f'/api/users?fields=id&{query}')
+            self.assertEqual(response.code, 200)
+            page = json.loads(response.body)
+            self.assertEqual(page['total'], len(page['result']))
+            return [u['id'] for u in page['result']]
+
+        self.assertEqual(ids('name_prefix=J'), [3])
+        self.assertEqual(ids('name_prefix=Crash%20C'), [2])
+        # the prefix is case-sensitive
+        self.assertEqual(ids('name_prefix=crash'), [])
+        # the last characters before the surrogates and of Unicode
+        self.assertEqual(ids('name_prefix=%ED%9F%BF'), [])
+        self.assertEqual(ids('name_prefix=%F4%8F%BF%BF'), [])
+        self.assertEqual(ids('creator_id=100'), [1])
+        self.assertEqual(ids('created_after=2019-01-01T00:00:01'), [2, 3])
+        self.assertEqual(ids('created_before=2019-01-01T00:00:05'), [1, 2])
+        # aware times are compared in UTC
+        self.assertEqual(
+            ids('created_after=2019-01-01T02:00:03%2B02:00'), [2, 3])
+        self.assertEqual(
+            ids('created_after=2019-01-01T00:00:01'
+                '&created_before=2019-01-01T00:00:05&creator_id=200'),
+            [2])
+
+    def test_filtered_users_paged(self) -> None:
+        self.do_get_and_assert(
+            '/api/users?fields=id&created_after=2019-01-01T00:00:01'
+            '&limit=1&offset=1',
+            200,
+            {'result': [{'id': 3}], 'total': 2})
+        # the total is counted even past the end of the filtered users
+        self.do_get_and_assert(
+            '/api/users?fields=id&name_prefix=Crash&offset=1',
+            200,
+            {'result': [], 'total': 1})
+
+        response = self.fetch('/api/users?fields=id&creator_id=300&cursor=')
+        self.assertEqual(json.loads(response.body), {
+            'result': [{'id': 3}], 'total': 1, 'next_cursor': None})
+
+    def test_users_filters_validated(self) -> None:
+        self.do_get_and_assert(
+            '/api/users?name_prefix=&creator_id=0'
+            '&created_after=2019-01-02T00:00:00'
+            '&created_before=2019-01-01T00:00:00',
+            400,
+            {
+                'result': [
+                    {
+                        'ctx': {'limit_value': 1},
+                        'loc': ['name_prefix'],
+                        'msg': 'ensure this value has at least 1 characters',
+                        'type': 'value_error.any_str.min_length'
+                    },
+                    {
+                        'loc': ['created_before'],
+                        'msg': 'created_before must be later than '
+                               'created_after',
+                        'type': 'value_error'
+                    },
+                    {
+                        'ctx': {'limit_value': 0},
+                        'loc': ['creator_id'],
+                        'msg': 'ensure this value is greater than 0',
+                        'type': 'value_error.number.not_gt'
+                    }
+                ]
+            })
+
+    def test_users_filtered_by_creator_use_composite_index(self) -> None:
+        async def explain() -> list:
+            db = Tortoise.get_connection('default')
+            users_tbl = Table(User._meta.table)
+            qry = db.query_class\
+                .from_(users_tbl)\
+                .select(users_tbl.star)\
+                .where(_user_filter_criterion(users_tbl, creator_id=100))\
+                .orderby(users_tbl.created_at)\
+                .orderby(users_tbl.id)
+            return await db.execute_query(
+                f'EXPLAIN QUERY PLAN {qry.get_sql()}')
+
+        plan = ' '.join(row['detail']
+                        for row in self.io_loop.run_sync(explain))
+        self.assertIn('user_creator_id_created_at_id_idx', plan)
+        # the index also yields the rows in keyset order
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_users_fetched_by_ids(self) -> None:
+        with self.override_settings(paging_max_limit=10):
+            self.do_get_and_assert(
+                '/api/users?ids=3,99,1,3&fields=id,name',
+                200,
+                {
+                    'result': [
+                        {'id': 3, 'name': 'John Doe'},
+                        {'id': 1, 'name': 'Frank Foobar'}
+                    ],
+                    'missing': [99]
+                })
+
+        response = self.fetch('/api/users?ids=2,1')
+        self.assertEqual(
+            [(u['id'], len(u['contacts']))
+             for u in json.loads(response.body)['result']],
+            [(2, 0), (1, 2)])
+        # the users, then the contacts of all of them
+        self.assertEqual(self.count_queries('/api/users?ids=1,2'), 2)
+        self.assertEqual(self.count_queries('/api/users?ids=1,2&fields=id'),
+                         1)
+
+    def test_user_ids_validated(self) -> None:
+        for ids in ('', ',', 'a', '1,-2', '0'):
+            response = self.fetch(f'/api/users?ids={ids}')
+            self.assertEqual(response.code, 400, ids)
+
+        # no more ids than there are users on a page
+        self.do_get_and_assert(
+            '/api/users?ids=1,2,3',
+            400,
+            {
+                'result': [
+                    {
+                        'loc': ['ids'],
+                        'msg': 'At most 2 ids can be requested',
+                        'type': 'value_error'
+                    }
+                ]
+            })
+
     def test_user_created(self) -> None:
         self.do_post_and_assert(
             '/api/users',
@@ -169,6 +464,45 @@ class ContactsHandlerTest(BaseTest):
                 'total': 2
             })
 
+    def test_contacts_paged_by_cursor(self) -> None:
+        response = self.fetch('/api/users/1/contacts?cursor=&limit=1')
+        self.assertEqual(response.code, 200)
+        first_page = json.loads(response.body)
+        self.assertEqual([c['id'] for c in first_page['result']], [1])
+
+        self.do_get_and_assert(
+            '/api/users/1/contacts?limit=2&cursor={}'.format(
+                first_page['next_cursor']),
+            200,
+            {
+                'result': [
+                    {
+                        'id': 2,
+                        'phone_no': '',
+                        'email': 'foo@bar.com',
+                        'type': 'work',
+                        'created_at': '2019-01-01T00:00:03',
+                    }
+                ],
+                'total': 2,
+                'next_cursor': None
+            })
+
+    def test_contacts_and_total_fetched_in_single_query(self) -> None:
+        self.assertEqual(self.count_queries('/api/users/1/contacts'), 1)
+        self.assertEqual(self.count_queries('/api/users/2/contacts'), 1)
+
+    def test_contacts_page_past_the_end(self) -> None:
+        self.do_get_and_assert(
+            '/api/users/1/contacts?offset=5',
+            200,
+            {'result': [], 'total': 2})
+
+        self.do_get_and_assert(
+            '/api/users/1000/contacts?offset=5',
+            404,
+            {'result': 'User with id 1000 was not found'})
+
     def test_contact_is_added(self) -> None:
         self.do_post_and_assert(
             '/api/users/1/contacts',
@@ -184,6 +518,72 @@ class ContactsHandlerTest(BaseTest):
             {'phone_no': '+380111111111', 'type': 'work'},
             200)
 
+    def test_contacts_are_added_in_bulk(self) -> None:
+        self.do_post_json_and_assert(
+            '/api/users/2/contacts',
+            201,
+            {'result': {'contact_ids': [3, 4]}},
+            [
+                {'email': 'ddd@bbb.com', 'type': 'work'},
+                {'phone_no': '+380111111111', 'type': 'home'}
+            ],
+            200)
+
+        response = self.fetch('/api/users/2/contacts')
+        contacts = json.loads(response.body)['result']
+        self.assertEqual(
+            [(c['id'], c['email'], c['phone_no'], c['type'])
+             for c in contacts],
+            [(3, 'ddd@bbb.com', '', 'work'),
+             (4, '', '+380111111111', 'home')])
+
+    def test_bulk_contacts_are_validated(self) -> None:
+        self.do_post_json_and_assert(
+            '/api/users/2/contacts',
+            400,
+            {
+                'result': [
+                    {
+                        'loc': ['contacts', 1, 'email'],
+                        'msg': 'Either phone number or email must be provided',
+                        'type': 'value_error'
+                    }
+                ]
+            },
+            [
+                {'email': 'ddd@bbb.com', 'type': 'work'},
+                {'type': 'home'}
+            ],
+            200)
+
+        self.do_post_json_and_assert(
+            '/api/users/2/contacts',
+            400,
+            {
+                'result': [
+                    {
+                        'loc': ['contacts'],
+                        'msg': 'At least one contact must be provided',
+                        'type': 'value_error'
+                    }
+                ]
+            },
+            [],
+            200)
+
+        self.do_get_and_assert(
+            '/api/users/2/contacts',
+            200,
+            {'result': [], 'total': 0})
+
+    def test_401_on_bulk_contacts_of_another_creator(self) -> None:
+        self.do_post_json_and_assert(
+            '/api/users/2/contacts',
+            401,
+            {'result': "Creator 100 can't edit user 2"},
+            [{'email': 'ddd@bbb.com', 'type': 'work'}],
+            100)
+
     def test_contact_data_is_validated(self) -> None:
         self.do_post_and_assert(
             '/api/users/1/contacts',
@@ -294,6 +694,105 @@ class SingleUserHandlerTest(BaseTest):
                 }
             })
 
+    def test_user_response_cached(self) -> None:
+        self.assertEqual(self.count_queries('/api/users/1'), 2)
+        self.assertEqual(self.count_queries('/api/users/1'), 0)
+
+    def test_user_sparse_fieldset(self) -> None:
+        self.do_get_and_assert(
+            '/api/users/1?fields=name',
+            200,
+            {'result': {'name': 'Frank Foobar'}})
+        # neither the contacts are loaded nor the response is cached
+        self.assertEqual(self.count_queries('/api/users/1?fields=name'), 1)
+        self.assertEqual(self.count_queries('/api/users/1?fields=name'), 1)
+
+    def test_user_embedded_contacts_limited(self) -> None:
+        response = self.fetch('/api/users/1?contacts_limit=1')
+        user = json.loads(response.body)['result']
+        self.assertEqual(user['name'], 'Frank Foobar')
+        self.assertEqual([c['id'] for c in user['contacts']], [1])
+
+    def test_unchanged_user_not_modified(self) -> None:
+        etag = self.fetch('/api/users/1').headers['Etag']
+
+        response = self.fetch('/api/users/1',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 304)
+        self.assertEqual(response.body, b'')
+        self.assertEqual(
+            self.count_queries('/api/users/1',
+                               headers={'If-None-Match': etag}),
+            0)
+
+        # without the cached response, only the version is looked up
+        user_responses.clear()
+        self.assertEqual(
+            self.count_queries('/api/users/1',
+                               headers={'If-None-Match': etag}),
+            1)
+
+    def test_user_etag_changed_by_contact_writes(self) -> None:
+        etag = self.fetch('/api/users/1').headers['Etag']
+        self.do_put_and_assert(
+            '/api/contacts/1',
+            204,
+            None,
+            {'email': 'baz@bar.com', 'type': 'home'},
+            100)
+
+        response = self.fetch('/api/users/1',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+        self.assertNotEqual(response.headers['Etag'], etag)
+
+        etag = response.headers['Etag']
+        self.do_post_and_assert(
+            '/api/users/1/contacts',
+            201,
+            {'result': {'contact_id': 3}},
+            {'phone_no': '+380111111111', 'type': 'work'},
+            100)
+        user_responses.clear()
+
+        response = self.fetch('/api/users/1',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+
+    def test_cached_user_invalidated_by_writes(self) -> None:
+        self.fetch('/api/users/1')
+        self.do_put_and_assert(
+            '/api/users/1',
+            204,
+            None,
+            {'name': 'Zack'},
+            100)
+        self.do_delete_and_assert(
+            '/api/contacts/1',
+            204,
+            100)
+
+        response = self.fetch('/api/users/1')
+        user = json.loads(response.body)['result']
+        self.assertEqual(user['name'], 'Zack')
+        self.assertEqual([c['id'] for c in user['contacts']], [2])
+
+    def test_cached_404_invalidated_by_user_creation(self) -> None:
+        self.do_get_and_assert(
+            '/api/users/4',
+            404,
+            {'result': 'User with id 4 was not found'})
+
+        self.do_post_and_assert(
+            '/api/users',
+            201,
+            {'result': {'user_id': 4}},
+            {'name': 'Baz'},
+            1)
+
+        response = self.fetch('/api/users/4')
+        self.assertEqual(response.code, 200)
+
     def test_404_on_nonexistent_user_id(self) -> None:
         self.do_get_and_assert(
             '/api/users/1000',
@@ -325,6 +824,26 @@ class SingleUserHandlerTest(BaseTest):
             401,
             1000)
 
+    def test_ownership_checked_before_user_data(self) -> None:
+        self.do_put_and_assert(
+            '/api/users/1',
+            401,
+            {'result': "Creator 1000 can't edit user 1"},
+            {'name': ''},
+            1000)
+
+        self.do_put_and_assert(
+            '/api/users/1000',
+            404,
+            {'result': 'User with id 1000 was not found'},
+            {'name': ''},
+            100)
+
+        response = self.fetch(
+            '/api/users/1', method='PUT', body=json.dumps({'name': ''}),
+            headers={'Authorization': 'Bearer ' + self._create_token(100)})
+        self.assertEqual(response.code, 400)
+
     def test_user_updated(self) -> None:
         self.do_put_and_assert(
             '/api/users/1',
@@ -333,6 +852,29 @@ class SingleUserHandlerTest(BaseTest):
             {'name': 'Zack'},
             100)
 
+        response = self.fetch('/api/users/1')
+        self.assertEqual(json.loads(response.body)['result']['name'], 'Zack')
+
+    def test_principal_parsed_once(self) -> None:
+        with mock.patch.object(Headers, 'parse_obj',
+                               wraps=Headers.parse_obj) as parse_obj:
+            self.do_put_and_assert(
+                '/api/users/1',
+                204,
+                None,
+                {'name': 'Zack'},
+                100)
+
+        self.assertEqual(parse_obj.call_count, 1)
+
+    def test_user_edited_in_single_statement(self) -> None:
+        self.assertEqual(
+            self.count_queries('/api/users/1', 'PUT', {'name': 'Zack'}, 100),
+            1)
+        self.assertEqual(
+            self.count_queries('/api/users/1', 'DELETE', creator_id=100),
+            1)
+
     def test_user_data_validated(self) -> None:
         self.do_put_and_assert(
             '/api/users/1',
@@ -391,6 +933,40 @@ class SingleContactHandlerTest(BaseTest):
                 }
             })
 
+    def test_contact_response_cached(self) -> None:
+        self.assertEqual(self.count_queries('/api/contacts/1'), 1)
+        self.assertEqual(self.count_queries('/api/contacts/1'), 0)
+
+    def test_unchanged_contact_not_modified(self) -> None:
+        etag = self.fetch('/api/contacts/1').headers['Etag']
+        contact_responses.clear()
+
+        response = self.fetch('/api/contacts/1',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 304)
+
+        self.do_put_and_assert(
+            '/api/contacts/1',
+            204,
+            None,
+            {'email': 'baz@bar.com', 'type': 'home'},
+            100)
+        response = self.fetch('/api/contacts/1',
+                              headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+
+    def test_cached_contacts_invalidated_by_user_deletion(self) -> None:
+        self.fetch('/api/contacts/1')
+        self.do_delete_and_assert(
+            '/api/users/1/contacts',
+            204,
+            100)
+
+        self.do_get_and_assert(
+            '/api/contacts/1',
+            404,
+            {'result': 'Contact with id 1 was not found'})
+
     def test_404_on_nonexistent_user_id(self) -> None:
         self.do_get_and_assert(
             '/api/contacts/1000',
@@ -422,6 +998,25 @@ class SingleContactHandlerTest(BaseTest):
             401,
             1000)
 
+    def test_ownership_checked_before_contact_data(self) -> None:
+        response = self.fetch(
+            '/api/contacts/1', method='PUT',
+            body=json.dumps({'phone_no': 'zzz', 'type': 'work'}),
+            headers={'Authorization': 'Bearer ' + self._create_token(1000)})
+        self.assertEqual(response.code, 401)
+
+        response = self.fetch(
+            '/api/contacts/1000', method='PUT',
+            body=json.dumps({'phone_no': 'zzz', 'type': 'work'}),
+            headers={'Authorization': 'Bearer ' + self._create_token(100)})
+        self.assertEqual(response.code, 404)
+
+        response = self.fetch(
+            '/api/contacts/1', method='PUT',
+            body=json.dumps({'phone_no': 'zzz', 'type': 'work'}),
+            headers={'Authorization': 'Bearer ' + self._create_token(100)})
+        self.assertEqual(response.code, 400)
+
     def test_contact_updated(self) -> None:
         self.do_put_and_assert(
             '/api/contacts/1',
@@ -430,6 +1025,45 @@ class SingleContactHandlerTest(BaseTest):
             {'phone_no': '+380111111111', 'type': 'work'},
             100)
 
+        self.do_get_and_assert(
+            '/api/contacts/1',
+            200,
+            {
+                'result': {
+                    'id': 1,
+                    'phone_no': '+380111111111',
+                    'email': '',
+                    'type': 'work',
+                    'created_at': '2019-01-01T00:00:02',
+                }
+            })
+
+    def test_contact_edited_without_ownership_lookups(self) -> None:
+        # the write itself and the version bump of the contact's user
+        self.assertEqual(
+            self.count_queries('/api/contacts/1', 'PUT',
+                               {'phone_no': '+380111111111', 'type': 'work'},
+                               100),
+            2)
+        self.assertEqual(
+            self.count_queries('/api/contacts/1', 'DELETE', creator_id=100),
+            2)
+
+    def test_contact_ownership_checked_by_primary_keys(self) -> None:
+        async def explain() -> list:
+            db = Tortoise.get_connection('default')
+            contacts_tbl = Table(ContactModel._meta.table)
+            qry = db.query_class\
+                .from_(contacts_tbl)\
+                .where(_owned_contact_criterion(db, 1, 100))\
+                .delete()
+            return await db.execute_query(
+                f'EXPLAIN QUERY PLAN {qry.get_sql()}')
+
+        plan = [row['detail'] for row in self.io_loop.run_sync(explain)]
+        self.assertFalse([step for step in plan if step.startswith('SCAN')],
+                         plan)
+
     def test_contact_data_validated(self) -> None:
         self.do_put_and_assert(
             '/api/contacts/1',
@@ -472,3 +1106,682 @@ class SingleContactHandlerTest(BaseTest):
                 ],
                 'total': 1
             })
+
+
+class ContactLookupHandlerTest(BaseTest):
+    def test_contacts_looked_up_by_normalized_email(self) -> None:
+        self.do_get_and_assert(
+            '/api/contacts/lookup?email=Foo@Bar.COM',
+            200,
+            {
+                'total': 1,
+                'result': [{
+                    'id': 2,
+                    'phone_no': '',
+                    'email': 'foo@bar.com',
+                    'type': 'work',
+                    'created_at': '2019-01-01T00:00:03',
+                    'user_id': 1
+                }]
+            })
+
+    def test_contacts_looked_up_by_normalized_phone_no(self) -> None:
+        for user_id, creator_id in ((1, 100), (2, 200)):
+            self.do_post_and_assert(
+                f'/api/users/{user_id}/contacts', 201, None,
+                {'phone_no': '+38 (050) 123-45-67', 'type': 'home'},
+                creator_id)
+
+        response = self.fetch('/api/contacts/lookup?phone_no=%2B380501234567')
+        result = json.loads(response.body)
+        self.assertEqual(result['total'], 2)
+        self.assertEqual([(c['user_id'], c['phone_no'])
+                          for c in result['result']],
+                         [(1, '+38 (050) 123-45-67'),
+                          (2, '+38 (050) 123-45-67')])
+
+    def test_lookup_follows_updates(self) -> None:
+        self.do_put_and_assert('/api/contacts/2', 204, None,
+                               {'email': 'Baz@Bar.com', 'type': 'work'}, 100)
+
+        self.do_get_and_assert('/api/contacts/lookup?email=foo@bar.com', 200,
+                               {'total': 0, 'result': []})
+        response = self.fetch('/api/contacts/lookup?email=baz@bar.com')
+        self.assertEqual(
+            [c['id'] for c in json.loads(response.body)['result']], [2])
+
+    def test_lookup_paginated(self) -> None:
+        self.do_post_json_and_assert(
+            '/api/users/1/contacts', 201, None,
+            [{'phone_no': '+380501234567', 'type': 'home'}] * 3, 100)
+
+        response = self.fetch(
+            '/api/contacts/lookup?phone_no=%2B380501234567&limit=2&cursor=')
+        page = json.loads(response.body)
+        self.assertEqual((page['total'], len(page['result'])), (3, 2))
+
+        response = self.fetch(
+            '/api/contacts/lookup?phone_no=%2B380501234567&limit=2&cursor='
+            + page['next_cursor'])
+        page = json.loads(response.body)
+        self.assertEqual(len(page['result']), 1)
+        self.assertIsNone(page['next_cursor'])
+
+    def test_lookup_validated(self) -> None:
+        for query in ('', '?phone_no=%2B380501234567&email=foo@bar.com',
+                      '?email=foo', '?phone_no=%2B1'):
+            response = self.fetch('/api/contacts/lookup' + query)
+            self.assertEqual(response.code, 400, query)
+
+    def test_existing_contacts_backfilled(self) -> None:
+        self.do_post_json_and_assert(
+            '/api/users/1/contacts', 201, None,
+            [{'phone_no': '+380501234567', 'type': 'home'},
+             {'email': 'Baz@Qux.com', 'type': 'work'},
+             {'phone_no': '+380 67 123 4567', 'type': 'other'}], 100)
+
+        async def clear_normalized_columns() -> None:
+            db = Tortoise.get_connection('default')
+            contacts_tbl = Table(ContactModel._meta.table)
+            await db.execute_query(
+                db.query_class
+                .update(contacts_tbl)
+                .set(contacts_tbl.e164_phone_no, '')
+                .set(contacts_tbl.lowercase_email, '')
+                .get_sql())
+
+        self.io_loop.run_sync(clear_normalized_columns)
+        response = self.fetch('/api/contacts/lookup?email=baz@qux.com')
+        self.assertEqual(json.loads(response.body)['total'], 0)
+
+        # the first contact's phone number can't be normalized
+        self.assertEqual(
+            self.io_loop.run_sync(
+                lambda: database_operations.backfill_normalized_contacts(2)),
+            4)
+
+        response = self.fetch('/api/contacts/lookup?email=baz@qux.com')
+        self.assertEqual(
+            [c['id'] for c in json.loads(response.body)['result']], [4])
+        response = self.fetch(
+            '/api/contacts/lookup?phone_no=%2B380671234567')
+        self.assertEqual(
+            [c['id'] for c in json.loads(response.body)['result']], [5])
+        response = self.fetch('/api/contacts/lookup?email=foo@bar.com')
+        self.assertEqual(
+            [c['id'] for c in json.loads(response.body)['result']], [2])
+
+    def test_lookup_uses_index(self) -> None:
+        async def explain(column: str) -> list:
+            db = Tortoise.get_connection('default')
+            contacts_tbl = Table(ContactModel._meta.table)
+            qry = db.query_class\
+                .from_(contacts_tbl)\
+                .select(contacts_tbl.star)\
+                .where(contacts_tbl.field(column) == 'foo@bar.com')
+            return await db.execute_query(
+                f'EXPLAIN QUERY PLAN {qry.get_sql()}')
+
+        for column in ('e164_phone_no', 'lowercase_email'):
+            plan = [row['detail'] for row in
+                    self.io_loop.run_sync(lambda: explain(column))]
+            self.assertIn('USING INDEX', plan[0], plan)
+
+
+class ContactsByIdsHandlerTest(BaseTest):
+    def test_contacts_fetched_by_ids(self) -> None:
+        with self.override_settings(paging_max_limit=10):
+            self.do_get_and_assert(
+                '/api/contacts?ids=2,5,1',
+                200,
+                {
+                    'result': [
+                        {
+                            'id': 2,
+                            'phone_no': '',
+                            'email': 'foo@bar.com',
+                            'type': 'work',
+                            'created_at': '2019-01-01T00:00:03',
+                            'user_id': 1
+                        },
+                        {
+                            'id': 1,
+                            'phone_no': '111',
+                            'email': '',
+                            'type': 'home',
+                            'created_at': '2019-01-01T00:00:02',
+                            'user_id': 1
+                        }
+                    ],
+                    'missing': [5]
+                })
+        self.assertEqual(self.count_queries('/api/contacts?ids=1,2'), 1)
+
+    def test_contact_ids_required(self) -> None:
+        self.do_get_and_assert(
+            '/api/contacts',
+            400,
+            {
+                'result': [
+                    {
+                        'loc': ['ids'],
+                        'msg': 'field required',
+                        'type': 'value_error.missing'
+                    }
+                ]
+            })
+
+
+class BatchHandlerTest(BaseTest):
+    def test_operations_executed(self) -> None:
+        self.do_post_json_and_assert(
+            '/api/batch',
+            200,
+            {
+                'result': [
+                    {'status': 201, 'result': {'user_id': 4}},
+                    {'status': 201, 'result': {'contact_id': 3}},
+                    {'status': 201, 'result': {'contact_ids': [4, 5]}},
+                    {'status': 204},
+                    {'status': 204}
+                ]
+            },
+            {
+                'operations': [
+                    {'method': 'POST', 'path': '/api/users',
+                     'body': {'name': 'Batch User'}},
+                    {'method': 'POST', 'path': '/api/users/$0/contacts',
+                     'body': {'phone_no': '+380501234567', 'type': 'home'}},
+                    {'method': 'POST', 'path': '/api/users/$0/contacts',
+                     'body': [{'email': 'a@b.com', 'type': 'work'},
+                              {'email': 'c@d.com', 'type': 'work'}]},
+                    {'method': 'PUT', 'path': '/api/users/$0',
+                     'body': {'name': 'Renamed User'}},
+                    {'method': 'DELETE', 'path': '/api/contacts/$1'}
+                ]
+            },
+            100)
+
+        response = json.loads(self.fetch('/api/users/4').body)['result']
+        self.assertEqual(response['name'], 'Renamed User')
+        self.assertEqual([c['id'] for c in response['contacts']], [4, 5])
+
+    def test_atomic_batch_rolled_back(self) -> None:
+        # cached before the batch, and dropped by its update
+        self.fetch('/api/users/1')
+
+        self.do_post_json_and_assert(
+            '/api/batch',
+            200,
+            {
+                'result': [
+                    {'status': 424,
+                     'result': 'Rolled back, operation 1 failed'},
+                    {'status': 401,
+                     'result': "Creator 100 can't edit user 2"},
+                    {'status': 424,
+                     'result': 'Not executed, operation 1 failed'}
+                ]
+            },
+            {
+                'operations': [
+                    {'method': 'PUT', 'path': '/api/users/1',
+                     'body': {'name': 'Renamed User'}},
+                    {'method': 'DELETE', 'path': '/api/users/2'},
+                    {'method': 'POST', 'path': '/api/users',
+                     'body': {'name': 'Batch User'}}
+                ]
+            },
+            100)
+
+        response = json.loads(self.fetch('/api/users').body)
+        self.assertEqual(response['total'], 3)
+        self.assertEqual(response['result'][0]['name'], 'Frank Foobar')
+        response = json.loads(self.fetch('/api/users/1').body)
+        self.assertEqual(response['result']['name'], 'Frank Foobar')
+
+    def test_independent_operations(self) -> None:
+        self.do_post_json_and_assert(
+            '/api/batch',
+            200,
+            {
+                'result': [
+                    {'status': 404, 'result': 'User with id 99 was not found'},
+                    {'status': 424,
+                     'result': 'Operation 0 created no user_id'},
+                    {'status': 400, 'result': [
+                        {
+                            'loc': ['name'],
+                            'msg': 'field required',
+                            'type': 'value_error.missing'
+                        }
+                    ]},
+                    {'status': 404, 'result': 'No operation PUT /api/users'},
+                    {'status': 201, 'result': {'user_id': 4}}
+                ]
+            },
+            {
+                'atomic': False,
+                'operations': [
+                    {'method': 'PUT', 'path': '/api/users/99',
+                     'body': {'name': 'Nobody'}},
+                    {'method': 'DELETE', 'path': '/api/users/$0'},
+                    {'method': 'POST', 'path': '/api/users'},
+                    {'method': 'PUT', 'path': '/api/users'},
+                    {'method': 'POST', 'path': '/api/users',
+                     'body': {'name': 'Batch User'}}
+                ]
+            },
+            100)
+
+        self.assertEqual(json.loads(self.fetch('/api/users').body)['total'],
+                         4)
+
+    def test_reference_to_other_entity_not_resolved(self) -> None:
+        self.do_post_json_and_assert(
+            '/api/batch',
+            200,
+            {
+                'result': [
+                    {'status': 201, 'result': {'user_id': 4}},
+                    {'status': 201, 'result': {'contact_id': 3}},
+                    {'status': 201, 'result': {'contact_id': 4}},
+                    {'status': 424,
+                     'result': 'Operation 2 created no user_id'},
+                    {'status': 424,
+                     'result': 'Operation 0 created no contact_id'}
+                ]
+            },
+            {
+                'atomic': False,
+                'operations': [
+                    {'method': 'POST', 'path': '/api/users',
+                     'body': {'name': 'Batch User'}},
+                    {'method': 'POST', 'path': '/api/users/$0/contacts',
+                     'body': {'email': 'a@b.com', 'type': 'work'}},
+                    {'method': 'POST', 'path': '/api/users/$0/contacts',
+                     'body': {'email': 'c@d.com', 'type': 'work'}},
+                    # contact id 4 is also the id of the new user
+                    {'method': 'DELETE', 'path': '/api/users/$2'},
+                    {'method': 'DELETE', 'path': '/api/contacts/$0'}
+                ]
+            },
+            100)
+
+        self.assertEqual(self.fetch('/api/users/4').code, 200)
+        self.assertEqual(self.fetch('/api/contacts/4').code, 200)
+
+    def test_batch_validated(self) -> None:
+        self.do_post_json_and_assert(
+            '/api/batch',
+            400,
+            {
+                'result': [
+                    {
+                        'loc': ['operations'],
+                        'msg': 'Operation 0 can only refer to the earlier '
+                               'operations',
+                        'type': 'value_error'
+                    }
+                ]
+            },
+            {'operations': [{'method': 'DELETE', 'path': '/api/users/$0'}]},
+            100)
+
+        get = {'method': 'GET', 'path': '/api/users'}
+        for body in ({}, {'operations': []}, {'operations': [get]}):
+            response = self.fetch(
+                '/api/batch', method='POST', body=json.dumps(body),
+                headers={'Authorization': 'Bearer {}'.format(
+                    self._create_token(100))})
+            self.assertEqual(response.code, 400, body)
+
+        # authentication is required even before the body is validated
+        response = self.fetch('/api/batch', method='POST', body='[]',
+                              raise_error=False)
+        self.assertEqual(response.code, 400)
+        self.assertEqual(json.loads(response.body)['result'][0]['loc'],
+                         ['Authorization'])
+
+    def test_authenticated_once(self) -> None:
+        validation_schemata.jwt_cache.clear()
+        operations = [{'method': 'POST', 'path': '/api/users',
+                       'body': {'name': f'Batch User {i}'}} for i in range(2)]
+        self.do_post_json_and_assert(
+            '/api/batch', 200, None, {'operations': operations}, 100)
+
+        jwt_cache = validation_schemata.jwt_cache
+        self.assertEqual(jwt_cache.hits + jwt_cache.misses, 1)
+
+
+class JwtCacheTest(BaseTest):
+    def setUp(self) -> None:
+        super().setUp()
+        validation_schemata.jwt_cache.clear()
+
+    def _post_user(self, token: str) -> int:
+        response = self.fetch(
+            '/api/users', method='POST', body=urlencode({'name': 'Baz'}),
+            headers={'Authorization': 'Bearer {}'.format(token)})
+        return response.code
+
+    def test_token_verified_once(self) -> None:
+        token = self._create_token(1)
+        with mock.patch.object(validation_schemata, 'jwt_decode',
+                               wraps=validation_schemata.jwt_decode) as decode:
+            self.assertEqual(self._post_user(token), 201)
+            self.assertEqual(self._post_user(token), 201)
+
+        self.assertEqual(decode.call_count, 1)
+        self.assertEqual(validation_schemata.jwt_cache.hits, 1)
+        self.assertEqual(validation_schemata.jwt_cache.misses, 1)
+
+    def test_token_expiry_respected(self) -> None:
+        token = self._create_token(1, exp=int(time()) + 60)
+        self.assertEqual(self._post_user(token), 201)
+
+        with mock.patch('fooapi_async.caches.time', return_value=time() + 120), \
+                mock.patch('jwt.api_jwt.timegm', return_value=int(time()) + 120):
+            self.assertEqual(self._post_user(token), 400)
+
+
+class ValidationCacheTest(BaseTest):
+    def setUp(self) -> None:
+        super().setUp()
+        validation_schemata.phone_number_cache.clear()
+        validation_schemata.email_cache.clear()
+
+    def _post_contact(self, **contact: str) -> int:
+        response = self.fetch(
+            '/api/users/1/contacts', method='POST',
+            body=urlencode(dict(contact, type='home')),
+            headers={'Authorization': 'Bearer {}'.format(
+                self._create_token(100))},
+            raise_error=False)
+        return response.code
+
+    def test_phone_number_parsed_once(self) -> None:
+        with mock.patch('phonenumbers.parse',
+                        wraps=phonenumbers.parse) as parse:
+            self.assertEqual(self._post_contact(phone_no='+380501234567'),
+                             201)
+            self.assertEqual(self._post_contact(phone_no='+380501234567'),
+                             201)
+
+        self.assertEqual(parse.call_count, 1)
+        self.assertEqual(validation_schemata.phone_number_cache.hits, 1)
+
+    def test_email_validated_once(self) -> None:
+        with mock.patch('pydantic.types.validate_email',
+                        wraps=validate_email) as validate:
+            self.assertEqual(self._post_contact(email='baz@example.com'), 201)
+            self.assertEqual(self._post_contact(email='baz@example.com'), 201)
+
+        self.assertEqual(validate.call_count, 1)
+        self.assertEqual(validation_schemata.email_cache.hits, 1)
+
+    def test_invalid_values_not_cached(self) -> None:
+        for _ in range(2):
+            self.assertEqual(self._post_contact(phone_no='+1'), 400)
+            self.assertEqual(self._post_contact(email='baz@'), 400)
+
+        self.assertEqual(len(validation_schemata.phone_number_cache), 0)
+        self.assertEqual(len(validation_schemata.email_cache), 0)
+
+
+class UserImportHandlerTest(BaseTest):
+    def _import(self, chunks, creator_id: int = None) -> Dict[str, Any]:
+        headers = {}
+        if creator_id is not None:
+            headers['Authorization'] = 'Bearer {}'.format(
+                self._create_token(creator_id))
+
+        async def body_producer(write):
+            for chunk in chunks:
+                await write(chunk)
+
+        response = self.fetch('/api/users/import', method='POST',
+                              headers=headers, body_producer=body_producer,
+                              raise_error=False)
+        return response.code, json.loads(response.body)
+
+    def test_users_imported(self) -> None:
+        lines = [
+            {'name': 'Alice', 'contacts': [
+                {'email': 'alice@example.com', 'type': 'work'},
+                {'phone_no': '+380111111111', 'type': 'home'}]},
+            {'name': 'Bob'},
+            {'name': ''},
+            {'name': 'Carol', 'contacts': [{'type': 'home'}]},
+            {'name': 'Dave'},
+        ]
+        body = ''.join(json.dumps(l) + '\n' for l in lines).encode('utf8')
+        # split lines between chunks and flush more than one batch
+        chunks = [body[i:i + 7] for i in range(0, len(body), 7)]
+
+        with self.override_settings(import_batch_size=2):
+            code, res = self._import(chunks, 100)
+
+        self.assertEqual(code, 200)
+        self.assertEqual(res['result']['imported'], 3)
+        self.assertEqual(res['result']['failed'], 2)
+        self.assertEqual([e['line'] for e in res['result']['errors']], [3, 4])
+
+        response = self.fetch('/api/users?offset=3&limit=2')
+        users = json.loads(response.body)
+        self.assertEqual(users['total'], 6)
+        self.assertEqual(
+            [(u['name'], [c['email'] or c['phone_no'] for c in u['contacts']])
+             for u in users['result']],
+            [('Alice', ['alice@example.com', '+380111111111']),
+             ('Bob', [])])
+
+    def test_imported_contacts_bounded(self) -> None:
+        contacts = [{'email': f'user{i}@example.com', 'type': 'work'}
+                    for i in range(3)]
+        lines = [{'name': 'Alice', 'contacts': contacts},
+                 {'name': 'Bob', 'contacts': contacts[:2]},
+                 {'name': 'Carol', 'contacts': contacts[:1]}]
+        body = b''.join(json.dumps(l).encode('utf8') + b'\n' for l in lines)
+
+        with self.override_settings(bulk_max_contacts=2,
+                                    import_batch_max_contacts=2), \
+                mock.patch('fooapi_async.api.import_users',
+                           wraps=database_operations.import_users
+                           ) as import_users:
+            code, res = self._import([body], 100)
+
+        self.assertEqual(code, 200)
+        self.assertEqual(res['result']['imported'], 2)
+        self.assertEqual(res['result']['errors'], [{
+            'line': 1,
+            'errors': [{
+                'loc': ['contacts'],
+                'msg': 'At most 2 contacts can be created at once',
+                'type': 'value_error'
+            }]
+        }])
+        # Bob's contacts fill a batch on their own
+        self.assertEqual([len(c.args[1]) for c in import_users.mock_calls],
+                         [1, 1])
+
+    def test_import_stopped_by_write_failure(self) -> None:
+        from fooapi_async import api
+
+        calls = 0
+
+        async def import_users(*args: Any) -> List[int]:
+            nonlocal calls
+            calls += 1
+            if calls == 2:
+                raise OperationalError('database is locked')
+            return await database_operations.import_users(*args)
+
+        body = b''.join(json.dumps({'name': f'User {i}'}).encode('utf8') +
+                        b'\n' for i in range(7))
+        with self.override_settings(import_batch_size=2), \
+                mock.patch.object(api, 'import_users', import_users), \
+                self.assertLogs('tornado.application', 'ERROR'):
+            code, res = self._import([body[:40], body[40:]], 100)
+
+        self.assertEqual(code, 500)
+        self.assertEqual(res['result'], {
+            'imported': 2,
+            'failed': 2,
+            'errors': [],
+            'aborted': {
+                'lines': [3, 4],
+                'msg': 'The users of these lines could not be written, the '
+                       'lines after them were not imported'
+            }
+        })
+        self.assertEqual(calls, 2)
+        self.assertEqual(
+            json.loads(self.fetch('/api/users').body)['total'], 5)
+
+    def test_unterminated_last_line_imported(self) -> None:
+        code, res = self._import([b'{"name": "Alice"}\n{"name": "Bob"}'],
+                                 100)
+        self.assertEqual(code, 200)
+        self.assertEqual(res['result']['imported'], 2)
+
+    def test_jwt_required(self) -> None:
+        code, res = self._import([b'{"name": "Alice"}\n'])
+        self.assertEqual(code, 400)
+        self.assertEqual(
+            res,
+            {
+                'result': [
+                    {
+                        'loc': ['Authorization'],
+                        'msg': 'field required',
+                        'type': 'value_error.missing'
+                    }
+                ]
+            })
+
+
+class UserExportHandlerTest(BaseTest):
+    def test_users_exported_as_ndjson(self) -> None:
+        with self.override_settings(export_batch_size=2):
+            response = self.fetch('/api/export/users')
+
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'],
+                         'application/x-ndjson; charset=UTF-8')
+        users = [json.loads(l) for l in response.body.splitlines()]
+        self.assertEqual([u['id'] for u in users], [1, 2, 3])
+        self.assertEqual([c['id'] for c in users[0]['contacts']], [1, 2])
+
+    def test_users_exported_as_csv(self) -> None:
+        with self.override_settings(export_batch_size=2):
+            response = self.fetch('/api/export/users?format=csv')
+
+        self.assertEqual(response.code, 200)
+        self.assertEqual(
+            response.body.decode('utf8').splitlines(),
+            [
+                'user_id,name,created_at,contact_id,phone_no,email,type,'
+                'contact_created_at',
+                '1,Frank Foobar,2019-01-01T00:00:01,1,111,,home,'
+                '2019-01-01T00:00:02',
+                '1,Frank Foobar,2019-01-01T00:00:01,2,,foo@bar.com,work,'
+                '2019-01-01T00:00:03',
+                '2,Crash Coredump,2019-01-01T00:00:04,,,,,',
+                '3,John Doe,2019-01-01T00:00:05,,,,,',
+            ])
+
+    def test_export_format_validated(self) -> None:
+        response = self.fetch('/api/export/users?format=xml')
+        self.assertEqual(response.code, 400)
+
+
+class SerializationTest(BaseTest):
+    def test_stdlib_fallback_matches_fast_encoder(self) -> None:
+        urls = ('/api/users', '/api/users/1/contacts', '/api/users?limit=0')
+        responses = [self.fetch(url) for url in urls]
+
+        with mock.patch('fooapi_async.serialization._encode',
+                        serialization._json_dumps):
+            fallback_responses = [self.fetch(url) for url in urls]
+
+        for response, fallback in zip(responses, fallback_responses):
+            self.assertEqual(response.headers['Content-Type'],
+                             'application/json; charset=UTF-8')
+            self.assertEqual(fallback.headers['Content-Type'],
+                             'application/json; charset=UTF-8')
+            self.assertEqual(response.body, fallback.body)
+
+
+class ReplicaRoutingTest(BaseTest):
+    def get_app(self) -> Application:
+        with self.override_settings(replica_cookie_secret='secret'):
+            return super().get_app()
+
+    def setUp(self) -> None:
+        super().setUp()
+
+        async def init_db_with_replicas() -> None:
+            await close_db_connections()
+            with self.override_settings(replica_db_uris=['sqlite://:memory:',
+                                                         'sqlite://:memory:']):
+                await init_db_and_apply_db_fixtures()
+
+            # the replicas are separate in-memory databases which only get
+            # the schema (generated for the models of the primary) and, for
+            # the second one, a user of its own
+            schema = get_schema_sql(Tortoise.get_connection('default'),
+                                    safe=False) + get_composite_index_sql()
+            for name in ('replica_0', 'replica_1'):
+                await Tortoise.get_connection(name).execute_script(schema)
+            await User(name='Replicated', creator_id=100).save(
+                using_db=Tortoise.get_connection('replica_1'))
+
+        self.io_loop.run_sync(init_db_with_replicas)
+
+    def write(self) -> str:
+        """
+        Renames user 1 and returns the cookie tracking the write
+        """
+        response = self.fetch(
+            '/api/users/1', method='PUT', body=urlencode({'name': 'Zack'}),
+            headers={
+                'Authorization': 'Bearer {}'.format(
+                    self._create_token(100)),
+                'Content-Type': 'application/x-www-form-urlencoded'
+            })
+        self.assertEqual(response.code, 204)
+        return response.headers['Set-Cookie'].split(';')[0]
+
+    def get_total(self, cookie: str = None) -> int:
+        headers = {'Cookie': cookie} if cookie is not None else {}
+        response = self.fetch('/api/users', headers=headers)
+        return json.loads(response.body)['total']
+
+    def test_reads_routed_to_replicas_in_turn(self) -> None:
+        self.assertEqual([self.get_total() for _ in range(4)], [0, 1, 0, 1])
+
+    def test_client_reads_own_writes_from_primary(self) -> None:
+        cookie = self.write()
+
+        self.assertEqual([self.get_total(cookie) for _ in range(2)], [3, 3])
+        self.assertIn(self.get_total(), (0, 1))
+
+    def test_cached_responses_rendered_from_primary(self) -> None:
+        cookie = self.write()
+
+        # the second replica has a user 1 too, named differently
+        for headers in ({}, {}, {'Cookie': cookie}):
+            response = self.fetch('/api/users/1', headers=headers)
+            self.assertEqual(json.loads(response.body)['result']['name'],
+                             'Zack')
+
+    def test_stickiness_expires(self) -> None:
+        cookie = self.write()
+
+        with mock.patch('fooapi_async.replicas.time',
+                        return_value=time() + 3600):
+            self.assertIn(self.get_total(cookie), (0, 1))
+
+    def test_forged_cookie_ignored(self) -> None:
+        self.assertIn(self.get_total(f'last_write={time()}'), (0, 1))
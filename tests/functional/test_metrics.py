@@ -0,0 +1,91 @@
+from typing import Dict
+
+from tornado.testing import AsyncHTTPTestCase
+from tornado.web import Application
+
+from fooapi_async.metrics import CONTENT_TYPE, expose, make_metrics_app
+from tests.functional import BaseTest
+
+
+def sample(name: str, **labels: str) -> float:
+    """
+    Value of a sample of the exposed metrics, 0 if there's none
+    """
+    # the label values of the routes are escaped
+    wanted = ','.join('{}="{}"'.format(k, v.replace('\\', r'\\'))
+                      for k, v in sorted(labels.items()))
+    for line in expose().splitlines():
+        if line.startswith('#'):
+            continue
+        series, value = line.rsplit(' ', 1)
+        sample_name, _, sample_labels = series.partition('{')
+        sample_labels = ','.join(sorted(sample_labels.rstrip('}').split(',')))
+        if sample_name == name and sample_labels == wanted:
+            return float(value)
+    return 0
+
+
+class MetricsTest(BaseTest):
+    def samples(self, route: str, status: str = '200') -> Dict[str, float]:
+        labels = {'route': route, 'method': 'GET'}
+        return {
+            'requests': sample('fooapi_requests_total', status=status,
+                               **labels),
+            'durations': sample('fooapi_request_duration_seconds_count',
+                                **labels),
+            'statements': sample('fooapi_request_db_statements_sum',
+                                 **labels),
+            'fast_requests': sample('fooapi_request_duration_seconds_bucket',
+                                    le='10.0', **labels),
+        }
+
+    def test_requests_recorded_by_route(self) -> None:
+        before = self.samples(r'/api/users/(\d+)')
+        self.fetch('/api/users/1')
+        self.fetch('/api/users/2')
+        after = self.samples(r'/api/users/(\d+)')
+
+        self.assertEqual(after['requests'] - before['requests'], 2)
+        self.assertEqual(after['durations'] - before['durations'], 2)
+        self.assertEqual(after['fast_requests'] - before['fast_requests'], 2)
+        self.assertGreater(after['statements'], before['statements'])
+
+    def test_statuses_recorded(self) -> None:
+        before = self.samples(r'/api/users/(\d+)', '404')
+        self.fetch('/api/users/1000')
+        after = self.samples(r'/api/users/(\d+)', '404')
+        self.assertEqual(after['requests'] - before['requests'], 1)
+
+        before = self.samples('unmatched', '404')
+        self.fetch('/nowhere')
+        after = self.samples('unmatched', '404')
+        self.assertEqual(after['requests'] - before['requests'], 1)
+
+    def test_cached_response_sends_no_statement(self) -> None:
+        self.fetch('/api/users/1')
+        before = self.samples(r'/api/users/(\d+)')
+        self.fetch('/api/users/1')
+        after = self.samples(r'/api/users/(\d+)')
+
+        self.assertEqual(after['requests'] - before['requests'], 1)
+        self.assertEqual(after['statements'], before['statements'])
+        self.assertEqual(sample('fooapi_cache_hits_total',
+                                cache='user_responses'), 1)
+
+    def test_pool_reported(self) -> None:
+        self.assertEqual(
+            sample('fooapi_db_pool_connections', connection='default'), 1)
+        self.assertEqual(
+            sample('fooapi_db_pool_saturation', connection='default'), 0)
+
+
+class MetricsHandlerTest(AsyncHTTPTestCase):
+    def get_app(self) -> Application:
+        return make_metrics_app()
+
+    def test_metrics_served(self) -> None:
+        response = self.fetch('/metrics')
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['Content-Type'], CONTENT_TYPE)
+        self.assertIn(b'# TYPE fooapi_request_duration_seconds histogram\n',
+                      response.body)
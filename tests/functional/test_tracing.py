@@ -0,0 +1,77 @@
+from unittest import mock
+
+from fooapi_async import tracing
+from tests.functional import BaseTest
+
+
+class TracingTest(BaseTest):
+    def test_request_id_generated(self) -> None:
+        first = self.fetch('/api/users').headers['X-Request-Id']
+        second = self.fetch('/api/users').headers['X-Request-Id']
+        self.assertRegex(first, r'^[0-9a-f]{32}$')
+        self.assertNotEqual(first, second)
+
+    def test_request_id_propagated(self) -> None:
+        response = self.fetch('/api/users',
+                              headers={'X-Request-Id': 'abc-123'})
+        self.assertEqual(response.headers['X-Request-Id'], 'abc-123')
+
+        for request_id in ('a' * 65, '<script>'):
+            response = self.fetch('/api/users',
+                                  headers={'X-Request-Id': request_id})
+            self.assertRegex(response.headers['X-Request-Id'],
+                             r'^[0-9a-f]{32}$')
+
+    def test_server_timing(self) -> None:
+        response = self.fetch('/api/users')
+        self.assertNotIn('Server-Timing', response.headers)
+
+        with self.override_settings(server_timing=True):
+            response = self.fetch('/api/users?limit=1')
+
+        metrics = dict(m.split(';', 1) for m in
+                       response.headers['Server-Timing'].split(', '))
+        self.assertEqual(set(metrics), {'db', 'validation', 'serialization'})
+        # the page of users along with their count, and their contacts
+        self.assertRegex(metrics['db'], r'^dur=[0-9.]+;desc="2 statements"$')
+
+    def test_slow_statements_logged(self) -> None:
+        with mock.patch.object(tracing, '_slow_statement_threshold', 0), \
+                self.assertLogs('tornado.application', 'WARNING') as logs:
+            self.fetch('/api/users/1',
+                       headers={'X-Request-Id': 'slow-request'})
+
+        self.assertTrue(logs.output)
+        for line in logs.output:
+            self.assertIn(r'route /api/users/(\d+), request slow-request',
+                          line)
+        self.assertIn('SELECT', logs.output[0])
+
+    def test_fast_statements_not_logged_as_slow(self) -> None:
+        with mock.patch.object(tracing, '_slow_statement_threshold', 60), \
+                mock.patch.object(tracing.app_log, 'warning') as warning:
+            self.fetch('/api/users/1')
+        warning.assert_not_called()
+
+    def test_streamed_body_statements_traced(self) -> None:
+        async def body_producer(write) -> None:
+            for i in range(2):
+                await write(b'{"name": "User %d"}\n' % i)
+
+        headers = {'Authorization': 'Bearer {}'.format(self._create_token(1)),
+                   'X-Request-Id': 'import-request'}
+        with self.override_settings(import_batch_size=1,
+                                    server_timing=True), \
+                mock.patch.object(tracing, '_slow_statement_threshold', 0), \
+                self.assertLogs('tornado.application', 'WARNING') as logs:
+            response = self.fetch('/api/users/import', method='POST',
+                                  headers=headers,
+                                  body_producer=body_producer)
+
+        self.assertEqual(response.code, 200)
+        # the users are written while the body is being received
+        self.assertRegex(response.headers['Server-Timing'],
+                         r'^db;dur=[0-9.]+;desc="[1-9][0-9]* statements"')
+        for line in logs.output:
+            self.assertIn('route /api/users/import, request import-request',
+                          line)
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+from http.client import HTTPConnection
+from socket import socket
+from tempfile import TemporaryDirectory
+from time import sleep, time
+from typing import Callable, List
+from unittest import TestCase, mock
+
+from tornado.gen import convert_yielded
+
+from fooapi_async import database_operations
+from fooapi_async.app import _drain
+from tests.functional import BaseTest
+
+
+class DrainTest(BaseTest):
+    def test_requests_in_flight_finished(self) -> None:
+        get_users = database_operations.get_user_list_values
+
+        async def slow_get_users(**kwargs):
+            await asyncio.sleep(0.2)
+            return await get_users(**kwargs)
+
+        async def request_then_drain() -> int:
+            request = convert_yielded(self.http_client.fetch(
+                self.get_url('/api/users'), raise_error=False))
+            await asyncio.sleep(0.1)
+            await _drain(self.http_server, timeout=5)
+            return (await request).code
+
+        with mock.patch('fooapi_async.api.get_user_list_values',
+                        slow_get_users):
+            self.assertEqual(self.io_loop.run_sync(request_then_drain), 200)
+
+    def test_drain_bounded(self) -> None:
+        async def stuck_get_users(**kwargs):
+            await asyncio.sleep(60)
+
+        async def request_then_drain() -> float:
+            self.http_client.fetch(self.get_url('/api/users'),
+                                   raise_error=False)
+            await asyncio.sleep(0.1)
+            started = time()
+            await _drain(self.http_server, timeout=0.2)
+            return time() - started
+
+        with mock.patch('fooapi_async.api.get_user_list_values',
+                        stuck_get_users):
+            self.assertLess(self.io_loop.run_sync(request_then_drain), 1)
+
+
+class SupervisorTest(TestCase):
+    """
+    Runs manage.py run --workers 2 against a file database
+    """
+
+    def setUp(self) -> None:
+        self.tmp_dir = TemporaryDirectory()
+        with socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+
+        with open('settings-test.json') as f:
+            settings = json.load(f)
+        settings['api_port'] = self.port
+        settings['db_uri'] = 'sqlite://{}/db.sqlite3'.format(
+            self.tmp_dir.name)
+        settings_file = os.path.join(self.tmp_dir.name, 'settings.json')
+        with open(settings_file, 'w') as f:
+            json.dump(settings, f)
+
+        manage = [sys.executable, 'manage.py', '--settings-file',
+                  settings_file]
+        subprocess.run(manage + ['init-db'], check=True)
+        self.supervisor = subprocess.Popen(manage + ['run', '--workers', '2'])
+
+    def tearDown(self) -> None:
+        if self.supervisor.poll() is None:
+            for pid in self.worker_pids():
+                os.kill(pid, signal.SIGKILL)
+            self.supervisor.kill()
+            self.supervisor.wait()
+        self.tmp_dir.cleanup()
+
+    def worker_pids(self) -> List[int]:
+        pids = []
+        for entry in os.listdir('/proc'):
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    # the parent pid follows the state, after the command
+                    # name which may contain spaces
+                    stat = f.read().rsplit(')', 1)[1].split()
+            except (OSError, IndexError):
+                continue
+            if int(stat[1]) == self.supervisor.pid and stat[0] != 'Z':
+                pids.append(int(entry))
+        return sorted(pids)
+
+    def wait_for(self, predicate: Callable[[], bool],
+                 timeout: float = 10) -> None:
+        deadline = time() + timeout
+        while not predicate():
+            if time() > deadline:
+                self.fail('Timed out')
+            sleep(0.05)
+
+    def get_status(self) -> int:
+        connection = HTTPConnection('127.0.0.1', self.port, timeout=5)
+        try:
+            connection.request('GET', '/api/users')
+            return connection.getresponse().status
+        except OSError:
+            return 0
+        finally:
+            connection.close()
+
+    def test_dead_worker_restarted(self) -> None:
+        self.wait_for(lambda: len(self.worker_pids()) == 2)
+        self.wait_for(lambda: self.get_status() == 200)
+        killed, survivor = self.worker_pids()
+
+        os.kill(killed, signal.SIGKILL)
+
+        self.wait_for(lambda: len(self.worker_pids()) == 2 and
+                      killed not in self.worker_pids())
+        self.assertIn(survivor, self.worker_pids())
+        self.wait_for(lambda: self.get_status() == 200)
+
+    def test_workers_stopped_on_sigterm(self) -> None:
+        self.wait_for(lambda: len(self.worker_pids()) == 2)
+        self.wait_for(lambda: self.get_status() == 200)
+
+        self.supervisor.send_signal(signal.SIGTERM)
+
+        self.assertEqual(self.supervisor.wait(10), 0)
+        self.assertEqual(self.worker_pids(), [])
+        self.assertEqual(self.get_status(), 0)